@@ -18,4 +18,5 @@ sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
 import buildkit.cli
 sys.path.pop(0)
 
-buildkit.cli.main()
+if __name__ == '__main__':
+    buildkit.cli.main()
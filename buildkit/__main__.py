@@ -13,4 +13,5 @@ Pass in -h or --help for usage information.
 
 from . import cli
 
-cli.main()
+if __name__ == '__main__':
+    cli.main()
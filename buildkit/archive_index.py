@@ -0,0 +1,494 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Archive member indexes
+
+An index records the location and metadata of every member of a tar archive. For
+xz-compressed archives, it also records the boundaries of the xz blocks. Once an index
+is built, the members can be listed without decompressing the archive, and a subset of
+members can be extracted by decompressing only the blocks that contain them.
+"""
+
+import bisect
+import collections
+import gzip
+import itertools
+import json
+import lzma
+import os
+import tarfile
+import zlib
+from pathlib import Path, PurePosixPath
+
+from .common import ENCODING, get_logger
+from .extraction import TarStreamReader, get_python_opener, open_tar_stream
+
+# Constants
+
+INDEX_SUFFIX = '.index'
+
+_INDEX_VERSION = 1
+_READ_SIZE = 1024 * 1024 # 1 MiB
+
+_XZ_HEADER_MAGIC = b'\xfd7zXZ\x00'
+_XZ_FOOTER_MAGIC = b'YZ'
+_XZ_HEADER_SIZE = 12
+_XZ_FOOTER_SIZE = 12
+_XZ_MAX_VARINT_SIZE = 9
+
+# Public classes
+
+class ArchiveIndexError(Exception):
+    """Exception for archives or indexes that cannot be read"""
+
+IndexMember = collections.namedtuple(
+    'IndexMember', ('name', 'type', 'mode', 'size', 'mtime', 'data_offset', 'block', 'linkname'))
+IndexMember.__doc__ = """
+A member of an archive index.
+
+type is the tarfile member type as a string of one character.
+data_offset is the offset of the member's data in the uncompressed tar stream, and
+block is the number of the xz block containing it; None if the archive has no blocks.
+"""
+
+XzBlock = collections.namedtuple(
+    'XzBlock', ('compressed_offset', 'unpadded_size', 'uncompressed_offset',
+                'uncompressed_size', 'stream_flags'))
+XzBlock.__doc__ = """
+A block of an xz-compressed archive.
+
+compressed_offset is the offset of the block header in the archive file, and
+uncompressed_offset is the offset of the block's data in the uncompressed tar stream.
+stream_flags is the bytes of the stream flags of the stream containing the block.
+"""
+
+class ArchiveIndex:
+    """
+    An index of the members of a tar archive.
+
+    members is an OrderedDict of member names to IndexMember in archive order.
+    blocks is a list of XzBlock; it is empty for archives that are not compressed with xz.
+    uncompressed is a boolean indicating if the archive is an uncompressed tar file.
+    """
+    def __init__(self, members, blocks, uncompressed):
+        self.members = members
+        self.blocks = blocks
+        self.uncompressed = uncompressed
+
+    @staticmethod
+    def get_path(archive_path):
+        """Returns the pathlib.Path of the index file for archive_path"""
+        return archive_path.with_name(archive_path.name + INDEX_SUFFIX)
+
+    @classmethod
+    def build(cls, archive_path, threads=0):
+        """
+        Builds an index of archive_path by reading it once.
+
+        threads is the number of threads to decompress with, or 0 for one per CPU core.
+
+        Raises ArchiveIndexError if the archive cannot be read.
+        May raise BuildkitAbort if the decompressor fails.
+        """
+        get_logger().info('Building index of %s ...', archive_path)
+        uncompressed = get_python_opener(archive_path) is open
+        with archive_path.open('rb') as archive_file:
+            blocks = _read_xz_blocks(archive_file)
+        block_starts = [x.uncompressed_offset for x in blocks]
+        members = collections.OrderedDict()
+        with open_tar_stream(archive_path, threads) as source:
+            try:
+                counting_reader = _CountingReader(source)
+                for tarinfo in TarStreamReader(counting_reader):
+                    data_offset = counting_reader.position
+                    if blocks:
+                        block = bisect.bisect_right(block_starts, data_offset) - 1
+                    else:
+                        block = None
+                    members[tarinfo.name] = IndexMember(
+                        tarinfo.name, tarinfo.type.decode(ENCODING), tarinfo.mode,
+                        tarinfo.size, tarinfo.mtime, data_offset, block, tarinfo.linkname)
+                # Read the rest of the stream so the decompressor verifies all of it
+                while counting_reader.read(_READ_SIZE):
+                    pass
+            except (EOFError, OSError, lzma.LZMAError, tarfile.TarError) as exc:
+                raise ArchiveIndexError('Unable to read {}: {}'.format(archive_path, exc))
+        get_logger().info('Indexed %s members in %s xz blocks', len(members), len(blocks))
+        return cls(members, blocks, uncompressed)
+
+    @classmethod
+    def load(cls, archive_path):
+        """
+        Loads the index of archive_path.
+
+        Returns None if there is no index, or the archive changed since it was indexed.
+        """
+        index_path = cls.get_path(archive_path)
+        try:
+            with gzip.open(str(index_path), 'rt', encoding=ENCODING) as index_file:
+                index_data = json.load(index_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as exc:
+            get_logger().warning('Ignoring invalid index %s: %s', index_path, exc)
+            return None
+        stat_result = archive_path.stat()
+        if index_data.get('version') != _INDEX_VERSION or (
+                index_data.get('archive_size') != stat_result.st_size) or (
+                    index_data.get('archive_mtime_ns') != stat_result.st_mtime_ns):
+            get_logger().info('Index of %s is outdated', archive_path)
+            return None
+        blocks = list(XzBlock(*x[:4], bytes.fromhex(x[4])) for x in index_data['blocks'])
+        members = collections.OrderedDict(
+            (x[0], IndexMember(*x)) for x in index_data['members'])
+        return cls(members, blocks, index_data['uncompressed'])
+
+    def save(self, archive_path):
+        """Atomically writes the index of archive_path next to it"""
+        stat_result = archive_path.stat()
+        index_data = {
+            'version': _INDEX_VERSION,
+            'archive_size': stat_result.st_size,
+            'archive_mtime_ns': stat_result.st_mtime_ns,
+            'uncompressed': self.uncompressed,
+            'blocks': list(x[:4] + (x.stream_flags.hex(),) for x in self.blocks),
+            'members': list(self.members.values()),
+        }
+        index_path = self.get_path(archive_path)
+        temp_path = index_path.with_name(index_path.name + '.tmp')
+        with gzip.open(str(temp_path), 'wt', encoding=ENCODING) as index_file:
+            json.dump(index_data, index_file, separators=(',', ':'))
+        temp_path.replace(index_path)
+
+# Private definitions
+
+class _CountingReader: #pylint: disable=too-few-public-methods
+    """Readable file object that counts the bytes read from file_obj"""
+    def __init__(self, file_obj):
+        self._file_obj = file_obj
+        self.position = 0
+
+    def read(self, size=-1):
+        """Reads up to size bytes"""
+        data = self._file_obj.read(size)
+        self.position += len(data)
+        return data
+
+def _decode_xz_varint(data, position):
+    """
+    Returns a tuple of the xz variable-length integer in data at position, and the position
+    after it.
+
+    Raises ArchiveIndexError if it is invalid.
+    """
+    value = 0
+    for byte_number in range(_XZ_MAX_VARINT_SIZE):
+        if position >= len(data):
+            break
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << (byte_number * 7)
+        if byte < 0x80:
+            return value, position
+    raise ArchiveIndexError('Invalid integer in xz index')
+
+def _encode_xz_varint(value):
+    """Returns the bytes of value as an xz variable-length integer"""
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _crc32_bytes(data):
+    """Returns the little-endian bytes of the CRC32 of data"""
+    return zlib.crc32(data).to_bytes(4, 'little')
+
+def _read_xz_stream(archive_file, stream_end):
+    """
+    Reads the footer and index of the xz stream ending at stream_end.
+
+    Returns a tuple of the offset of the stream, its stream flags, and a list of
+    (compressed_offset, unpadded_size, uncompressed_size) tuples of its blocks.
+
+    Raises ArchiveIndexError if the stream is invalid.
+    """
+    archive_file.seek(stream_end - _XZ_FOOTER_SIZE)
+    footer = archive_file.read(_XZ_FOOTER_SIZE)
+    if footer[-2:] != _XZ_FOOTER_MAGIC or _crc32_bytes(footer[4:10]) != footer[:4]:
+        raise ArchiveIndexError('Invalid xz stream footer')
+    index_size = (int.from_bytes(footer[4:8], 'little') + 1) * 4
+    stream_flags = footer[8:10]
+    index_start = stream_end - _XZ_FOOTER_SIZE - index_size
+    if index_start < _XZ_HEADER_SIZE:
+        raise ArchiveIndexError('Invalid xz index size')
+    archive_file.seek(index_start)
+    index = archive_file.read(index_size)
+    if index[0] != 0 or _crc32_bytes(index[:-4]) != index[-4:]:
+        raise ArchiveIndexError('Invalid xz index')
+    record_count, position = _decode_xz_varint(index, 1)
+    records = list()
+    for _ in range(record_count):
+        unpadded_size, position = _decode_xz_varint(index, position)
+        uncompressed_size, position = _decode_xz_varint(index, position)
+        records.append((unpadded_size, uncompressed_size))
+    stream_start = index_start - sum((x[0] + 3) // 4 * 4 for x in records) - _XZ_HEADER_SIZE
+    if stream_start < 0:
+        raise ArchiveIndexError('Invalid xz index records')
+    archive_file.seek(stream_start)
+    header = archive_file.read(_XZ_HEADER_SIZE)
+    if not header.startswith(_XZ_HEADER_MAGIC) or header[6:8] != stream_flags:
+        raise ArchiveIndexError('Invalid xz stream header')
+    blocks = list()
+    compressed_offset = stream_start + _XZ_HEADER_SIZE
+    for unpadded_size, uncompressed_size in records:
+        blocks.append((compressed_offset, unpadded_size, uncompressed_size))
+        compressed_offset += (unpadded_size + 3) // 4 * 4
+    return stream_start, stream_flags, blocks
+
+def _read_xz_blocks(archive_file):
+    """
+    Returns a list of XzBlock of the xz-compressed archive_file in order, using the indexes
+    at the end of its streams; an empty list if it is not compressed with xz.
+
+    Raises ArchiveIndexError if the xz streams are invalid.
+    """
+    if archive_file.read(len(_XZ_HEADER_MAGIC)) != _XZ_HEADER_MAGIC:
+        return list()
+    streams = list()
+    stream_end = archive_file.seek(0, os.SEEK_END)
+    while stream_end > 0:
+        # Skip stream padding
+        archive_file.seek(stream_end - 4)
+        if archive_file.read(4) == bytes(4):
+            stream_end -= 4
+            continue
+        stream_start, stream_flags, stream_blocks = _read_xz_stream(archive_file, stream_end)
+        streams.append((stream_flags, stream_blocks))
+        stream_end = stream_start
+    blocks = list()
+    uncompressed_offset = 0
+    for stream_flags, stream_blocks in reversed(streams):
+        for compressed_offset, unpadded_size, uncompressed_size in stream_blocks:
+            blocks.append(XzBlock(
+                compressed_offset, unpadded_size, uncompressed_offset, uncompressed_size,
+                stream_flags))
+            uncompressed_offset += uncompressed_size
+    return blocks
+
+def _iter_xz_block(archive_file, block):
+    """
+    Yields the uncompressed data of the XzBlock block of archive_file in chunks.
+
+    The block is decompressed by wrapping it in a new xz stream containing only that block,
+    so lzma handles its filters and integrity check.
+
+    Raises ArchiveIndexError if the block is invalid.
+    """
+    stream_header = _XZ_HEADER_MAGIC + block.stream_flags + _crc32_bytes(block.stream_flags)
+    index = b'\x00' + _encode_xz_varint(1) + _encode_xz_varint(block.unpadded_size) + (
+        _encode_xz_varint(block.uncompressed_size))
+    index += bytes(-len(index) % 4)
+    index += _crc32_bytes(index)
+    footer_fields = (len(index) // 4 - 1).to_bytes(4, 'little') + block.stream_flags
+    stream_footer = _crc32_bytes(footer_fields) + footer_fields + _XZ_FOOTER_MAGIC
+
+    def _iter_block_bytes():
+        archive_file.seek(block.compressed_offset)
+        remaining = (block.unpadded_size + 3) // 4 * 4
+        while remaining > 0:
+            data = archive_file.read(min(remaining, _READ_SIZE))
+            if not data:
+                raise ArchiveIndexError('Unexpected end of xz block')
+            remaining -= len(data)
+            yield data
+
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    try:
+        for data in itertools.chain(
+                (stream_header, ), _iter_block_bytes(), (index + stream_footer, )):
+            output = decompressor.decompress(data, _READ_SIZE)
+            while output:
+                yield output
+                if decompressor.needs_input or decompressor.eof:
+                    break
+                output = decompressor.decompress(b'', _READ_SIZE)
+    except lzma.LZMAError as exc:
+        raise ArchiveIndexError('Unable to decompress xz block: {}'.format(exc))
+    if not decompressor.eof:
+        raise ArchiveIndexError('Incomplete xz block')
+
+class _IndexedDataReader:
+    """
+    Reads ranges of the uncompressed tar stream of an indexed archive.
+
+    Reading is fastest for ranges in increasing order. xz-compressed archives are
+    decompressed starting from the block containing the range, uncompressed archives are
+    read directly, and other archives are decompressed from the start.
+    """
+    def __init__(self, archive_path, index):
+        self._archive_path = archive_path
+        self._index = index
+        self._block_starts = list(x.uncompressed_offset for x in index.blocks)
+        self._archive_file = None
+        self._chunks = None
+        self._block_number = None
+        self._buffer = b''
+        self._position = 0
+
+    def _iter_blocks(self, block_number):
+        """Yields the uncompressed data of the blocks starting at block_number"""
+        for self._block_number in range(block_number, len(self._index.blocks)):
+            yield from _iter_xz_block(self._archive_file, self._index.blocks[self._block_number])
+
+    def _restart(self, offset):
+        """Starts reading the uncompressed stream at or before offset"""
+        self.close()
+        if self._index.blocks:
+            self._archive_file = self._archive_path.open('rb')
+            block_number = bisect.bisect_right(self._block_starts, offset) - 1
+            self._chunks = self._iter_blocks(block_number)
+            self._position = self._block_starts[block_number]
+        elif self._index.uncompressed:
+            self._archive_file = self._archive_path.open('rb')
+            self._archive_file.seek(offset)
+            self._chunks = iter(lambda: self._archive_file.read(_READ_SIZE), b'')
+            self._position = offset
+        else:
+            self._archive_file = get_python_opener(self._archive_path)(
+                str(self._archive_path), 'rb')
+            self._chunks = iter(lambda: self._archive_file.read(_READ_SIZE), b'')
+            self._position = 0
+
+    def _needs_restart(self, offset):
+        """Returns True if offset is behind the stream, or in a later block"""
+        if self._chunks is None or offset < self._position:
+            return True
+        if self._index.blocks and offset >= self._position + len(self._buffer):
+            return bisect.bisect_right(self._block_starts, offset) - 1 > self._block_number
+        return False
+
+    def iter_range(self, offset, size):
+        """
+        Yields the size bytes of the uncompressed stream at offset in chunks.
+
+        Raises ArchiveIndexError if the archive ends early or cannot be read.
+        """
+        if self._needs_restart(offset):
+            self._restart(offset)
+        while size > 0:
+            if not self._buffer:
+                try:
+                    self._buffer = next(self._chunks, b'')
+                except (EOFError, OSError, lzma.LZMAError) as exc:
+                    raise ArchiveIndexError('Unable to read {}: {}'.format(
+                        self._archive_path, exc))
+                if not self._buffer:
+                    raise ArchiveIndexError('Unexpected end of {}'.format(self._archive_path))
+            start = offset - self._position
+            if start >= len(self._buffer):
+                # Skip data before the range
+                self._position += len(self._buffer)
+                self._buffer = b''
+                continue
+            data = self._buffer[start:start + size]
+            offset += len(data)
+            size -= len(data)
+            self._position += start + len(data)
+            self._buffer = self._buffer[start + len(data):]
+            yield data
+
+    def close(self):
+        """Closes the archive"""
+        if not self._archive_file is None:
+            self._archive_file.close()
+            self._archive_file = None
+        self._chunks = None
+        self._buffer = b''
+
+# Public methods
+
+def get_archive_index(archive_path, threads=0):
+    """
+    Returns the ArchiveIndex of archive_path, building and saving it if it does not exist
+    or the archive changed since it was built.
+
+    threads is the number of threads to decompress with when building the index, or 0 for
+    one per CPU core.
+
+    Raises FileNotFoundError if the archive does not exist.
+    Raises ArchiveIndexError if the archive cannot be read.
+    May raise BuildkitAbort if the decompressor fails.
+    """
+    if not archive_path.is_file():
+        raise FileNotFoundError(archive_path)
+    index = ArchiveIndex.load(archive_path)
+    if index is None:
+        index = ArchiveIndex.build(archive_path, threads=threads)
+        index.save(archive_path)
+    return index
+
+def extract_members(archive_path, index, member_names, output_dir, relative_to=None):
+    """
+    Extracts a subset of the members of archive_path into output_dir using its index.
+
+    index is the ArchiveIndex of archive_path.
+    member_names is an iterable of POSIX path strings of members to extract, relative to
+    relative_to. Parent directories are created as needed.
+    relative_to is a pathlib.Path of the archive directory to strip from member names,
+    or None.
+
+    Returns a set of the names in member_names that are not in the archive.
+
+    Raises ArchiveIndexError if the archive cannot be read.
+    """
+    if relative_to is None:
+        prefix = PurePosixPath()
+    else:
+        prefix = PurePosixPath(Path(relative_to).as_posix())
+    selected = list()
+    missing = set()
+    for name in member_names:
+        member = index.members.get((prefix / name).as_posix())
+        if member is None:
+            missing.add(name)
+        else:
+            selected.append((name, member))
+    # Hardlinks are written from the data of their targets
+    data_members = dict()
+    for name, member in selected:
+        data_member = member
+        while data_member.type == '1' and data_member.linkname in index.members:
+            data_member = index.members[data_member.linkname]
+        data_members[name] = data_member
+    selected.sort(key=lambda x: data_members[x[0]].data_offset)
+    reader = _IndexedDataReader(archive_path, index)
+    try:
+        for name, member in selected:
+            path = output_dir / name
+            data_member = data_members[name]
+            if member.type == '5':
+                path.mkdir(parents=True, exist_ok=True)
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.is_symlink() or path.exists():
+                path.unlink()
+            if member.type == '2':
+                os.symlink(member.linkname, str(path))
+                continue
+            if data_member.type not in ('0', '\x00', '7'):
+                get_logger().warning('Ignoring unsupported member: %s', member.name)
+                continue
+            with path.open('wb') as output_file:
+                for data in reader.iter_range(data_member.data_offset, data_member.size):
+                    output_file.write(data)
+            os.chmod(str(path), data_member.mode & 0o7777)
+            os.utime(str(path), (data_member.mtime, data_member.mtime))
+    finally:
+        reader.close()
+    return missing
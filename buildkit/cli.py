@@ -18,18 +18,30 @@ the one in buildkit's parent directory.
 * BUILDKIT_USER_BUNDLE - Path to the user config bundle. Without it, commands
  that need a bundle default to buildspace/user_bundle. This value can be
  overridden per-command with the --user-bundle option.
+* BUILDKIT_DOWNLOAD_CACHE - Path to a download cache directory shared between
+ buildspaces. Without it, no download cache is used. This value can be
+ overridden with getsrc's --download-cache option.
+* BUILDKIT_SNAPSHOT_CACHE - Path to a directory of pristine buildspace tree snapshots
+ shared between buildspaces. Without it, no snapshots are used. This value can be
+ overridden with the --snapshot-cache option of getsrc and snapsh.
 """
 
 import argparse
 import os
+import time
 from pathlib import Path
 
+from . import archive_index
 from . import config
 from . import source_retrieval
 from . import domain_substitution
+from . import extraction
+from . import snapshot_cache
+from . import tree_manifest
 from .common import (
     CONFIG_BUNDLES_DIR, BUILDSPACE_DOWNLOADS, BUILDSPACE_TREE,
-    BUILDSPACE_TREE_PACKAGING, BUILDSPACE_USER_BUNDLE, SEVENZIP_USE_REGISTRY,
+    BUILDSPACE_TREE_PACKAGING, BUILDSPACE_USER_BUNDLE, BUILDSPACE_REMOTE_HASHES,
+    SEVENZIP_USE_REGISTRY,
     BuildkitAbort, ExtractorEnum, get_resources_dir, get_logger)
 from .config import ConfigBundle
 
@@ -81,8 +93,32 @@ def _default_user_bundle_path():
     """Returns the default path to the buildspace user bundle."""
     return os.getenv('BUILDKIT_USER_BUNDLE', default=BUILDSPACE_USER_BUNDLE)
 
-def setup_bundle_group(parser):
-    """Helper to add arguments for loading a config bundle to argparse.ArgumentParser"""
+def _megabytes_to_bytes(value):
+    """Converts a size in megabytes to bytes, passing through None"""
+    if value is None:
+        return None
+    return value * 1024 * 1024
+
+def _add_snapshot_cache_argument(parser):
+    """Adds the argument of the snapshot cache path to argparse.ArgumentParser"""
+    parser.add_argument(
+        '--snapshot-cache', metavar='PATH', type=Path,
+        default=os.getenv('BUILDKIT_SNAPSHOT_CACHE'),
+        help=('A directory of snapshots of pristine buildspace trees, which can be shared '
+              'between buildspaces. Use BUILDKIT_SNAPSHOT_CACHE to override the default '
+              'value. Current default: %(default)s'))
+
+def setup_bundle_group(parser, load_user_bundle=True):
+    """
+    Helper to add arguments for loading a config bundle to argparse.ArgumentParser
+
+    If load_user_bundle is False, the user bundle is not loaded while parsing arguments;
+    it is stored as a pathlib.Path to be loaded with get_bundle() when it is needed.
+    """
+    if load_user_bundle:
+        user_bundle_type = lambda x: ConfigBundle(Path(x))
+    else:
+        user_bundle_type = Path
     config_group = parser.add_mutually_exclusive_group()
     config_group.add_argument(
         '-b', '--base-bundle', metavar='NAME', dest='bundle', default=argparse.SUPPRESS,
@@ -93,11 +129,22 @@ def setup_bundle_group(parser):
     config_group.add_argument(
         '-u', '--user-bundle', metavar='PATH', dest='bundle',
         default=_default_user_bundle_path(),
-        type=lambda x: ConfigBundle(Path(x)),
+        type=user_bundle_type,
         help=('The path to a user bundle to use. '
               'Mutually exclusive with --base-bundle. Use BUILDKIT_USER_BUNDLE '
               'to override the default value. Current default: %(default)s'))
 
+def get_bundle(args):
+    """
+    Returns the config bundle from the arguments of setup_bundle_group(), loading the user
+    bundle if it was not loaded while parsing arguments.
+
+    Raises FileNotFoundError if the user bundle does not exist.
+    """
+    if isinstance(args.bundle, Path):
+        return ConfigBundle(args.bundle)
+    return args.bundle
+
 def _add_bunnfo(subparsers):
     """Gets info about base bundles."""
     def _callback(args):
@@ -163,7 +210,15 @@ def _add_getsrc(subparsers):
                 config_bundle=args.bundle, buildspace_downloads=args.downloads,
                 buildspace_tree=args.tree, prune_binaries=args.prune_binaries,
                 show_progress=args.show_progress, extractors=extractors,
-                disable_ssl_verification=args.disable_ssl_verification)
+                disable_ssl_verification=args.disable_ssl_verification,
+                download_connections=args.download_connections,
+                download_workers=args.download_workers,
+                download_cache=args.download_cache,
+                download_cache_size=_megabytes_to_bytes(args.download_cache_size),
+                paranoid=args.paranoid, decompress_threads=args.decompress_threads,
+                extract_workers=args.extract_workers, snapshot_cache=args.snapshot_cache,
+                snapshot_cache_size=_megabytes_to_bytes(args.snapshot_cache_size),
+                snapshot_method=args.snapshot_method)
         except FileExistsError as exc:
             get_logger().error('Directory is not empty: %s', exc)
             raise _CLIError()
@@ -187,9 +242,12 @@ def _add_getsrc(subparsers):
             'The %s directory must already exist for storing downloads. '
             'If the buildspace tree already exists or there is a checksum mismatch, '
             'this command will abort. '
-            'Only files that are missing will be downloaded. '
+            'Only files that are missing will be downloaded, and interrupted '
+            'downloads are resumed where possible. '
             'If the files are already downloaded, their checksums are '
-            'confirmed and then they are unpacked.') % BUILDSPACE_DOWNLOADS)
+            'confirmed and then they are unpacked. Checksums of files that are unchanged '
+            'since they were last confirmed are not computed again unless '
+            '--paranoid is specified.') % BUILDSPACE_DOWNLOADS)
     setup_bundle_group(parser)
     parser.add_argument(
         '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
@@ -212,9 +270,225 @@ def _add_getsrc(subparsers):
         '--7z-path', dest='sevenz_path', default=SEVENZIP_USE_REGISTRY,
         help=('Command or path to 7-Zip\'s "7z" binary. If "_use_registry" is '
               'specified, determine the path from the registry. Default: %(default)s'))
+    parser.add_argument(
+        '--decompress-threads', metavar='N', type=int, default=0,
+        help=('The number of threads to decompress archives with. 0 uses one thread per '
+              'CPU core. Archives are decompressed by commands such as xz, gzip, or zstd '
+              'piped into the extractor. xz archives are decompressed in parallel by xz 5.4 '
+              'or newer, or pixz, if either is found. 1 always uses one thread. '
+              'Default: %(default)s'))
+    parser.add_argument(
+        '--extract-workers', metavar='N', type=int, default=0,
+        help=('The maximum number of archives to extract at the same time, each in its own '
+              'process. Extra dependencies are extracted while the Chromium source code is '
+              'extracted. 0 uses one process per CPU core. Default: %(default)s'))
     parser.add_argument(
         '--disable-ssl-verification', action='store_true',
         help='Disables certification verification for downloads using HTTPS.')
+    parser.add_argument(
+        '--download-connections', metavar='N', type=int, default=1,
+        help=('The number of concurrent connections to download each archive with. '
+              'Servers that do not support range requests use one connection. '
+              'Default: %(default)s'))
+    parser.add_argument(
+        '--download-workers', metavar='N', type=int, default=1,
+        help=('The maximum number of archives to download at the same time. '
+              'Archives are extracted while the remaining archives download. '
+              'Default: %(default)s'))
+    parser.add_argument(
+        '--download-cache', metavar='PATH', type=Path,
+        default=os.getenv('BUILDKIT_DOWNLOAD_CACHE'),
+        help=('A directory to cache verified archives in, which can be shared between '
+              'buildspaces. Archives are linked from the cache when possible. Use '
+              'BUILDKIT_DOWNLOAD_CACHE to override the default value. '
+              'Current default: %(default)s'))
+    parser.add_argument(
+        '--download-cache-size', metavar='MB', type=int,
+        help=('The maximum size of the download cache in megabytes. The least recently '
+              'used archives are removed when it is exceeded. Default is no limit.'))
+    parser.add_argument(
+        '--paranoid', action='store_true',
+        help=('Always compute the hashes of existing archives, even if they are unchanged '
+              'since they were last verified.'))
+    _add_snapshot_cache_argument(parser)
+    parser.add_argument(
+        '--snapshot-cache-size', metavar='MB', type=int,
+        help=('The maximum size of the snapshot cache in megabytes. The least recently '
+              'used snapshots are removed when it is exceeded. Default is no limit.'))
+    parser.add_argument(
+        '--snapshot-method', choices=snapshot_cache.SNAPSHOT_METHODS,
+        default=snapshot_cache.SnapshotMethod.AUTO,
+        help=('How to materialize the buildspace tree from a snapshot. "auto" uses '
+              'copy-on-write clones if the filesystem supports them, then hard links if the '
+              'snapshot cache is on the same filesystem, and then copies. With hard links, '
+              'files modified in place (other than by domain substitution, whose files are '
+              'copied) also modify the snapshot. Default: %(default)s'))
+    parser.set_defaults(callback=_callback)
+
+def _add_snapsh(subparsers):
+    """Lists or purges snapshots of pristine buildspace trees."""
+    def _callback(args):
+        if not args.snapshot_cache:
+            get_logger().error('No snapshot cache specified')
+            raise _CLIError()
+        cache = snapshot_cache.SnapshotCache(args.snapshot_cache)
+        if args.list:
+            for snapshot in cache.list():
+                print('{}\t{}\t{:.1f} MB\t{}'.format(
+                    snapshot.name, snapshot.chromium_version, snapshot.size / 1024 / 1024,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot.last_used))))
+            return
+        if args.purge_all:
+            names = list(x.name for x in cache.list())
+        else:
+            names = args.purge
+        missing_snapshot = False
+        for name in names:
+            try:
+                cache.remove(name)
+                get_logger().info('Removed snapshot %s', name)
+            except FileNotFoundError:
+                get_logger().error('No such snapshot: %s', name)
+                missing_snapshot = True
+        if missing_snapshot:
+            raise _CLIError()
+    parser = subparsers.add_parser(
+        'snapsh', help=_add_snapsh.__doc__, description=_add_snapsh.__doc__ + (
+            ' Snapshots are created and used by getsrc when a snapshot cache is specified.'))
+    _add_snapshot_cache_argument(parser)
+    action_group = parser.add_mutually_exclusive_group(required=True)
+    action_group.add_argument(
+        '--list', action='store_true',
+        help=('Lists the name, Chromium version, size, and last use time of each snapshot, '
+              'most recently used first.'))
+    action_group.add_argument(
+        '--purge', metavar='NAME', nargs='+', help='Removes the given snapshots.')
+    action_group.add_argument(
+        '--purge-all', action='store_true', help='Removes all snapshots.')
+    parser.set_defaults(callback=_callback)
+
+def _add_arcidx(subparsers):
+    """Lists or extracts members of an archive using a member index."""
+    def _callback(args):
+        archive_path = args.archive
+        relative_to = args.relative_to
+        try:
+            if archive_path is None:
+                chromium_version = get_bundle(args).version.chromium_version
+                archive_path = args.downloads / 'chromium-{}.tar.xz'.format(chromium_version)
+                if relative_to is None:
+                    relative_to = Path('chromium-{}'.format(chromium_version))
+            index = archive_index.get_archive_index(
+                archive_path, threads=args.decompress_threads)
+            if args.list:
+                if relative_to is None:
+                    prefix = ''
+                else:
+                    prefix = relative_to.as_posix() + '/'
+                for member_name in index.members:
+                    if member_name.startswith(prefix):
+                        print(member_name[len(prefix):])
+                return
+            member_names = list(args.member)
+            if args.members_from:
+                with args.members_from.open(encoding='UTF-8') as members_file:
+                    member_names.extend(filter(len, members_file.read().splitlines()))
+            if args.domain_substitution:
+                member_names.extend(get_bundle(args).domain_substitution)
+            if not member_names:
+                get_logger().error('No members specified to extract')
+                raise _CLIError()
+            missing_members = archive_index.extract_members(
+                archive_path, index, member_names, args.extract, relative_to=relative_to)
+        except FileNotFoundError as exc:
+            get_logger().error('File or directory does not exist: %s', exc)
+            raise _CLIError()
+        except archive_index.ArchiveIndexError as exc:
+            get_logger().error('Unable to use archive index: %s', exc)
+            raise _CLIError()
+        if missing_members:
+            for member_name in sorted(missing_members):
+                get_logger().warning('No such member: %s', member_name)
+            raise _CLIError()
+    parser = subparsers.add_parser(
+        'arcidx', help=_add_arcidx.__doc__, description=_add_arcidx.__doc__ + (
+            ' The index is built by reading the archive once, and is stored next to it '
+            'with the suffix "%s". For xz archives with multiple blocks (e.g. compressed '
+            'with "xz -T0"), only the blocks containing the requested members are '
+            'decompressed. Other archives are decompressed up to the last requested '
+            'member.') % archive_index.INDEX_SUFFIX)
+    # The bundle is only needed without --archive, or with --domain-substitution
+    setup_bundle_group(parser, load_user_bundle=False)
+    parser.add_argument(
+        '-a', '--archive', type=Path,
+        help=('The archive to index. Default is the Chromium source archive of the bundle '
+              'in the downloads directory.'))
+    parser.add_argument(
+        '-d', '--downloads', type=Path, default=BUILDSPACE_DOWNLOADS,
+        help='Path containing the Chromium source archive. Default: %(default)s')
+    parser.add_argument(
+        '--relative-to', type=Path,
+        help=('The archive directory that member paths are relative to. Default is the '
+              'top-level directory of the Chromium source archive if --archive is not '
+              'specified; otherwise, paths are relative to the archive root.'))
+    parser.add_argument(
+        '--decompress-threads', metavar='N', type=int, default=0,
+        help=('The number of threads to decompress the archive with when building the '
+              'index. 0 uses one thread per CPU core. Default: %(default)s'))
+    action_group = parser.add_mutually_exclusive_group(required=True)
+    action_group.add_argument(
+        '--list', action='store_true', help='Lists the members of the archive.')
+    action_group.add_argument(
+        '-x', '--extract', metavar='DIRECTORY', type=Path,
+        help='Extracts the selected members into DIRECTORY.')
+    parser.add_argument(
+        '--member', metavar='PATH', action='append', default=list(),
+        help='A member to extract. Can be specified multiple times.')
+    parser.add_argument(
+        '--members-from', metavar='FILE', type=Path,
+        help='A file listing members to extract, one per line.')
+    parser.add_argument(
+        '--domain-substitution', action='store_true',
+        help='Extracts the files in the bundle\'s domain_substitution.list.')
+    parser.set_defaults(callback=_callback)
+
+def _add_vertree(subparsers):
+    """Verifies the buildspace tree against the manifest written by getsrc."""
+    def _callback(args):
+        try:
+            problems = tree_manifest.verify_tree(
+                args.tree, check_hashes=not args.quick, threads=args.threads)
+        except FileNotFoundError as exc:
+            get_logger().error(
+                'File or directory does not exist: %s. The tree may be from an incomplete '
+                'extraction.', exc)
+            raise _CLIError()
+        except ValueError as exc:
+            get_logger().error('Unable to verify tree: %s', exc)
+            raise _CLIError()
+        for problem in problems:
+            get_logger().error('%s: %s', problem.path, problem.reason)
+        if problems:
+            get_logger().error('Buildspace tree does not match manifest: %s problems',
+                               len(problems))
+            raise _CLIError()
+        get_logger().info('Buildspace tree matches manifest')
+    parser = subparsers.add_parser(
+        'vertree', help=_add_vertree.__doc__, description=_add_vertree.__doc__ + (
+            ' The manifest is only written once extraction completes, so a tree without one '
+            'is from an interrupted extraction. Files changed afterwards, such as by '
+            'subdom, are reported as differing.'))
+    parser.add_argument(
+        '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
+        help='The buildspace tree path to verify. Default: %(default)s')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help=('Only checks the types, sizes, and modes of files instead of also hashing '
+              'their contents.'))
+    parser.add_argument(
+        '--threads', metavar='N', type=int, default=0,
+        help=('The number of threads to verify files with. 0 uses one thread per CPU core. '
+              'Default: %(default)s'))
     parser.set_defaults(callback=_callback)
 
 def _add_prubin(subparsers):
@@ -226,14 +500,13 @@ def _add_prubin(subparsers):
         except FileNotFoundError as exc:
             logger.error('File or directory does not exist: %s', exc)
             raise _CLIError()
-        missing_file = False
-        for tree_node in args.bundle.pruning:
-            try:
-                (resolved_tree / tree_node).unlink()
-            except FileNotFoundError:
-                missing_file = True
-                logger.warning('No such file: %s', resolved_tree / tree_node)
-        if missing_file:
+        pruning_set = set(args.bundle.pruning)
+        missing_files, pruned_size = extraction.prune_files(resolved_tree, pruning_set)
+        for tree_node in sorted(missing_files):
+            logger.warning('No such file: %s', resolved_tree / tree_node)
+        logger.info('Pruned %s files (%.1f MB)', len(pruning_set) - len(missing_files),
+                    pruned_size / 1024 / 1024)
+        if missing_files:
             raise _CLIError()
     parser = subparsers.add_parser(
         'prubin', help=_add_prubin.__doc__, description=_add_prubin.__doc__ + (
@@ -248,9 +521,24 @@ def _add_prubin(subparsers):
 def _add_subdom(subparsers):
     """Substitutes domain names in buildspace tree or patches with blockable strings."""
     def _callback(args):
+        if args.check_combined:
+            try:
+                mismatched_files = domain_substitution.check_tree_with_bundle(
+                    args.bundle, args.tree)
+            except FileNotFoundError as exc:
+                get_logger().error('File or directory does not exist: %s', exc)
+                raise _CLIError()
+            except ValueError as exc:
+                get_logger().error('Regex pairs cannot be combined: %s', exc)
+                raise _CLIError()
+            if mismatched_files:
+                raise _CLIError()
+            get_logger().info('Combined substitution is identical for all files')
+            return
         try:
             if not args.only or args.only == 'tree':
-                domain_substitution.process_tree_with_bundle(args.bundle, args.tree)
+                domain_substitution.process_tree_with_bundle(
+                    args.bundle, args.tree, jobs=args.jobs, combined=args.combined)
             if not args.only or args.only == 'patches':
                 domain_substitution.process_bundle_patches(args.bundle)
         except FileNotFoundError as exc:
@@ -262,7 +550,9 @@ def _add_subdom(subparsers):
     parser = subparsers.add_parser(
         'subdom', help=_add_subdom.__doc__, description=_add_subdom.__doc__ + (
             ' By default, it will substitute the domains on both the buildspace tree and '
-            'the bundle\'s patches.'))
+            'the bundle\'s patches. Files of the buildspace tree that are unchanged since '
+            'they were substituted with the same regex pairs are skipped, according to a '
+            'journal next to the tree.'))
     setup_bundle_group(parser)
     parser.add_argument(
         '-o', '--only', choices=['tree', 'patches'],
@@ -272,6 +562,21 @@ def _add_subdom(subparsers):
         '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
         help=('The buildspace tree path to apply domain substitution. '
               'Not applicable when --only is "patches". Default: %(default)s'))
+    parser.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=1,
+        help=('The number of processes to substitute the files of the buildspace tree in. '
+              '0 uses one process per CPU core. Default: %(default)s'))
+    parser.add_argument(
+        '--combined', action='store_true',
+        help=('Substitutes the files of the buildspace tree with the regex pairs combined '
+              'into one pattern, so each file is scanned once. Falls back to applying each '
+              'pair in order if the pairs cannot be combined.'))
+    parser.add_argument(
+        '--check-combined', action='store_true',
+        help=('Instead of substituting, checks that the regex pairs combined into one '
+              'pattern, and matched on the bytes of files where possible, give identical '
+              'results to applying each pair in order to the decoded files of the '
+              'buildspace tree. Files are not modified.'))
     parser.set_defaults(callback=_callback)
 
 def _add_genpkg_archlinux(subparsers):
@@ -281,7 +586,7 @@ def _add_genpkg_archlinux(subparsers):
         try:
             packaging_archlinux.generate_packaging(
                 args.bundle, args.output, repo_version=args.repo_commit,
-                repo_hash=args.repo_hash)
+                repo_hash=args.repo_hash, repo_hash_cache=args.repo_hash_cache)
         except FileExistsError as exc:
             get_logger().error('PKGBUILD already exists: %s', exc)
             raise _CLIError()
@@ -308,9 +613,17 @@ def _add_genpkg_archlinux(subparsers):
         '--repo-hash', default='SKIP',
         help=('The SHA-256 hash to verify the archive of the ungoogled-chromium '
               'repository to download within the PKGBUILD. If it is "compute", '
-              'the hash is computed by downloading the archive to memory and '
+              'the hash is computed by downloading the archive and '
               'computing the hash. If it is "SKIP", hash computation is skipped. '
               'Default: %(default)s'))
+    parser.add_argument(
+        '--repo-hash-cache', type=Path, default=BUILDSPACE_REMOTE_HASHES,
+        help=('The file caching hashes computed with "--repo-hash compute". '
+              'The archive is not downloaded again if the server reports it is unchanged. '
+              'Default: %(default)s'))
+    parser.add_argument(
+        '--no-repo-hash-cache', dest='repo_hash_cache', action='store_const', const=None,
+        help='Do not use or update the cache of computed hashes.')
     parser.set_defaults(callback=_callback)
 
 def _add_genpkg_debian(subparsers):
@@ -455,6 +768,9 @@ def main(arg_list=None):
     _add_bunnfo(subparsers)
     _add_genbun(subparsers)
     _add_getsrc(subparsers)
+    _add_snapsh(subparsers)
+    _add_arcidx(subparsers)
+    _add_vertree(subparsers)
     _add_prubin(subparsers)
     _add_subdom(subparsers)
     _add_genpkg(subparsers)
@@ -24,11 +24,15 @@ BUILDSPACE_DOWNLOADS = 'buildspace/downloads'
 BUILDSPACE_TREE = 'buildspace/tree'
 BUILDSPACE_TREE_PACKAGING = 'buildspace/tree/ungoogled_packaging'
 BUILDSPACE_USER_BUNDLE = 'buildspace/user_bundle'
+BUILDSPACE_REMOTE_HASHES = 'buildspace/remote_hashes.ini'
 
 SEVENZIP_USE_REGISTRY = '_use_registry'
 
 _ENV_FORMAT = "BUILDKIT_{}"
 
+# ioctl request number to clone a file on Linux (from linux/fs.h)
+_FICLONE = 0x40049409
+
 # Public classes
 
 class BuildkitError(Exception):
@@ -125,6 +129,30 @@ def ensure_empty_dir(path, parents=False):
         if not dir_empty(path):
             raise exc
 
+def reflink_file(src_path, dest_path):
+    """
+    Creates dest_path as a copy-on-write clone of src_path, sharing the data blocks of
+    src_path until either file is modified.
+
+    src_path and dest_path are pathlib.Path objects. dest_path must not already exist.
+
+    Raises OSError if the platform or filesystem does not support cloning files.
+    Raises FileExistsError if dest_path already exists.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError('Cloning files is not supported on this platform')
+    if not platform.system() == 'Linux':
+        raise OSError('Cloning files is not supported on this platform')
+    with src_path.open('rb') as src_file, dest_path.open('xb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+        except OSError:
+            dest_file.close()
+            dest_path.unlink()
+            raise
+
 def get_running_platform():
     """
     Returns a PlatformEnum value indicating the platform that buildkit is running on.
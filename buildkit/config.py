@@ -635,7 +635,7 @@ class ExtraDepsIni(IniConfigFile):
 
     _hashes = ('md5', 'sha1', 'sha256', 'sha512')
     _required_keys = ('version', 'url', 'download_name', 'output_path')
-    _optional_keys = ('strip_leading_dirs',)
+    _optional_keys = ('strip_leading_dirs', 'mirrors')
     _passthrough_properties = (*_required_keys, *_optional_keys, 'extractor')
 
     _schema = schema.Schema(schema_inisections({
@@ -656,6 +656,10 @@ class ExtraDepsIni(IniConfigFile):
         def __getattr__(self, name):
             if name in self._passthrough_properties:
                 return self._section_dict.get(name, fallback=None)
+            elif name == 'urls':
+                # Additional mirrors are delimited by whitespace, including newlines
+                mirrors = self._section_dict.get('mirrors', fallback='')
+                return (self._section_dict.get('url'), *mirrors.split())
             elif name == 'hashes':
                 hashes_dict = dict()
                 for hash_name in self._hashes:
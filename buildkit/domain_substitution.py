@@ -8,45 +8,728 @@
 Module for substituting domain names in buildspace tree with blockable strings.
 """
 
+import collections
+import concurrent.futures
+import functools
+import json
+import mmap
+import os
+import re
+
+# The regex parser of the re module is private, so it is only used for optimizations that
+# are skipped when it is unavailable or fails (see _parse_pattern())
+try:
+    import re._parser as sre_parse # Python 3.11+
+except ImportError:
+    try:
+        import sre_parse #pylint: disable=deprecated-module
+    except ImportError:
+        sre_parse = None #pylint: disable=invalid-name
+
 from .common import ENCODING, BuildkitAbort, get_logger
+from .tree_manifest import HASH_NAME, new_hasher
 from .third_party import unidiff
 
-# Encodings to try on buildspace tree files
+# Encodings to try on buildspace tree files. They must encode ASCII characters as themselves
+# and other characters as bytes outside of ASCII, so that ASCII patterns match the bytes of
+# files the same way as their decoded text.
 TREE_ENCODINGS = (ENCODING, 'ISO-8859-1')
 
-def substitute_domains_for_files(regex_iter, file_iter, log_warnings=True):
+# Suffix of the journal of domain substitution written next to a buildspace tree
+JOURNAL_SUFFIX = '.domsub'
+
+_JOURNAL_VERSION = 1
+
+# Empty named group that marks the pair of a match of the combined pattern
+_PAIR_GROUP = '(?P<_pair{}>)'
+# Escapes in replacements: group references by number or name, and other escapes
+_REPLACEMENT_ESCAPE = re.compile(r'\\(?:g<([^>]*)>|([1-9][0-9]?)|(.))', re.DOTALL)
+# Character class categories that never match a newline
+_LINE_LOCAL_CATEGORIES = frozenset(('CATEGORY_DIGIT', 'CATEGORY_WORD', 'CATEGORY_NOT_SPACE'))
+_NEWLINE = ord('\n')
+# Number of chunks of files given to each worker process
+_CHUNKS_PER_WORKER = 8
+
+# Regex pairs compiled to match bytes, or rebuilt in worker processes since
+# config.DomainRegexList pairs can't be pickled
+_RegexPair = collections.namedtuple('_RegexPair', ('pattern', 'replacement'))
+
+# Function that substitutes file content, and if it takes the bytes of files instead of
+# their decoded text
+_Substituter = collections.namedtuple('_Substituter', ('subn', 'takes_bytes'))
+
+# Journal entry of a substituted file: the hashes of its content before and after
+# substitution, its size and modification time in nanoseconds after substitution, and the
+# number of substitutions
+_JournalEntry = collections.namedtuple(
+    '_JournalEntry', ('original_hash', 'substituted_hash', 'size', 'mtime_ns', 'subs'))
+
+# _Substituter and name of the hash algorithm of journal entries of each worker process
+_worker_substituter = None #pylint: disable=invalid-name
+_worker_hash_name = None #pylint: disable=invalid-name
+
+def _parse_pattern(pattern):
+    """
+    Returns the compiled pattern parsed by the private regex parser of the re module.
+
+    Raises ValueError if the parser is unavailable or fails.
+    """
+    if sre_parse is None:
+        raise ValueError('Regex parser is unavailable')
+    try:
+        return sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception as exc: #pylint: disable=broad-except
+        raise ValueError('Unable to parse pattern: {}: {}'.format(pattern.pattern, exc))
+
+def _check_line_local_charset(charset):
+    """
+    Raises ValueError if the parsed character class charset may match a newline
+    """
+    for item_op, item_av in charset:
+        item_op = str(item_op)
+        if item_op == 'LITERAL' and item_av != _NEWLINE:
+            continue
+        if item_op == 'RANGE' and not item_av[0] <= _NEWLINE <= item_av[1]:
+            continue
+        if item_op == 'CATEGORY' and str(item_av) in _LINE_LOCAL_CATEGORIES:
+            continue
+        raise ValueError('Character class may match a newline')
+
+def _check_line_local(subpattern, flags):
+    """
+    Raises ValueError if the parsed pattern subpattern may match a newline, or depends on
+    the text around its matches (anchors, lookarounds, or group references).
+
+    flags are the flags the pattern is compiled with.
+    """
+    for op, av in subpattern:
+        op = str(op)
+        if op == 'LITERAL':
+            if av == _NEWLINE:
+                raise ValueError('Pattern matches a newline')
+        elif op == 'NOT_LITERAL':
+            if av != _NEWLINE:
+                raise ValueError('Pattern may match a newline')
+        elif op == 'ANY':
+            if flags & re.DOTALL:
+                raise ValueError('Pattern may match a newline')
+        elif op == 'IN':
+            _check_line_local_charset(av)
+        elif op == 'BRANCH':
+            for branch in av[1]:
+                _check_line_local(branch, flags)
+        elif op == 'SUBPATTERN':
+            if any(av[1:-1]):
+                raise ValueError('Pattern has scoped flags')
+            _check_line_local(av[-1], flags)
+        elif op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'):
+            _check_line_local(av[2], flags)
+        elif op == 'ATOMIC_GROUP':
+            _check_line_local(av, flags)
+        else:
+            raise ValueError('Unsupported pattern construct: {}'.format(op))
+
+def _shift_replacement(replacement, offset, group_count):
+    """
+    Returns the replacement template with its group references shifted by offset.
+
+    group_count is the number of groups in the pattern of the replacement.
+
+    Raises ValueError if the replacement contains a newline, a group reference by name or
+    to a missing group, or an escape other than of a backslash.
+    """
+    if '\n' in replacement:
+        raise ValueError('Replacement contains a newline')
+
+    def _shift(match):
+        group_ref, group_number, other = match.groups()
+        if not other is None:
+            if other == '\\':
+                return r'\\'
+            raise ValueError('Unsupported escape in replacement: \\{}'.format(other))
+        if group_number is None:
+            group_number = group_ref
+        if not group_number.isdigit() or not 0 < int(group_number) <= group_count:
+            raise ValueError('Unsupported group reference in replacement: {}'.format(
+                match.group()))
+        return r'\g<{}>'.format(int(group_number) + offset)
+
+    return _REPLACEMENT_ESCAPE.sub(_shift, replacement)
+
+def _check_ascii_only(subpattern):
+    """
+    Raises ValueError if the parsed pattern subpattern may match a character outside of
+    ASCII, or a construct that matches differently on bytes than on text.
+    """
+    for op, av in subpattern:
+        op = str(op)
+        if op == 'LITERAL':
+            if av > 127:
+                raise ValueError('Pattern is not ASCII')
+        elif op == 'IN':
+            for item_op, item_av in av:
+                item_op = str(item_op)
+                if item_op == 'LITERAL' and item_av <= 127:
+                    continue
+                if item_op == 'RANGE' and item_av[1] <= 127:
+                    continue
+                raise ValueError('Character class may match characters outside of ASCII')
+        elif op == 'BRANCH':
+            for branch in av[1]:
+                _check_ascii_only(branch)
+        elif op == 'SUBPATTERN':
+            if any(av[1:-1]):
+                raise ValueError('Pattern has scoped flags')
+            _check_ascii_only(av[-1])
+        elif op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'):
+            _check_ascii_only(av[2])
+        elif op == 'ATOMIC_GROUP':
+            _check_ascii_only(av)
+        else:
+            raise ValueError('Unsupported pattern construct on bytes: {}'.format(op))
+
+def _get_bytes_pairs(regex_pairs):
+    """
+    Returns a tuple of _RegexPair of regex_pairs compiled to match bytes. On the bytes of
+    content in any of TREE_ENCODINGS, they give the same results as regex_pairs on the
+    decoded content.
+
+    Raises ValueError if a pattern may match characters outside of ASCII, depends on Unicode
+    (case-insensitive matching, character categories, or word boundaries), or matches
+    empty strings; or if a replacement is not ASCII.
+    """
+    bytes_pairs = list()
+    for regex_pair in regex_pairs:
+        pattern = regex_pair.pattern
+        if pattern.flags & re.IGNORECASE:
+            raise ValueError('Pattern is case-insensitive: {}'.format(pattern.pattern))
+        parsed = _parse_pattern(pattern)
+        try:
+            if not parsed.getwidth()[0]:
+                raise ValueError('Pattern matches empty strings: {}'.format(pattern.pattern))
+            _check_ascii_only(parsed)
+        except (AttributeError, IndexError, TypeError) as exc:
+            raise ValueError('Unable to analyze pattern: {}: {}'.format(pattern.pattern, exc))
+        try:
+            bytes_pattern = re.compile(
+                pattern.pattern.encode('ascii'), pattern.flags & ~re.UNICODE)
+            bytes_replacement = regex_pair.replacement.encode('ascii')
+            # Compare the replacements without their group references, which are replaced
+            # with the same ASCII text on bytes and on text
+            expanded = re.match('()' * pattern.groups, '').expand(
+                regex_pair.replacement).encode('ascii')
+            bytes_expanded = re.match(b'()' * pattern.groups, b'').expand(bytes_replacement)
+        except (UnicodeEncodeError, re.error, IndexError) as exc:
+            raise ValueError('Unable to match regex pair on bytes: {}: {}'.format(
+                pattern.pattern, exc))
+        if expanded != bytes_expanded:
+            raise ValueError('Replacement differs on bytes: {}'.format(regex_pair.replacement))
+        bytes_pairs.append(_RegexPair(bytes_pattern, bytes_replacement))
+    return tuple(bytes_pairs)
+
+def _get_literal_prefix(pattern):
+    """
+    Returns the literal string, or bytes for a bytes pattern, that every match of
+    the compiled pattern starts with, or None if there is none or the pattern cannot be
+    parsed.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    literal = list()
+    try:
+        for op, av in _parse_pattern(pattern):
+            if str(op) != 'LITERAL':
+                break
+            literal.append(av)
+    except (AttributeError, TypeError, ValueError) as exc:
+        get_logger().debug('No literal prefix: %s', exc)
+        return None
+    if isinstance(pattern.pattern, bytes):
+        return bytes(literal) or None
+    return ''.join(map(chr, literal)) or None
+
+def _get_literal_regex(literals):
+    """
+    Returns a compiled pattern that matches any of the strings in literals, or None if one
+    of them is None. Literals that contain another literal are left out, since the shorter
+    one is found wherever the longer one is.
+    """
+    if not literals or None in literals:
+        return None
+    unique_literals = set(literals)
+    minimal_literals = sorted(
+        x for x in unique_literals if not any(y != x and y in x for y in unique_literals))
+    separator = b'|' if isinstance(minimal_literals[0], bytes) else '|'
+    return re.compile(separator.join(map(re.escape, minimal_literals)))
+
+def _substitute_sequential(regex_pairs, content, literals=None, literal_regex=None):
+    """
+    Returns a tuple of content with each pair of regex_pairs substituted in order,
+    and the number of substitutions. content is a string, or a bytes-like object for
+    bytes patterns.
+
+    literals is a sequence of the literal prefix of each pair from _get_literal_prefix(),
+    or None. A pair is skipped if its literal prefix is not in the content at that point,
+    since its pattern cannot match.
+    literal_regex is a compiled pattern from _get_literal_regex(), or None. Content without
+    a match of it is returned without trying any pair.
+    """
+    if literal_regex and not literal_regex.search(content):
+        return content, 0
+    total_subs = 0
+    for pair_index, regex_pair in enumerate(regex_pairs):
+        # find() instead of the in operator, which only finds single bytes in mmap objects
+        if literals and not literals[pair_index] is None and (
+                content.find(literals[pair_index]) < 0):
+            continue
+        content, sub_count = regex_pair.pattern.subn(regex_pair.replacement, content)
+        total_subs += sub_count
+    return content, total_subs
+
+class _CombinedPairs:
+    """
+    Regex pairs compiled into one alternation, so that content is scanned once.
+
+    Each alternative ends with an empty named group of its pair, and the replacement
+    of each match is dispatched by that group. The patterns are either all strings or all
+    bytes, and content is of the same type; bytes content can be any bytes-like object.
+
+    The results are identical to substituting each pair in order. The patterns cannot match
+    across lines, so matches are substituted one line at a time. A line is conservatively
+    substituted with the sequential pairs instead if it has matches of more than one pair,
+    if the pattern of an earlier pair matches inside of a match, or if the pattern of a
+    later pair matches the substituted line.
+    """
+    def __init__(self, regex_pairs):
+        """
+        regex_pairs is a sequence of pattern and replacement regex pair tuples.
+
+        Raises ValueError if the pairs cannot be combined.
+        """
+        self._regex_pairs = regex_pairs
+        self._literals = tuple(_get_literal_prefix(x.pattern) for x in regex_pairs)
+        self._is_bytes = isinstance(regex_pairs[0].pattern.pattern, bytes)
+        self._newline = b'\n' if self._is_bytes else '\n'
+        self._group_pairs = dict()
+        self._templates = list()
+        # Number of lines substituted with the sequential pairs
+        self.sequential_lines = 0
+        if len(set(x.pattern.flags for x in regex_pairs)) != 1:
+            raise ValueError('Patterns have different flags')
+        flags = regex_pairs[0].pattern.flags
+        alternatives = list()
+        group_index = 0
+        for pair_index, regex_pair in enumerate(regex_pairs):
+            pattern = regex_pair.pattern
+            if pattern.groupindex:
+                raise ValueError('Pattern has named groups: {}'.format(pattern.pattern))
+            parsed = _parse_pattern(pattern)
+            try:
+                if not parsed.getwidth()[0]:
+                    raise ValueError(
+                        'Pattern matches empty strings: {}'.format(pattern.pattern))
+                _check_line_local(parsed, flags)
+            except (AttributeError, IndexError, TypeError) as exc:
+                raise ValueError(
+                    'Unable to analyze pattern: {}: {}'.format(pattern.pattern, exc))
+            # Bytes patterns and replacements are ASCII (see _get_bytes_pairs())
+            pattern_string = pattern.pattern
+            replacement = regex_pair.replacement
+            if self._is_bytes:
+                pattern_string = pattern_string.decode('ascii')
+                replacement = replacement.decode('ascii')
+            template = _shift_replacement(replacement, group_index, pattern.groups)
+            self._templates.append(template.encode('ascii') if self._is_bytes else template)
+            # The named group is last so that the alternation can still be searched for by
+            # the first character of each pattern.
+            alternatives.append('(?:{}){}'.format(pattern_string, _PAIR_GROUP.format(pair_index)))
+            group_index += pattern.groups + 1
+            self._group_pairs[group_index] = pair_index
+        try:
+            self._regex = self._compile_alternation(alternatives, flags)
+            # Alternations of the patterns before and after each pair, to check for
+            # interactions between the pairs
+            self._earlier_regexes = [
+                self._compile_alternation(alternatives[:x], flags) if x else None
+                for x in range(len(alternatives))
+            ]
+            self._later_regexes = [
+                self._compile_alternation(alternatives[x + 1:], flags)
+                if x + 1 < len(alternatives) else None for x in range(len(alternatives))
+            ]
+        except re.error as exc:
+            raise ValueError('Unable to compile combined pattern: {}'.format(exc))
+
+    def _compile_alternation(self, alternatives, flags):
+        """Returns the alternation of the pattern strings alternatives compiled with flags"""
+        source = '|'.join(alternatives)
+        if self._is_bytes:
+            source = source.encode('ascii')
+        return re.compile(source, flags)
+
+    def _substitute_line(self, content, line_start, line_end, matches):
+        """
+        Returns a tuple of the line of content from line_start to line_end with
+        matches substituted, and the number of substitutions.
+
+        matches is a list of the re.Match objects of the combined pattern in the line.
+        """
+        pair_index = self._group_pairs[matches[0].lastindex]
+        if all(self._group_pairs[x.lastindex] == pair_index for x in matches):
+            earlier_regex = self._earlier_regexes[pair_index]
+            for match in matches:
+                if earlier_regex is None:
+                    continue
+                hidden_match = earlier_regex.search(content, match.start() + 1, line_end)
+                if hidden_match and hidden_match.start() < match.end():
+                    break
+            else:
+                template = self._templates[pair_index]
+                pieces = list()
+                position = line_start
+                for match in matches:
+                    pieces.append(content[position:match.start()])
+                    pieces.append(match.expand(template))
+                    position = match.end()
+                pieces.append(content[position:line_end])
+                line = content[:0].join(pieces)
+                later_regex = self._later_regexes[pair_index]
+                if later_regex is None or not later_regex.search(line):
+                    return line, len(matches)
+        self.sequential_lines += 1
+        return _substitute_sequential(
+            self._regex_pairs, content[line_start:line_end], self._literals)
+
+    def subn(self, content):
+        """
+        Returns a tuple of content with the pairs substituted, and the number of
+        substitutions.
+        """
+        # Tuples of the start and end of each line with matches, and a list of its matches
+        lines = list()
+        for match in self._regex.finditer(content):
+            if not lines or match.start() >= lines[-1][1]:
+                line_end = content.find(self._newline, match.end())
+                if line_end < 0:
+                    line_end = len(content)
+                lines.append(
+                    (content.rfind(self._newline, 0, match.start()) + 1, line_end, list()))
+            lines[-1][2].append(match)
+        if not lines:
+            return content, 0
+        pieces = list()
+        position = 0
+        total_subs = 0
+        for line_start, line_end, matches in lines:
+            line, sub_count = self._substitute_line(content, line_start, line_end, matches)
+            pieces.append(content[position:line_start])
+            pieces.append(line)
+            position = line_end
+            total_subs += sub_count
+        pieces.append(content[position:])
+        return content[:0].join(pieces), total_subs
+
+def _get_substituter(regex_pairs, combined=False):
+    """
+    Returns a _Substituter with a function that takes file content and returns a tuple of
+    the content with regex_pairs substituted and the number of substitutions.
+
+    The pairs are matched on the bytes of files if that gives the same results as on their
+    decoded text. The pairs are substituted in order, and content is first searched for the
+    literal prefixes of the patterns; each pair is only tried if its literal prefix is found.
+    If combined is True, the pairs are combined into one pattern instead if possible.
+    """
+    try:
+        regex_pairs = _get_bytes_pairs(regex_pairs)
+        takes_bytes = True
+    except ValueError as exc:
+        get_logger().debug('Substituting regex pairs in decoded text: %s', exc)
+        takes_bytes = False
+    if combined:
+        try:
+            return _Substituter(_CombinedPairs(regex_pairs).subn, takes_bytes)
+        except ValueError as exc:
+            get_logger().debug('Substituting regex pairs sequentially: %s', exc)
+    literals = tuple(_get_literal_prefix(x.pattern) for x in regex_pairs)
+    return _Substituter(
+        functools.partial(
+            _substitute_sequential, regex_pairs, literals=literals,
+            literal_regex=_get_literal_regex(literals)), takes_bytes)
+
+def _decode_content(file_bytes, path):
+    """
+    Returns a tuple of file_bytes of the file at path decoded as a string, and the encoding
+    from TREE_ENCODINGS used.
+
+    Raises BuildkitAbort if it cannot be decoded.
+    """
+    for encoding in TREE_ENCODINGS:
+        try:
+            return file_bytes.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    get_logger().error('Unable to decode with any encoding: %s', path)
+    raise BuildkitAbort()
+
+def _hash_content(content, hash_name):
+    """Returns the hexadecimal hash of the bytes-like object content"""
+    hasher = new_hasher(hash_name)
+    hasher.update(content)
+    return hasher.hexdigest()
+
+def _substitute_file(substituter, path, hash_name=None, journal_entry=None):
+    """
+    Substitutes domains in the file at path with the _Substituter substituter from
+    _get_substituter(). The file is memory-mapped, so it is only read into memory if it has
+    to be decoded or it has matches.
+
+    hash_name is the name of the hash algorithm of journal entries, or None to not journal
+    the file.
+    journal_entry is the _JournalEntry of the file from a previous run with the same regex
+    pairs, or None. The file is not substituted again if it has the same size and
+    modification time, or the same content, as after that run.
+
+    Returns a tuple of the number of substitutions, or None if the file was already
+    substituted, and the new _JournalEntry of the file, or None if hash_name is None.
+
+    Raises BuildkitAbort if the file has to be decoded but cannot be.
+    """
+    with path.open(mode="r+b") as file_obj:
+        stat_result = os.fstat(file_obj.fileno())
+        if journal_entry and (stat_result.st_size, stat_result.st_mtime_ns) == (
+                journal_entry.size, journal_entry.mtime_ns):
+            return None, journal_entry
+        if stat_result.st_size:
+            file_map = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files cannot be memory-mapped
+            file_map = b''
+        try:
+            original_hash = None
+            if hash_name:
+                original_hash = _hash_content(file_map, hash_name)
+                if journal_entry and original_hash == journal_entry.substituted_hash:
+                    return None, journal_entry._replace(
+                        size=stat_result.st_size, mtime_ns=stat_result.st_mtime_ns)
+            if substituter.takes_bytes:
+                content, file_subs = substituter.subn(file_map)
+            else:
+                content, encoding = _decode_content(file_map[:], path)
+                content, file_subs = substituter.subn(content)
+                if file_subs > 0:
+                    content = content.encode(encoding)
+        finally:
+            if stat_result.st_size:
+                file_map.close()
+        if file_subs > 0:
+            file_obj.seek(0)
+            file_obj.write(content)
+            file_obj.truncate()
+    if not hash_name:
+        return file_subs, None
+    substituted_hash = original_hash
+    if file_subs > 0:
+        substituted_hash = _hash_content(content, hash_name)
+        stat_result = path.stat()
+    return file_subs, _JournalEntry(
+        original_hash, substituted_hash, stat_result.st_size, stat_result.st_mtime_ns,
+        file_subs)
+
+def _init_worker(regex_pairs, hash_name, combined):
+    """
+    Initializes a worker process with regex_pairs, a tuple of pattern and replacement tuples,
+    hash_name, the name of the hash algorithm of journal entries or None, and combined,
+    the same as for _get_substituter()
+    """
+    global _worker_substituter, _worker_hash_name #pylint: disable=global-statement,invalid-name
+    _worker_substituter = _get_substituter(
+        tuple(_RegexPair(*x) for x in regex_pairs), combined=combined)
+    _worker_hash_name = hash_name
+
+def _substitute_file_in_worker(path, journal_entry):
+    """Substitutes domains in the file at path in a worker process"""
+    return _substitute_file(_worker_substituter, path, _worker_hash_name, journal_entry)
+
+def _substitute_files_in_workers(regex_pairs, file_iter, jobs, hash_name, journal, #pylint: disable=too-many-arguments
+                                 combined):
+    """
+    Substitutes domains in the files from file_iter in a pool of jobs processes, or one per
+    CPU core if jobs is 0.
+
+    hash_name, journal, and combined are the same as for substitute_domains_for_files()
+
+    Yields a tuple of the pathlib.Path, number of substitutions, and _JournalEntry of each
+    file from _substitute_file(), in the order of file_iter.
+    """
+    file_list = list(file_iter)
+    jobs = jobs or os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker,
+        initargs=(tuple((x.pattern, x.replacement) for x in regex_pairs), hash_name, combined))
+    with executor:
+        for path, (file_subs, journal_entry) in zip(file_list, executor.map(
+                _substitute_file_in_worker, file_list, [journal.get(x) for x in file_list],
+                chunksize=max(1, len(file_list) // (jobs * _CHUNKS_PER_WORKER)))):
+            yield path, file_subs, journal_entry
+
+def _get_regex_digest(regex_pairs):
+    """Returns the hexadecimal HASH_NAME digest of the patterns and replacements of regex_pairs"""
+    hasher = new_hasher()
+    for regex_pair in regex_pairs:
+        hasher.update(json.dumps([
+            regex_pair.pattern.pattern, regex_pair.pattern.flags, regex_pair.replacement
+        ]).encode(ENCODING))
+    return hasher.hexdigest()
+
+def _read_journal(tree_path, regex_digest):
+    """
+    Returns a dictionary of POSIX path strings relative to tree_path to the _JournalEntry of
+    files from the journal of the tree at tree_path. It is empty if the journal does not
+    exist, or if it is from different regex pairs or a different hash algorithm.
+    """
+    journal_path = get_journal_path(tree_path)
+    try:
+        with journal_path.open(encoding=ENCODING) as journal_file:
+            journal = json.load(journal_file)
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError) as exc:
+        get_logger().warning('Ignoring unreadable domain substitution journal %s: %s',
+                             journal_path, exc)
+        return dict()
+    if journal.get('version') != _JOURNAL_VERSION or journal.get('hash') != HASH_NAME:
+        get_logger().info('Ignoring domain substitution journal of another version')
+        return dict()
+    if journal.get('regex_digest') != regex_digest:
+        get_logger().info('Domain regex pairs changed since the last domain substitution')
+        return dict()
+    return {x: _JournalEntry(*y) for x, y in journal['files'].items()}
+
+def _write_journal(tree_path, regex_digest, entries):
+    """
+    Writes the journal of the tree at tree_path with the dictionary entries of POSIX path
+    strings relative to tree_path to the _JournalEntry of files.
+    """
+    journal_path = get_journal_path(tree_path)
+    temp_path = journal_path.with_name(journal_path.name + '.tmp')
+    with temp_path.open('w', encoding=ENCODING) as journal_file:
+        json.dump({
+            'version': _JOURNAL_VERSION,
+            'hash': HASH_NAME,
+            'regex_digest': regex_digest,
+            'files': entries,
+        }, journal_file, separators=(',', ':'))
+    temp_path.replace(journal_path)
+
+def get_journal_path(tree_path):
+    """Returns the pathlib.Path of the domain substitution journal of the tree at tree_path"""
+    return tree_path.with_name(tree_path.name + JOURNAL_SUFFIX)
+
+def remove_journal(tree_path):
+    """Removes the domain substitution journal of the tree at tree_path if it exists"""
+    try:
+        get_journal_path(tree_path).unlink()
+    except FileNotFoundError:
+        pass
+
+def substitute_domains_for_files(regex_iter, file_iter, log_warnings=True, jobs=1, journal=None, #pylint: disable=too-many-arguments
+                                 combined=False):
     """
     Runs domain substitution with regex_iter over files from file_iter
 
     regex_iter is an iterable of pattern and replacement regex pair tuples
     file_iter is an iterable of pathlib.Path to files that are to be domain substituted
     log_warnings indicates if a warning is logged when a file has no matches.
+    jobs is the number of processes to substitute files in, or 0 for one per CPU core.
+    The files are split into chunks between the processes, and the regex pairs are compiled
+    once per process. Warnings are logged in the order of file_iter.
+    journal is a dictionary of pathlib.Path of files to their entries from a previous run
+    with the same regex pairs, or None to not keep a journal. Files that are unchanged since
+    that run are not substituted again. The dictionary is updated with the entries of the
+    files from file_iter.
+    combined indicates if the pairs are combined into one pattern when possible, so each
+    file is scanned once. The combined pattern relies on the private regex parser of the re
+    module; the pairs are substituted in order if it is unavailable or fails.
+
+    Each pair is only tried on files that contain the literal prefix of its pattern. The
+    pairs are matched on the bytes of files instead of their decoded text when that gives
+    the same results. The results are identical to substituting each pair in order.
+
+    Returns the number of files that were already substituted according to journal.
+
+    Raises BuildkitAbort if a file has to be decoded but cannot be.
+    """
+    regex_pairs = tuple(regex_iter)
+    hash_name = None if journal is None else HASH_NAME
+    if journal is None:
+        journal = dict()
+    if jobs == 1:
+        substituter = _get_substituter(regex_pairs, combined=combined)
+        file_results = (
+            (x, ) + _substitute_file(substituter, x, hash_name, journal.get(x))
+            for x in file_iter)
+    else:
+        file_results = _substitute_files_in_workers(
+            regex_pairs, file_iter, jobs, hash_name, journal, combined)
+    already_substituted = 0
+    for path, file_subs, journal_entry in file_results:
+        if hash_name:
+            journal[path] = journal_entry
+        if file_subs is None:
+            already_substituted += 1
+            file_subs = journal_entry.subs
+            if file_subs:
+                get_logger().debug('File is already substituted: %s', path)
+                continue
+        if not file_subs and log_warnings:
+            get_logger().warning('File has no matches: %s', path)
+    return already_substituted
+
+def check_combined_substitution(regex_iter, file_iter):
     """
-    encoding = None # To satisfy pylint undefined-loop-variable warning
+    Checks that substituting the regex pairs combined into one pattern gives the same
+    results as substituting each pair in order on the decoded text of files. The combined
+    pattern matches the bytes of files if it does for substitution. Files are not modified.
+
+    regex_iter is an iterable of pattern and replacement regex pair tuples
+    file_iter is an iterable of pathlib.Path to files to check
+
+    Returns a list of pathlib.Path of files with different results.
+
+    Raises ValueError if the pairs cannot be combined.
+    Raises BuildkitAbort if a file cannot be decoded.
+    """
+    regex_pairs = tuple(regex_iter)
+    try:
+        combined_pairs = _CombinedPairs(_get_bytes_pairs(regex_pairs))
+        takes_bytes = True
+    except ValueError as exc:
+        get_logger().info('Checking substitution in decoded text: %s', exc)
+        combined_pairs = _CombinedPairs(regex_pairs)
+        takes_bytes = False
+    mismatched_files = list()
+    file_count = 0
+    files_with_matches = 0
     for path in file_iter:
-        with path.open(mode="r+b") as file_obj:
+        with path.open('rb') as file_obj:
             file_bytes = file_obj.read()
-            content = None
-            for encoding in TREE_ENCODINGS:
-                try:
-                    content = file_bytes.decode(encoding)
-                    break
-                except UnicodeDecodeError:
-                    continue
-            if not content:
-                get_logger().error('Unable to decode with any encoding: %s', path)
-                raise BuildkitAbort()
-            file_subs = 0
-            for regex_pair in regex_iter:
-                content, sub_count = regex_pair.pattern.subn(
-                    regex_pair.replacement, content)
-                file_subs += sub_count
-            if file_subs > 0:
-                file_obj.seek(0)
-                file_obj.write(content.encode(encoding))
-                file_obj.truncate()
-            elif log_warnings:
-                get_logger().warning('File has no matches: %s', path)
+        content, encoding = _decode_content(file_bytes, path)
+        expected_content, expected_subs = _substitute_sequential(regex_pairs, content)
+        if takes_bytes:
+            result = combined_pairs.subn(file_bytes)
+        else:
+            result_content, result_subs = combined_pairs.subn(content)
+            result = result_content.encode(encoding), result_subs
+        if result != (expected_content.encode(encoding), expected_subs):
+            get_logger().error('Combined substitution differs: %s', path)
+            mismatched_files.append(path)
+        file_count += 1
+        if expected_subs:
+            files_with_matches += 1
+    get_logger().info(
+        'Checked %s files (%s with matches); %s lines were substituted sequentially',
+        file_count, files_with_matches, combined_pairs.sequential_lines)
+    return mismatched_files
 
 def substitute_domains_in_patches(regex_iter, file_set, patch_iter, log_warnings=False):
     """
@@ -102,12 +785,18 @@ def process_bundle_patches(config_bundle, invert=False):
         set(config_bundle.domain_substitution),
         config_bundle.patches.patch_iter())
 
-def process_tree_with_bundle(config_bundle, buildspace_tree):
+def process_tree_with_bundle(config_bundle, buildspace_tree, jobs=1, combined=False):
     """
     Substitute domains in buildspace_tree with files and substitutions from config_bundle
 
     config_bundle is a config.ConfigBundle
     buildspace_tree is a pathlib.Path to the buildspace tree.
+    jobs is the number of processes to substitute files in, or 0 for one per CPU core.
+    combined is the same as for substitute_domains_for_files().
+
+    A journal of the content hashes of the files before and after substitution, and of the
+    regex pairs, is kept next to the buildspace tree. Files that are unchanged since they
+    were substituted with the same regex pairs are skipped.
 
     Raises NotADirectoryError if the patches directory is not a directory or does not exist
     Raises FileNotFoundError if the buildspace tree does not exist.
@@ -115,6 +804,42 @@ def process_tree_with_bundle(config_bundle, buildspace_tree):
     if not buildspace_tree.exists():
         raise FileNotFoundError(buildspace_tree)
     resolved_tree = buildspace_tree.resolve()
-    substitute_domains_for_files(
+    regex_pairs = config_bundle.domain_regex.get_pairs()
+    regex_digest = _get_regex_digest(regex_pairs)
+    file_list = [resolved_tree / x for x in config_bundle.domain_substitution]
+    relative_paths = dict(zip(file_list, config_bundle.domain_substitution))
+    old_entries = _read_journal(buildspace_tree, regex_digest)
+    journal = {
+        x: old_entries[y]
+        for x, y in relative_paths.items() if y in old_entries
+    }
+    try:
+        already_substituted = substitute_domains_for_files(
+            regex_pairs, file_list, jobs=jobs, journal=journal, combined=combined)
+    finally:
+        # Keep the entries of the files substituted before any error
+        _write_journal(
+            buildspace_tree, regex_digest, {relative_paths[x]: y for x, y in journal.items()})
+    if already_substituted:
+        get_logger().info('Skipped %s files that were already substituted', already_substituted)
+
+def check_tree_with_bundle(config_bundle, buildspace_tree):
+    """
+    Checks that combined domain substitution of the files from config_bundle in
+    buildspace_tree gives the same results as sequential substitution, without modifying
+    them.
+
+    config_bundle is a config.ConfigBundle
+    buildspace_tree is a pathlib.Path to the buildspace tree.
+
+    Returns a list of pathlib.Path of files with different results.
+
+    Raises FileNotFoundError if the buildspace tree does not exist.
+    Raises ValueError if the regex pairs cannot be combined.
+    """
+    if not buildspace_tree.exists():
+        raise FileNotFoundError(buildspace_tree)
+    resolved_tree = buildspace_tree.resolve()
+    return check_combined_substitution(
         config_bundle.domain_regex.get_pairs(),
         map(lambda x: resolved_tree / x, config_bundle.domain_substitution))
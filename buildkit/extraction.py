@@ -8,21 +8,515 @@
 Archive extraction utilities
 """
 
+import bz2
+import concurrent.futures
+import contextlib
+import gzip
+import lzma
 import os
+import re
 import shutil
+import signal
+import stat
 import subprocess
 import tarfile
+import tempfile
+import threading
 from pathlib import Path, PurePosixPath
 
 from .common import (
-    SEVENZIP_USE_REGISTRY, BuildkitAbort, PlatformEnum, ExtractorEnum, get_logger,
+    ENCODING, SEVENZIP_USE_REGISTRY, BuildkitAbort, PlatformEnum, ExtractorEnum, get_logger,
     get_running_platform)
+from .tree_manifest import new_hasher
 
 DEFAULT_EXTRACTORS = {
     ExtractorEnum.SEVENZIP: SEVENZIP_USE_REGISTRY,
     ExtractorEnum.TAR: 'tar',
 }
 
+# Compression formats of archive layers by the magic bytes at the start of the file
+_MAGIC_FORMATS = (
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+)
+# Compression formats of archive layers by file suffix, and if the layer contains a tar archive
+_SUFFIX_FORMATS = {
+    '.xz': ('xz', False),
+    '.txz': ('xz', True),
+    '.gz': ('gzip', False),
+    '.tgz': ('gzip', True),
+    '.bz2': ('bzip2', False),
+    '.tbz': ('bzip2', True),
+    '.tbz2': ('bzip2', True),
+    '.zst': ('zstd', False),
+    '.tzst': ('zstd', True),
+    '.7z': ('7z', False),
+}
+# Decompressor commands that read from stdin and write to stdout, by compression format
+_DECOMPRESS_CMDS = {
+    'gzip': ('gzip', '-d', '-c'),
+    'bzip2': ('bzip2', '-d', '-c'),
+    'zstd': ('zstd', '-d', '-c', '-q'),
+}
+# 7-zip archive types of the compression formats it can decompress from stdin
+_SEVENZIP_STDIN_TYPES = {
+    'xz': 'xz',
+    'gzip': 'gzip',
+    'bzip2': 'bzip2',
+}
+# Return code of commands killed by writing to a pipe that is no longer read
+_SIGPIPE_RETURNCODE = -signal.SIGPIPE if hasattr(signal, 'SIGPIPE') else None
+# The first version of xz that decompresses with multiple threads
+_XZ_MIN_THREADED_VERSION = (5, 4)
+# Python openers of compressed archives, by the magic bytes at the start of the file
+_PYTHON_DECOMPRESSORS = (
+    (b'\xfd7zXZ\x00', lzma.open),
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+)
+# Offset and value of the magic bytes of uncompressed tar archives
+_TAR_MAGIC_OFFSET = 257
+_TAR_MAGIC = b'ustar'
+# Size of reads when relaying uncompressed tar streams
+_STREAM_BUFFER_SIZE = 1024 * 1024 # 1 MiB
+# Number of threads writing files in the Python extractor
+_PYTHON_WRITER_THREADS = 8
+# Largest file that the Python extractor reads into memory to be written by another thread
+_MAX_BUFFERED_FILE_SIZE = 16 * 1024 * 1024 # 16 MiB
+# Maximum total size of file data waiting to be written by the Python extractor
+_MAX_BUFFERED_SIZE = 256 * 1024 * 1024 # 256 MiB
+# Delimiters to choose from for bsdtar substitution patterns, which cannot escape them
+_BSDTAR_DELIMITERS = ',|#:;'
+# Whether files can be removed relative to an open directory (not on Windows)
+_UNLINK_DIR_FD = os.unlink in os.supports_dir_fd and os.stat in os.supports_dir_fd
+
+class TarStreamReader:
+    """
+    Reads the members of an uncompressed tar stream in order with bounded memory.
+
+    ustar, GNU long name, and pax headers are supported. Member data that is not read
+    with read_data() is skipped when iterating to the next member.
+    """
+    def __init__(self, file_obj):
+        """file_obj is a readable binary file object of the uncompressed tar stream"""
+        self._file_obj = file_obj
+        self._data_remaining = 0
+        self._padding = 0
+        self._pax_globals = dict()
+        self._member_name = None
+        self._hasher = None
+        self._member_hashes = None
+
+    def _read_exact(self, size):
+        """
+        Returns the next size bytes of the stream.
+
+        Raises tarfile.ReadError if the stream ends early.
+        """
+        data = self._file_obj.read(size)
+        if len(data) == size:
+            return data
+        chunks = [data]
+        read_size = len(data)
+        while read_size < size:
+            chunk = self._file_obj.read(size - read_size)
+            if not chunk:
+                raise tarfile.ReadError('Unexpected end of tar stream')
+            chunks.append(chunk)
+            read_size += len(chunk)
+        return b''.join(chunks)
+
+    def _skip(self, size):
+        """Skips the next size bytes of the stream"""
+        while size > 0:
+            chunk_size = min(size, _STREAM_BUFFER_SIZE)
+            self._read_exact(chunk_size)
+            size -= chunk_size
+
+    def _read_header_data(self, size):
+        """Returns the data of an extended header of size bytes, and skips its padding"""
+        data = self._read_exact(size)
+        self._skip(-size % tarfile.BLOCKSIZE)
+        return data
+
+    @staticmethod
+    def _parse_pax_records(data):
+        """
+        Returns a dictionary of the records in the data of a pax header.
+
+        Raises tarfile.ReadError if the data is invalid.
+        """
+        records = dict()
+        position = 0
+        try:
+            while position < len(data):
+                space_index = data.index(b' ', position)
+                length = int(data[position:space_index])
+                if length <= 0:
+                    raise ValueError(length)
+                key, _, value = data[space_index + 1:position + length - 1].partition(b'=')
+                records[key.decode(ENCODING)] = value.decode(ENCODING, 'surrogateescape')
+                position += length
+        except ValueError:
+            raise tarfile.ReadError('Invalid pax header')
+        return records
+
+    def _finish_member(self):
+        """Skips the rest of the data of the current member and stores its hash"""
+        if self._hasher is None:
+            self._skip(self._data_remaining + self._padding)
+        else:
+            while self._data_remaining:
+                self.read_data(_STREAM_BUFFER_SIZE)
+            self._member_hashes[self._member_name] = self._hasher.hexdigest()
+            self._hasher = None
+            self._skip(self._padding)
+        self._data_remaining = 0
+        self._padding = 0
+
+    def read_data(self, size):
+        """Returns up to size bytes of the data of the current member"""
+        size = min(size, self._data_remaining)
+        data = self._read_exact(size)
+        self._data_remaining -= size
+        if not self._hasher is None:
+            self._hasher.update(data)
+        return data
+
+    def hash_data(self, member_hashes):
+        """
+        Hashes all of the data of the current regular file member for the tree manifest,
+        including data that is skipped. The hexadecimal hash is stored in the dictionary
+        member_hashes under the member's name when iterating to the next member.
+        """
+        self._hasher = new_hasher()
+        self._member_hashes = member_hashes
+
+    def __iter__(self):
+        """
+        Yields a tarfile.TarInfo for each member of the stream.
+
+        Raises tarfile.TarError if the stream is invalid or uses unsupported features.
+        """
+        long_name = None
+        long_link = None
+        pax_records = dict()
+        while True:
+            self._finish_member()
+            header = self._file_obj.read(tarfile.BLOCKSIZE)
+            if not header or header == tarfile.NUL * tarfile.BLOCKSIZE:
+                return # End of archive
+            if len(header) < tarfile.BLOCKSIZE:
+                header += self._read_exact(tarfile.BLOCKSIZE - len(header))
+            tarinfo = tarfile.TarInfo.frombuf(header, ENCODING, 'surrogateescape')
+            if tarinfo.type in (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK):
+                value = self._read_header_data(tarinfo.size).split(tarfile.NUL, 1)[0].decode(
+                    ENCODING, 'surrogateescape')
+                if tarinfo.type == tarfile.GNUTYPE_LONGNAME:
+                    long_name = value
+                else:
+                    long_link = value
+                continue
+            if tarinfo.type in (tarfile.XHDTYPE, tarfile.SOLARIS_XHDTYPE):
+                pax_records.update(self._parse_pax_records(self._read_header_data(tarinfo.size)))
+                continue
+            if tarinfo.type == tarfile.XGLTYPE:
+                self._pax_globals.update(
+                    self._parse_pax_records(self._read_header_data(tarinfo.size)))
+                continue
+            records = dict(self._pax_globals)
+            records.update(pax_records)
+            try:
+                if 'path' in records:
+                    tarinfo.name = records['path']
+                if 'linkpath' in records:
+                    tarinfo.linkname = records['linkpath']
+                if 'size' in records:
+                    tarinfo.size = int(records['size'])
+                if 'mtime' in records:
+                    tarinfo.mtime = float(records['mtime'])
+            except ValueError:
+                raise tarfile.ReadError('Invalid pax header for {}'.format(tarinfo.name))
+            if not long_name is None:
+                tarinfo.name = long_name
+            if not long_link is None:
+                tarinfo.linkname = long_link
+            if tarinfo.type == tarfile.GNUTYPE_SPARSE or 'GNU.sparse.map' in records or (
+                    'GNU.sparse.major' in records):
+                raise tarfile.ReadError('Sparse files are unsupported: {}'.format(tarinfo.name))
+            if tarinfo.isdir():
+                tarinfo.name = tarinfo.name.rstrip('/')
+            if tarinfo.name.startswith('./'):
+                tarinfo.name = tarinfo.name[2:]
+            long_name = None
+            long_link = None
+            pax_records = dict()
+            # Same as tarfile: only regular files and unknown types have data
+            if tarinfo.isreg() or tarinfo.type not in tarfile.SUPPORTED_TYPES:
+                self._data_remaining = tarinfo.size
+                self._padding = -tarinfo.size % tarfile.BLOCKSIZE
+            self._member_name = tarinfo.name
+            yield tarinfo
+
+def _open_new_file(path):
+    """Opens path for binary writing, replacing any existing file or symbolic link"""
+    try:
+        return open(path, 'xb')
+    except FileExistsError:
+        os.unlink(path)
+        return open(path, 'xb')
+
+def _write_member_file(path, data, tarinfo):
+    """Writes the bytes data of the tar member tarinfo into a new file at path"""
+    with _open_new_file(path) as file_obj:
+        file_obj.write(data)
+    os.chmod(path, tarinfo.mode & 0o7777)
+    os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+
+class _PythonTarWriter:
+    """
+    Writes tar members into a directory for the Python extractor.
+
+    Regular files are written by a pool of threads while the archive continues to be read,
+    and the total size of file data waiting to be written is bounded. Directories are
+    created once, and their modes and times are set together after all members are written.
+    Hardlinks are created last, once their targets exist.
+    """
+    def __init__(self, out_dir, symlink_supported):
+        """
+        out_dir is the path string of the directory to write members into.
+        symlink_supported is a boolean indicating if symbolic links can be created.
+        """
+        self._out_dir = out_dir
+        self._symlink_supported = symlink_supported
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=_PYTHON_WRITER_THREADS)
+        self._condition = threading.Condition()
+        self._buffered_size = 0
+        self._error = None
+        self._created_dirs = set((out_dir,))
+        self._directories = list()
+        self._hardlinks = list()
+
+    def get_path(self, member_path):
+        """Returns the path string in the output directory of the POSIX path member_path"""
+        if not member_path:
+            return self._out_dir
+        return os.path.join(self._out_dir, member_path)
+
+    def _make_dirs(self, path):
+        """Creates the directory path and its parents if they were not created already"""
+        if path in self._created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        while not path in self._created_dirs:
+            self._created_dirs.add(path)
+            path = os.path.dirname(path)
+
+    def _check_error(self):
+        """Raises BuildkitAbort if writing a file failed"""
+        if not self._error is None:
+            error_path, exc = self._error
+            get_logger().error('Unable to write %s: %s', error_path, exc)
+            raise BuildkitAbort()
+
+    def _write_done(self, path, size, future):
+        """Releases the buffered size of a written file, and records the first error"""
+        with self._condition:
+            self._buffered_size -= size
+            if self._error is None and not future.cancelled() and future.exception():
+                self._error = (path, future.exception())
+            self._condition.notify_all()
+
+    def add_directory(self, path, tarinfo):
+        """Creates the directory path for the tar member tarinfo"""
+        self._make_dirs(path)
+        if path != self._out_dir:
+            self._directories.append((path, tarinfo.mode & 0o7777, tarinfo.mtime))
+
+    def add_file(self, path, tarinfo, reader):
+        """
+        Writes the regular file path for tarinfo with the member data from the
+        TarStreamReader reader.
+        """
+        self._check_error()
+        self._make_dirs(os.path.dirname(path))
+        if tarinfo.size > _MAX_BUFFERED_FILE_SIZE:
+            with _open_new_file(path) as file_obj:
+                while True:
+                    data = reader.read_data(_STREAM_BUFFER_SIZE)
+                    if not data:
+                        break
+                    file_obj.write(data)
+            os.chmod(path, tarinfo.mode & 0o7777)
+            os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+            return
+        data = reader.read_data(tarinfo.size)
+        with self._condition:
+            while self._buffered_size and (
+                    self._buffered_size + len(data) > _MAX_BUFFERED_SIZE) and self._error is None:
+                self._condition.wait()
+            self._buffered_size += len(data)
+        future = self._executor.submit(_write_member_file, path, data, tarinfo)
+        future.add_done_callback(
+            lambda x, path=path, size=len(data): self._write_done(path, size, x))
+
+    def add_symlink(self, path, tarinfo):
+        """Creates the symbolic link path for tarinfo, if symbolic links are supported"""
+        if not self._symlink_supported:
+            # If symlinks are not supported, it's safe to assume that symlinks aren't needed.
+            # The only situation where this happens is on Windows.
+            return
+        self._make_dirs(os.path.dirname(path))
+        try:
+            os.symlink(tarinfo.linkname, path)
+        except FileExistsError:
+            os.unlink(path)
+            os.symlink(tarinfo.linkname, path)
+
+    def add_hardlink(self, path, target_path):
+        """Creates the hardlink path to target_path after all files are written"""
+        self._hardlinks.append((path, target_path))
+
+    def finish(self):
+        """
+        Waits for all files to be written, then creates hardlinks and sets the modes and
+        times of directories.
+
+        Raises BuildkitAbort if writing a file failed.
+        """
+        self._executor.shutdown(wait=True)
+        self._check_error()
+        for path, target_path in self._hardlinks:
+            self._make_dirs(os.path.dirname(path))
+            if os.path.lexists(path):
+                os.unlink(path)
+            try:
+                os.link(target_path, path)
+            except OSError:
+                # Hardlinks are not supported by the file system
+                shutil.copy2(target_path, path)
+        # Set directory attributes from the deepest directory up, as tarfile does
+        for path, mode, mtime in sorted(self._directories, reverse=True):
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+
+    def close(self):
+        """Stops writing files; pending files may not be written"""
+        with self._condition:
+            if self._error is None:
+                self._error = (self._out_dir, 'Extraction stopped')
+            self._condition.notify_all()
+        self._executor.shutdown(wait=True)
+
+class _TeeReader: #pylint: disable=too-few-public-methods
+    """Readable file object that writes all data read from source into sink"""
+    def __init__(self, source, sink):
+        self._source = source
+        self._sink = sink
+
+    def read(self, size=-1):
+        """Reads up to size bytes from the source and writes them to the sink"""
+        data = self._source.read(size)
+        if data:
+            self._sink.write(data)
+        return data
+
+class _Pipeline:
+    """
+    Chain of commands connected through OS pipes, where the stdout of each command is
+    the stdin of the next one. The stderr of every command is captured, and the return codes
+    of all commands are checked by wait().
+    """
+    def __init__(self, cmds, stdin, stdout=subprocess.PIPE):
+        """
+        cmds is a list of command tuples in the order of the chain.
+        stdin and stdout are the stdin of the first command and the stdout of the last command,
+        as accepted by subprocess.Popen.
+
+        Raises OSError if a command cannot be started.
+        """
+        self._procs = list()
+        self._stderr_outputs = list()
+        self._stderr_threads = list()
+        try:
+            for cmd_index, cmd in enumerate(cmds):
+                if cmd_index == len(cmds) - 1:
+                    cmd_stdout = stdout
+                else:
+                    cmd_stdout = subprocess.PIPE
+                proc = subprocess.Popen(cmd, stdin=stdin, stdout=cmd_stdout, stderr=subprocess.PIPE)
+                if self._procs:
+                    # Only the new command may read from the previous one
+                    self._procs[-1].stdout.close()
+                self._procs.append(proc)
+                stderr_output = list()
+                self._stderr_outputs.append(stderr_output)
+                stderr_thread = threading.Thread(
+                    target=lambda x=proc.stderr, y=stderr_output: y.append(x.read()))
+                stderr_thread.start()
+                self._stderr_threads.append(stderr_thread)
+                stdin = proc.stdout
+        except OSError:
+            self.kill()
+            raise
+
+    @property
+    def stdin(self):
+        """The stdin of the first command, if it is a pipe"""
+        return self._procs[0].stdin
+
+    @property
+    def stdout(self):
+        """The stdout of the last command, if it is a pipe"""
+        return self._procs[-1].stdout
+
+    def __str__(self):
+        return ' | '.join(' '.join(x.args) for x in self._procs)
+
+    def kill(self):
+        """Kills all commands and waits for them to exit"""
+        for proc in self._procs:
+            proc.kill()
+        for proc in self._procs:
+            proc.wait()
+        for stderr_thread in self._stderr_threads:
+            stderr_thread.join()
+
+    def wait(self, log_failures=True):
+        """
+        Waits for all commands to exit. The stderr of commands that failed is logged, at the
+        debug level if log_failures is False. Commands killed by writing to a pipe that the
+        next command stopped reading are not considered failed, since that is reported by
+        the reader.
+
+        Raises BuildkitAbort if any command failed.
+        """
+        for proc in self._procs:
+            proc.wait()
+        for stderr_thread in self._stderr_threads:
+            stderr_thread.join()
+        failed = False
+        for proc, stderr_output in zip(self._procs, self._stderr_outputs):
+            stderr_text = b''.join(stderr_output).decode(ENCODING, errors='replace').strip()
+            if proc.returncode == 0 or proc.returncode == _SIGPIPE_RETURNCODE:
+                if stderr_text:
+                    get_logger().debug('%s stderr: %s', proc.args[0], stderr_text)
+                continue
+            failed = True
+            if log_failures:
+                log_function = get_logger().error
+            else:
+                log_function = get_logger().debug
+            log_function('%s command returned %s', proc.args[0], proc.returncode)
+            if stderr_text:
+                log_function('%s stderr: %s', proc.args[0], stderr_text)
+        if failed:
+            raise BuildkitAbort()
+
 def _find_7z_by_registry():
     """
     Return a string to 7-zip's 7z.exe from the Windows Registry.
@@ -50,6 +544,383 @@ def _find_extractor_by_cmd(extractor_cmd):
         return extractor_cmd
     return shutil.which(extractor_cmd)
 
+def _get_xz_version(xz_bin):
+    """Returns the version of the xz binary as a tuple of integers; None if it is unknown"""
+    try:
+        result = subprocess.run(
+            (xz_bin, '--version'), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+    except OSError:
+        return None
+    match = re.search(r'xz \(XZ Utils\) (\d+)\.(\d+)', result.stdout)
+    if result.returncode != 0 or not match:
+        return None
+    return tuple(map(int, match.groups()))
+
+def _get_xz_cmd(threads):
+    """
+    Returns a command tuple that decompresses xz from stdin to stdout; None if xz and pixz
+    are not available.
+
+    threads is the number of threads to use, or 0 for one thread per CPU core.
+    xz 5.4 and newer is preferred for multiple threads, followed by pixz.
+    """
+    xz_bin = shutil.which('xz')
+    if threads != 1:
+        if xz_bin:
+            xz_version = _get_xz_version(xz_bin)
+            if xz_version and xz_version >= _XZ_MIN_THREADED_VERSION:
+                return (xz_bin, '-d', '-c', '-T{}'.format(threads))
+        pixz_bin = shutil.which('pixz')
+        if pixz_bin:
+            if threads:
+                return (pixz_bin, '-d', '-p', str(threads))
+            return (pixz_bin, '-d')
+        get_logger().debug('No parallel xz decompressor found. Using single-threaded xz.')
+    if xz_bin:
+        return (xz_bin, '-d', '-c')
+    return None
+
+def _get_magic_format(archive_path):
+    """
+    Returns the compression format of archive_path from its magic bytes, 'tar' for
+    an uncompressed tar archive, or None if the format is unknown.
+    """
+    with archive_path.open('rb') as archive_file:
+        header = archive_file.read(tarfile.BLOCKSIZE)
+    for magic, layer_format in _MAGIC_FORMATS:
+        if header.startswith(magic):
+            return layer_format
+    if header[_TAR_MAGIC_OFFSET:_TAR_MAGIC_OFFSET + len(_TAR_MAGIC)] == _TAR_MAGIC:
+        return 'tar'
+    return None
+
+def _get_archive_layers(archive_path, sevenzip_bin=None):
+    """
+    Returns a tuple of a list of the compression formats of archive_path from the outermost
+    layer inwards, and True if the innermost layer is known to be a tar archive.
+
+    The outermost format is detected from the magic bytes of the file, and the inner formats
+    from the file suffixes. The name of the file inside a 7z archive is listed with the
+    7-zip binary sevenzip_bin; 7z archives are only supported as the outermost layer.
+    """
+    layer_format = _get_magic_format(archive_path)
+    if layer_format == 'tar':
+        return list(), True
+    layers = list()
+    name = archive_path.name
+    while not layer_format is None:
+        layers.append(layer_format)
+        if layer_format == '7z':
+            if len(layers) > 1 or sevenzip_bin is None:
+                break
+            members = _list_with_7z(sevenzip_bin, archive_path)
+            if len(members) != 1:
+                break
+            name = members.pop()
+        else:
+            suffix = PurePosixPath(name).suffix.lower()
+            suffix_format, contains_tar = _SUFFIX_FORMATS.get(suffix, (None, False))
+            if suffix_format == layer_format:
+                if contains_tar:
+                    return layers, True
+                name = name[:-len(suffix)]
+        suffix = PurePosixPath(name).suffix.lower()
+        if suffix == '.tar':
+            return layers, True
+        layer_format = _SUFFIX_FORMATS.get(suffix, (None, False))[0]
+    return layers, False
+
+def _get_layer_cmd(layer_format, archive_path, threads, sevenzip_bin):
+    """
+    Returns a command tuple that decompresses a layer of layer_format from stdin to stdout;
+    None if no command is available. 7z archives are read directly from archive_path.
+    """
+    if layer_format == '7z':
+        if sevenzip_bin is None:
+            return None
+        return (sevenzip_bin, 'x', str(archive_path), '-so') + _get_7z_thread_args(threads)
+    if layer_format == 'xz':
+        cmd = _get_xz_cmd(threads)
+    elif layer_format in _DECOMPRESS_CMDS:
+        binary = shutil.which(_DECOMPRESS_CMDS[layer_format][0])
+        cmd = None
+        if binary:
+            cmd = (binary, ) + _DECOMPRESS_CMDS[layer_format][1:]
+    else:
+        cmd = None
+    if cmd is None and not sevenzip_bin is None and layer_format in _SEVENZIP_STDIN_TYPES:
+        cmd = (sevenzip_bin, 'x', '-si', '-so', '-t{}'.format(
+            _SEVENZIP_STDIN_TYPES[layer_format])) + _get_7z_thread_args(threads)
+    return cmd
+
+def _get_decompress_cmds(archive_path, threads=0, sevenzip_bin=None):
+    """
+    Returns a list of command tuples that, chained through pipes, decompress archive_path
+    from stdin into an uncompressed tar stream on stdout. The list is empty if the archive is
+    not compressed.
+    Returns None if the compression format is unknown, or a layer cannot be decompressed
+    by an available command.
+
+    threads is the number of threads to decompress with, or 0 for one per CPU core.
+    sevenzip_bin is the 7-zip binary to read 7z archives and decompress formats that have
+    no other command, or None.
+    """
+    layers, contains_tar = _get_archive_layers(archive_path, sevenzip_bin)
+    if not layers and not contains_tar:
+        return None
+    cmds = list()
+    for layer_format in layers:
+        cmd = _get_layer_cmd(layer_format, archive_path, threads, sevenzip_bin)
+        if cmd is None:
+            get_logger().debug('No command found to decompress %s', layer_format)
+            return None
+        cmds.append(cmd)
+    return cmds
+
+def _is_gnu_tar(binary):
+    """Returns True if binary is GNU tar; False otherwise (e.g. bsdtar)"""
+    try:
+        result = subprocess.run(
+            (binary, '--version'), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+    except OSError:
+        return False
+    return 'GNU tar' in result.stdout
+
+def _get_pruned_members(ignore_files, unpack_dir, relative_to):
+    """
+    Returns a dictionary of archive member names to the paths in ignore_files they would be
+    extracted to, for all paths in ignore_files inside of unpack_dir.
+    """
+    unpack_posix = PurePosixPath(Path(unpack_dir).as_posix())
+    pruned_members = dict()
+    for tree_path in ignore_files:
+        try:
+            member_path = PurePosixPath(tree_path).relative_to(unpack_posix)
+        except ValueError:
+            continue
+        if not relative_to is None:
+            member_path = PurePosixPath(Path(relative_to).as_posix()) / member_path
+        pruned_members[member_path.as_posix()] = tree_path
+    return pruned_members
+
+def _write_exclude_file(patterns):
+    """Writes patterns into a new temporary file, one per line, and returns its pathlib.Path"""
+    file_descriptor, exclude_path = tempfile.mkstemp(prefix='buildkit_exclude_', suffix='.txt')
+    with open(file_descriptor, 'w', encoding=ENCODING, newline='\n') as exclude_file:
+        for pattern in patterns:
+            exclude_file.write(pattern + '\n')
+    return Path(exclude_path)
+
+def _relay_tar_stream(source, sink, pruned_members, ignore_files, member_hashes=None):
+    """
+    Copies the uncompressed tar stream from the file object source into sink.
+    The paths in ignore_files of pruned members found in the stream are removed from it.
+    If member_hashes is not None, the hashes of the regular files that are not pruned are
+    added to it by member name.
+
+    Returns a tuple of a set of the top-level names of the members in the stream, and
+    a set of the names of pruned members that hardlinks point to.
+    """
+    member_roots = set()
+    hardlink_targets = set()
+    tee_reader = _TeeReader(source, sink)
+    reader = TarStreamReader(tee_reader)
+    for tarinfo in reader:
+        member_roots.add(tarinfo.name.split('/', 1)[0])
+        tree_path = pruned_members.get(tarinfo.name)
+        if not tree_path is None:
+            ignore_files.discard(tree_path)
+        elif tarinfo.islnk() and tarinfo.linkname in pruned_members:
+            hardlink_targets.add(tarinfo.linkname)
+        elif member_hashes is None:
+            continue
+        elif tarinfo.isreg():
+            reader.hash_data(member_hashes)
+        elif tarinfo.islnk() and tarinfo.linkname in member_hashes:
+            member_hashes[tarinfo.name] = member_hashes[tarinfo.linkname]
+    # Pass the end-of-archive blocks through
+    while tee_reader.read(_STREAM_BUFFER_SIZE):
+        pass
+    return member_roots, hardlink_targets
+
+def _extract_tar_stream(archive_path, decompress_cmds, extract_cmd, pruned_members, #pylint: disable=too-many-arguments
+                        ignore_files, member_hashes=None):
+    """
+    Pipes the uncompressed tar stream of archive_path into the extractor command extract_cmd,
+    which excludes the pruned members. The paths in ignore_files of pruned members found in
+    the archive are removed from it. If member_hashes is not None, the hashes of the
+    extracted regular files are added to it by member name.
+
+    decompress_cmds is a list of command tuples that decompress the archive from stdin to
+    stdout when chained, or None to decompress with Python.
+
+    Returns a tuple of a set of the top-level names of the members in the archive, and
+    a set of the names of pruned members that hardlinks point to. The extractor cannot
+    create these hardlinks since their targets are excluded, so its failure is ignored
+    when there are any; see _extract_excluding_pruned().
+
+    Raises BuildkitAbort if a command fails or the archive is invalid.
+    """
+    get_logger().debug('Extractor command line: %s', ' '.join(extract_cmd))
+    source, decompress_pipeline = _open_tar_stream(archive_path, decompress_cmds)
+    try:
+        extract_pipeline = _Pipeline([extract_cmd], stdin=subprocess.PIPE, stdout=None)
+    except OSError as exc:
+        source.close()
+        if not decompress_pipeline is None:
+            decompress_pipeline.kill()
+        get_logger().error('Unable to start extractor: %s', exc)
+        raise BuildkitAbort()
+    stream_error = None
+    member_roots = set()
+    hardlink_targets = set()
+    try:
+        member_roots, hardlink_targets = _relay_tar_stream(
+            source, extract_pipeline.stdin, pruned_members, ignore_files, member_hashes)
+    except BrokenPipeError:
+        pass # The extractor exited early; its return code is checked below
+    except (tarfile.TarError, EOFError, OSError) as exc:
+        stream_error = exc
+    finally:
+        source.close()
+        try:
+            extract_pipeline.stdin.close()
+        except BrokenPipeError:
+            pass
+    try:
+        extract_pipeline.wait(log_failures=not hardlink_targets)
+    except BuildkitAbort:
+        if not hardlink_targets:
+            _check_decompressor(decompress_pipeline)
+            raise
+    _check_decompressor(decompress_pipeline)
+    if not stream_error is None:
+        get_logger().error('Unable to read tar stream of %s: %s', archive_path, stream_error)
+        raise BuildkitAbort()
+    return member_roots, hardlink_targets
+
+def _extract_excluding_pruned(extract_pass, pruned_members):
+    """
+    Extracts an archive with the function extract_pass, excluding the pruned members that
+    no hardlinks point to.
+
+    extract_pass is called with a dictionary of the pruned members to exclude, in the form
+    of pruned_members. It returns a set of the names of the excluded members that hardlinks
+    point to. If there are any, the archive is extracted again without excluding them, so
+    they are extracted like the other members and must be removed afterwards with
+    _prune_hardlink_targets().
+
+    Returns a set of the names of the pruned members that were extracted.
+    """
+    extracted_members = set()
+    while True:
+        hardlink_targets = extract_pass({
+            x: y
+            for x, y in pruned_members.items() if not x in extracted_members
+        })
+        if not hardlink_targets:
+            return extracted_members
+        get_logger().info(
+            'Extracting again to keep hardlinks to %s pruned files', len(hardlink_targets))
+        extracted_members.update(hardlink_targets)
+
+def _prune_hardlink_targets(buildspace_tree, pruned_members, extracted_members, member_hashes):
+    """
+    Removes the pruned members extracted_members from the extracted files in
+    buildspace_tree after extraction, keeping the hardlinks that point to them.
+    Their hashes are removed from member_hashes, unless it is None.
+    """
+    if not extracted_members:
+        return
+    if not member_hashes is None:
+        for member_name in extracted_members:
+            member_hashes.pop(member_name, None)
+    prune_files(buildspace_tree, [pruned_members[x] for x in extracted_members])
+
+def _get_tar_transform_args(relative_to, is_gnu_tar):
+    """
+    Returns a list of tar arguments that strip relative_to from the member names during
+    extraction. The directory relative_to itself is extracted as the unpack directory.
+    Symbolic link targets are not changed.
+
+    Raises BuildkitAbort if relative_to contains every delimiter usable with bsdtar.
+    """
+    if relative_to is None:
+        return list()
+    prefix = Path(relative_to).as_posix()
+    if is_gnu_tar:
+        escaped_prefix = re.sub(r'([\\.\[\]*^$,])', r'\\\1', prefix)
+        return [
+            r'--transform=s,^{}$,.,S'.format(escaped_prefix),
+            r'--transform=s,^{}/,,S'.format(escaped_prefix),
+        ]
+    # bsdtar patterns have the form /old/new/flags without a leading 's', and the delimiter
+    # cannot be escaped. The S flag (do not apply to symbolic link targets) is supported
+    # since libarchive 3.0.
+    delimiter = next((x for x in _BSDTAR_DELIMITERS if not x in prefix), None)
+    if delimiter is None:
+        get_logger().error('Unable to strip relative_to with bsdtar: %s', relative_to)
+        raise BuildkitAbort()
+    escaped_prefix = re.sub(r'([\\.\[\]*^$])', r'\\\1', prefix)
+    return [
+        '-s', '{0}^{1}${0}.{0}S'.format(delimiter, escaped_prefix),
+        '-s', '{0}^{1}/{0}{0}S'.format(delimiter, escaped_prefix),
+    ]
+
+def get_python_opener(archive_path):
+    """
+    Returns a function that opens archive_path as an uncompressed binary stream, like the
+    built-in open(), which is returned for uncompressed tar archives; None if Python cannot
+    read the archive's compression format.
+    """
+    with archive_path.open('rb') as archive_file:
+        header = archive_file.read(tarfile.BLOCKSIZE)
+    for magic, opener in _PYTHON_DECOMPRESSORS:
+        if header.startswith(magic):
+            return opener
+    if header[_TAR_MAGIC_OFFSET:_TAR_MAGIC_OFFSET + len(_TAR_MAGIC)] == _TAR_MAGIC:
+        return open
+    return None
+
+def _open_tar_stream(archive_path, decompress_cmds):
+    """
+    Returns a tuple of a binary file object of the uncompressed tar stream of archive_path,
+    and the decompressor _Pipeline or None.
+
+    decompress_cmds is a list of command tuples that decompress the archive from stdin to
+    stdout when chained, or None to decompress with Python.
+
+    Raises BuildkitAbort if the archive cannot be decompressed.
+    """
+    if decompress_cmds is None:
+        opener = get_python_opener(archive_path)
+        if opener is None:
+            get_logger().error('Unsupported archive compression format: %s', archive_path)
+            raise BuildkitAbort()
+        return opener(str(archive_path), 'rb'), None
+    archive_file = archive_path.open('rb')
+    if not decompress_cmds:
+        return archive_file, None
+    with archive_file:
+        try:
+            decompress_pipeline = _Pipeline(decompress_cmds, stdin=archive_file)
+        except OSError as exc:
+            get_logger().error('Unable to start decompressor: %s', exc)
+            raise BuildkitAbort()
+    get_logger().debug('Decompressor command line: %s < %s', decompress_pipeline, archive_path)
+    return decompress_pipeline.stdout, decompress_pipeline
+
+def _check_decompressor(decompress_pipeline):
+    """
+    Waits for the decompressor _Pipeline decompress_pipeline to exit if it is not None.
+
+    Raises BuildkitAbort if it failed.
+    """
+    if not decompress_pipeline is None:
+        decompress_pipeline.wait()
+
 def _process_relative_to(unpack_root, relative_to):
     """
     For an extractor that doesn't support an automatic transform, move the extracted
@@ -68,70 +939,216 @@ def _process_relative_to(unpack_root, relative_to):
 def _prune_tree(unpack_root, ignore_files):
     """
     Run through the list of pruned files, delete them, and remove them from the set
+
+    unpack_root is the pathlib.Path that the paths in ignore_files are relative to.
     """
-    deleted_files = set()
-    for relative_file in ignore_files:
-        file_path = unpack_root / relative_file
-        if not file_path.is_file():
-            continue
-        file_path.unlink()
-        deleted_files.add(Path(relative_file).as_posix())
-    for deleted_path in deleted_files:
-        ignore_files.remove(deleted_path)
+    missing_files, _ = prune_files(unpack_root, ignore_files)
+    ignore_files.intersection_update(missing_files)
+
+def _prune_directory(dir_path, names):
+    """
+    Removes the files names in the directory path string dir_path. Names that do not exist
+    or are directories are not removed.
+
+    Returns a tuple of a list of the names that were not removed, and the total size of
+    the removed files in bytes.
+    """
+    if _UNLINK_DIR_FD:
+        try:
+            dir_fd = os.open(dir_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        except (FileNotFoundError, NotADirectoryError):
+            return list(names), 0
+        name_args = dict(dir_fd=dir_fd)
+    else:
+        if not os.path.isdir(dir_path):
+            return list(names), 0
+        dir_fd = None
+        name_args = dict()
+    missing_names = list()
+    pruned_size = 0
+    try:
+        for name in names:
+            if dir_fd is None:
+                path = os.path.join(dir_path, name)
+            else:
+                path = name
+            try:
+                stat_result = os.stat(path, follow_symlinks=False, **name_args)
+                if stat.S_ISDIR(stat_result.st_mode):
+                    missing_names.append(name)
+                    continue
+                os.unlink(path, **name_args)
+            except FileNotFoundError:
+                missing_names.append(name)
+                continue
+            pruned_size += stat_result.st_size
+    finally:
+        if not dir_fd is None:
+            os.close(dir_fd)
+    return missing_names, pruned_size
+
+def _list_with_7z(binary, archive_path):
+    """
+    Returns a set of POSIX path strings of the members in archive_path.
+
+    Raises BuildkitAbort if 7-zip fails.
+    """
+    cmd = (binary, 'l', '-slt', '-sccUTF-8', str(archive_path))
+    get_logger().debug('7z command line: %s', ' '.join(cmd))
+    result = subprocess.run(cmd, stdout=subprocess.PIPE)
+    if result.returncode != 0:
+        get_logger().error('7z command returned %s', result.returncode)
+        raise BuildkitAbort()
+    members = set()
+    # Member properties follow the separator line after the archive properties
+    in_members = False
+    for line in result.stdout.decode(ENCODING, errors='replace').splitlines():
+        if line.startswith('----------'):
+            in_members = True
+        elif in_members and line.startswith('Path = '):
+            members.add(line[len('Path = '):].replace('\\', '/'))
+    return members
+
+def _get_7z_thread_args(threads):
+    """Returns a tuple of 7-zip arguments to use the number of threads; 0 uses the default"""
+    if threads:
+        return ('-mmt{}'.format(threads),)
+    return tuple()
 
 def _extract_tar_with_7z(binary, archive_path, buildspace_tree, unpack_dir, ignore_files, #pylint: disable=too-many-arguments
-                         relative_to):
+                         relative_to, threads=0, file_hashes=None):
     get_logger().debug('Using 7-zip extractor')
     out_dir = buildspace_tree / unpack_dir
     if not relative_to is None and (out_dir / relative_to).exists():
         get_logger().error(
             'Temporary unpacking directory already exists: %s', out_dir / relative_to)
         raise BuildkitAbort()
-    cmd1 = (binary, 'x', str(archive_path), '-so')
-    cmd2 = (binary, 'x', '-si', '-aoa', '-ttar', '-o{}'.format(str(out_dir)))
-    get_logger().debug('7z command line: %s | %s',
-                       ' '.join(cmd1), ' '.join(cmd2))
-
-    proc1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE)
-    proc2 = subprocess.Popen(cmd2, stdin=proc1.stdout, stdout=subprocess.PIPE)
-    proc1.stdout.close()
-    (stdout_data, stderr_data) = proc2.communicate()
-    if proc2.returncode != 0:
-        get_logger().error('7z commands returned non-zero status: %s', proc2.returncode)
-        get_logger().debug('stdout: %s', stdout_data)
-        get_logger().debug('stderr: %s', stderr_data)
-        raise BuildkitAbort()
+    pruned_members = _get_pruned_members(ignore_files, unpack_dir, relative_to)
+    decompress_cmds = _get_decompress_cmds(archive_path, threads, sevenzip_bin=binary)
+    if decompress_cmds is None:
+        decompress_cmds = [(binary, 'x', str(archive_path), '-so') + _get_7z_thread_args(threads)]
+    member_hashes = None if file_hashes is None else dict()
+
+    def _extract_pass(excluded_members):
+        if not member_hashes is None:
+            member_hashes.clear()
+        exclude_path = _write_exclude_file(excluded_members)
+        try:
+            extract_cmd = (binary, 'x', '-si', '-aoa', '-ttar', '-o{}'.format(str(out_dir)),
+                           '-scsUTF-8', '-xr-@{}'.format(str(exclude_path)))
+            _, hardlink_targets = _extract_tar_stream(
+                archive_path, decompress_cmds, extract_cmd, excluded_members, ignore_files,
+                member_hashes)
+        finally:
+            exclude_path.unlink()
+        return hardlink_targets
+
+    extracted_members = _extract_excluding_pruned(_extract_pass, pruned_members)
 
     if not relative_to is None:
         _process_relative_to(out_dir, relative_to)
-
-    _prune_tree(out_dir, ignore_files)
+    _prune_hardlink_targets(buildspace_tree, pruned_members, extracted_members, member_hashes)
+    _add_file_hashes(file_hashes, member_hashes, unpack_dir, relative_to)
 
 def _extract_tar_with_tar(binary, archive_path, buildspace_tree, unpack_dir, #pylint: disable=too-many-arguments
-                          ignore_files, relative_to):
+                          ignore_files, relative_to, threads=0, file_hashes=None):
     get_logger().debug('Using BSD or GNU tar extractor')
     out_dir = buildspace_tree / unpack_dir
     out_dir.mkdir(exist_ok=True)
-    cmd = (binary, '-xf', str(archive_path), '-C', str(out_dir))
-    get_logger().debug('tar command line: %s', ' '.join(cmd))
-    result = subprocess.run(cmd)
-    if result.returncode != 0:
-        get_logger().error('tar command returned %s', result.returncode)
-        raise BuildkitAbort()
+    is_gnu_tar = _is_gnu_tar(binary)
+    # relative_to is stripped from member names during extraction
+    transform_args = _get_tar_transform_args(relative_to, is_gnu_tar)
+    decompress_cmds = _get_decompress_cmds(archive_path, threads)
+    if decompress_cmds is None and get_python_opener(archive_path) is None:
+        # The archive can only be read by tar, so prune after extraction
+        cmd = [binary, '-xf', str(archive_path), '-C', str(out_dir)] + transform_args
+        get_logger().debug('tar command line: %s', ' '.join(cmd))
+        result = subprocess.run(cmd)
+        if result.returncode != 0:
+            get_logger().error('tar command returned %s', result.returncode)
+            raise BuildkitAbort()
+        pruned_members = None
+    else:
+        # Pruned files are excluded from extraction. The tar stream is listed while it is
+        # piped into tar to determine which pruned files were in the archive.
+        pruned_members = _get_pruned_members(ignore_files, unpack_dir, relative_to)
+        cmd = [binary, '-xf', '-', '-C', str(out_dir)] + transform_args
+        if is_gnu_tar:
+            cmd.extend(('--anchored', '--no-wildcards'))
+        member_hashes = None if file_hashes is None else dict()
+        member_roots = set()
 
-    # for gnu tar, the --transform option could be used. but to keep compatibility with
-    # bsdtar on macos, we just do this ourselves
-    if not relative_to is None:
-        _process_relative_to(out_dir, relative_to)
+        def _extract_pass(excluded_members):
+            if not member_hashes is None:
+                member_hashes.clear()
+            if is_gnu_tar:
+                patterns = excluded_members
+            else:
+                # bsdtar patterns are unanchored wildcards unless they start with '^'
+                patterns = ('^' + re.sub(r'([\\*?[])', r'\\\1', x) for x in excluded_members)
+            exclude_path = _write_exclude_file(patterns)
+            try:
+                pass_roots, hardlink_targets = _extract_tar_stream(
+                    archive_path, decompress_cmds, cmd + ['-X', str(exclude_path)],
+                    excluded_members, ignore_files, member_hashes)
+            finally:
+                exclude_path.unlink()
+            member_roots.update(pass_roots)
+            return hardlink_targets
+
+        extracted_members = _extract_excluding_pruned(_extract_pass, pruned_members)
+        _prune_hardlink_targets(
+            buildspace_tree, pruned_members, extracted_members, member_hashes)
+        _add_file_hashes(file_hashes, member_hashes, unpack_dir, relative_to)
+        if not relative_to is None and Path(relative_to).parts[0] not in member_roots:
+            get_logger().error(
+                'Could not find relative_to directory in extracted files: %s', relative_to)
+            raise BuildkitAbort()
+
+    if pruned_members is None:
+        _prune_tree(buildspace_tree, ignore_files)
+
+def _get_member_path(member_name, prefix):
+    """
+    Returns the POSIX path string of member_name relative to the POSIX path string prefix,
+    or member_name if prefix is None. The prefix itself is returned as an empty string.
 
-    _prune_tree(out_dir, ignore_files)
+    Raises ValueError if member_name is outside of prefix or the unpack directory.
+    """
+    if not prefix is None:
+        if member_name == prefix:
+            return ''
+        if not member_name.startswith(prefix + '/'):
+            raise ValueError('{} is not in {}'.format(member_name, prefix))
+        member_name = member_name[len(prefix) + 1:]
+    if member_name.startswith('/') or '..' in member_name.split('/'):
+        raise ValueError('Unsafe path in archive: {}'.format(member_name))
+    return member_name
 
-def _extract_tar_with_python(archive_path, buildspace_tree, unpack_dir, ignore_files, relative_to):
+def _add_file_hashes(file_hashes, member_hashes, unpack_dir, relative_to):
+    """
+    Adds the hashes in member_hashes, a dictionary of archive member names to hashes, to
+    file_hashes by the POSIX path strings relative to the buildspace tree the members were
+    extracted to. Does nothing if file_hashes is None.
+    """
+    if file_hashes is None:
+        return
+    unpack_posix = PurePosixPath(Path(unpack_dir).as_posix())
+    if relative_to is None:
+        prefix = None
+    else:
+        prefix = Path(relative_to).as_posix()
+    for member_name, digest in member_hashes.items():
+        try:
+            member_path = _get_member_path(member_name, prefix)
+        except ValueError:
+            continue
+        if member_path:
+            file_hashes[(unpack_posix / member_path).as_posix()] = digest
+
+def _extract_tar_with_python(archive_path, buildspace_tree, unpack_dir, ignore_files, #pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+                             relative_to, threads=0, file_hashes=None):
     get_logger().debug('Using pure Python tar extractor')
-    class NoAppendList(list):
-        """Hack to workaround memory issues with large tar files"""
-        def append(self, obj):
-            pass
 
     # Simple hack to check if symlinks are supported
     try:
@@ -148,39 +1165,69 @@ def _extract_tar_with_python(archive_path, buildspace_tree, unpack_dir, ignore_f
         get_logger().exception('Unexpected exception during symlink support check.')
         raise BuildkitAbort()
 
-    with tarfile.open(str(archive_path)) as tar_file_obj:
-        tar_file_obj.members = NoAppendList()
-        for tarinfo in tar_file_obj:
-            try:
-                if relative_to is None:
-                    tree_relative_path = unpack_dir / PurePosixPath(tarinfo.name)
-                else:
-                    tree_relative_path = unpack_dir / PurePosixPath(tarinfo.name).relative_to(
-                        relative_to)
+    pruned_members = _get_pruned_members(ignore_files, unpack_dir, relative_to)
+    if relative_to is None:
+        prefix = None
+    else:
+        prefix = Path(relative_to).as_posix()
+    member_hashes = dict()
+
+    def _extract_pass(excluded_members):
+        member_hashes.clear()
+        hardlink_targets = set()
+        source, decompress_pipeline = _open_tar_stream(
+            archive_path, _get_decompress_cmds(archive_path, threads))
+        writer = _PythonTarWriter(str(buildspace_tree / unpack_dir), symlink_supported)
+        try:
+            reader = TarStreamReader(source)
+            for tarinfo in reader:
                 try:
-                    ignore_files.remove(tree_relative_path.as_posix())
-                except KeyError:
-                    destination = buildspace_tree / tree_relative_path
-                    if tarinfo.issym() and not symlink_supported:
-                        # In this situation, TarFile.makelink() will try to create a copy of the
-                        # target. But this fails because TarFile.members is empty
-                        # But if symlinks are not supported, it's safe to assume that symlinks
-                        # aren't needed. The only situation where this happens is on Windows.
+                    tree_path = excluded_members.get(tarinfo.name)
+                    if not tree_path is None:
+                        ignore_files.discard(tree_path)
                         continue
-                    if tarinfo.islnk():
-                        # Derived from TarFile.extract()
-                        new_target = buildspace_tree / unpack_dir / PurePosixPath(
-                            tarinfo.linkname).relative_to(relative_to)
-                        tarinfo._link_target = new_target.as_posix() # pylint: disable=protected-access
-                    if destination.is_symlink():
-                        destination.unlink()
-                    tar_file_obj._extract_member(tarinfo, str(destination)) # pylint: disable=protected-access
-            except BaseException:
-                get_logger().exception('Exception thrown for tar member: %s', tarinfo.name)
-                raise BuildkitAbort()
+                    path = writer.get_path(_get_member_path(tarinfo.name, prefix))
+                    if tarinfo.isreg():
+                        if not file_hashes is None:
+                            reader.hash_data(member_hashes)
+                        writer.add_file(path, tarinfo, reader)
+                    elif tarinfo.isdir():
+                        writer.add_directory(path, tarinfo)
+                    elif tarinfo.issym():
+                        writer.add_symlink(path, tarinfo)
+                    elif tarinfo.islnk():
+                        if tarinfo.linkname in excluded_members:
+                            hardlink_targets.add(tarinfo.linkname)
+                            continue
+                        writer.add_hardlink(
+                            path, writer.get_path(_get_member_path(tarinfo.linkname, prefix)))
+                        if tarinfo.linkname in member_hashes:
+                            member_hashes[tarinfo.name] = member_hashes[tarinfo.linkname]
+                    else:
+                        get_logger().warning(
+                            'Ignoring unsupported tar member: %s', tarinfo.name)
+                except BuildkitAbort:
+                    raise
+                except BaseException:
+                    get_logger().exception(
+                        'Exception thrown for tar member: %s', tarinfo.name)
+                    raise BuildkitAbort()
+            writer.finish()
+        except (tarfile.TarError, OSError) as exc:
+            get_logger().error('Unable to extract %s: %s', archive_path, exc)
+            raise BuildkitAbort()
+        finally:
+            writer.close()
+            source.close()
+        _check_decompressor(decompress_pipeline)
+        return hardlink_targets
+
+    extracted_members = _extract_excluding_pruned(_extract_pass, pruned_members)
+    _prune_hardlink_targets(buildspace_tree, pruned_members, extracted_members, member_hashes)
+    _add_file_hashes(file_hashes, member_hashes, unpack_dir, relative_to)
 
 def extract_tar_file(archive_path, buildspace_tree, unpack_dir, ignore_files, relative_to, #pylint: disable=too-many-arguments
-                     extractors=None):
+                     extractors=None, threads=0, file_hashes=None):
     """
     Extract regular or compressed tar archive into the buildspace tree.
 
@@ -195,6 +1242,13 @@ def extract_tar_file(archive_path, buildspace_tree, unpack_dir, ignore_files, re
     root of the archive.
     extractors is a dictionary of PlatformEnum to a command or path to the
     extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip.
+    threads is the number of threads to decompress with, or 0 for one per CPU core.
+    Compressed archives are piped through decompressor commands when they are available;
+    xz is decompressed in parallel by xz 5.4+ or pixz unless threads is 1.
+    file_hashes is a dictionary to add the tree manifest hashes of extracted regular files
+    to, by POSIX path strings relative to buildspace_tree, or None. The hashes are computed
+    from the tar stream as it is extracted; extractors that read the archive directly do
+    not add any.
 
     Raises BuildkitAbort if unexpected issues arise during unpacking.
     """
@@ -211,7 +1265,8 @@ def extract_tar_file(archive_path, buildspace_tree, unpack_dir, ignore_files, re
         if not sevenzip_bin is None:
             _extract_tar_with_7z(
                 binary=sevenzip_bin, archive_path=archive_path, buildspace_tree=resolved_tree,
-                unpack_dir=unpack_dir, ignore_files=ignore_files, relative_to=relative_to)
+                unpack_dir=unpack_dir, ignore_files=ignore_files, relative_to=relative_to,
+                threads=threads, file_hashes=file_hashes)
             return
     elif current_platform == PlatformEnum.UNIX:
         # NOTE: 7-zip isn't an option because it doesn't preserve file permissions
@@ -219,7 +1274,8 @@ def extract_tar_file(archive_path, buildspace_tree, unpack_dir, ignore_files, re
         if not tar_bin is None:
             _extract_tar_with_tar(
                 binary=tar_bin, archive_path=archive_path, buildspace_tree=resolved_tree,
-                unpack_dir=unpack_dir, ignore_files=ignore_files, relative_to=relative_to)
+                unpack_dir=unpack_dir, ignore_files=ignore_files, relative_to=relative_to,
+                threads=threads, file_hashes=file_hashes)
             return
     else:
         # This is not a normal code path, so make it clear.
@@ -227,13 +1283,15 @@ def extract_tar_file(archive_path, buildspace_tree, unpack_dir, ignore_files, re
     # Fallback to Python-based extractor on all platforms
     _extract_tar_with_python(
         archive_path=archive_path, buildspace_tree=resolved_tree, unpack_dir=unpack_dir,
-        ignore_files=ignore_files, relative_to=relative_to)
+        ignore_files=ignore_files, relative_to=relative_to, threads=threads,
+        file_hashes=file_hashes)
 
 def extract_with_7z(archive_path, buildspace_tree, unpack_dir, ignore_files, relative_to, #pylint: disable=too-many-arguments
-                    extractors=None):
+                    extractors=None, threads=0, file_hashes=None):
     """
     Extract archives with 7-zip into the buildspace tree.
-    Only supports archives with one layer of unpacking, so compressed tar archives don't work.
+    Archives that contain a tar archive, such as a 7z archive of a compressed tarball, are
+    decompressed and unpacked in one pass through pipes.
 
     archive_path is the pathlib.Path to the archive to unpack
     buildspace_tree is a pathlib.Path to the buildspace tree.
@@ -246,11 +1304,13 @@ def extract_with_7z(archive_path, buildspace_tree, unpack_dir, ignore_files, rel
     root of the archive.
     extractors is a dictionary of PlatformEnum to a command or path to the
     extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip.
+    threads is the number of threads 7-zip decompresses with, or 0 for its default.
+    file_hashes is a dictionary to add the tree manifest hashes of extracted regular files
+    to, by POSIX path strings relative to buildspace_tree, or None. Hashes are only added
+    for archives that contain a tar archive.
 
     Raises BuildkitAbort if unexpected issues arise during unpacking.
     """
-    # TODO: It would be nice to extend this to support arbitrary standard IO chaining of 7z
-    # instances, so _extract_tar_with_7z and other future formats could use this.
     if extractors is None:
         extractors = DEFAULT_EXTRACTORS
     sevenzip_cmd = extractors.get(ExtractorEnum.SEVENZIP)
@@ -261,21 +1321,86 @@ def extract_with_7z(archive_path, buildspace_tree, unpack_dir, ignore_files, rel
         sevenzip_cmd = str(_find_7z_by_registry())
     sevenzip_bin = _find_extractor_by_cmd(sevenzip_cmd)
     resolved_tree = buildspace_tree.resolve()
+    layers, contains_tar = _get_archive_layers(archive_path, sevenzip_bin)
+    if layers and contains_tar:
+        _extract_tar_with_7z(
+            binary=sevenzip_bin, archive_path=archive_path, buildspace_tree=resolved_tree,
+            unpack_dir=unpack_dir, ignore_files=ignore_files, relative_to=relative_to,
+            threads=threads, file_hashes=file_hashes)
+        return
 
     out_dir = resolved_tree / unpack_dir
     if not relative_to is None and (out_dir / relative_to).exists():
         get_logger().error(
             'Temporary unpacking directory already exists: %s', out_dir / relative_to)
         raise BuildkitAbort()
-    cmd = (sevenzip_bin, 'x', str(archive_path), '-aoa', '-o{}'.format(str(out_dir)))
-    get_logger().debug('7z command line: %s', ' '.join(cmd))
+    pruned_members = _get_pruned_members(ignore_files, unpack_dir, relative_to)
+    archive_members = _list_with_7z(sevenzip_bin, archive_path)
+    exclude_path = _write_exclude_file(pruned_members)
+    try:
+        cmd = (sevenzip_bin, 'x', str(archive_path), '-aoa', '-o{}'.format(str(out_dir)),
+               '-scsUTF-8', '-xr-@{}'.format(str(exclude_path))) + _get_7z_thread_args(threads)
+        get_logger().debug('7z command line: %s', ' '.join(cmd))
 
-    result = subprocess.run(cmd)
-    if result.returncode != 0:
-        get_logger().error('7z command returned %s', result.returncode)
-        raise BuildkitAbort()
+        result = subprocess.run(cmd)
+        if result.returncode != 0:
+            get_logger().error('7z command returned %s', result.returncode)
+            raise BuildkitAbort()
+    finally:
+        exclude_path.unlink()
+    for member_name in archive_members.intersection(pruned_members):
+        ignore_files.discard(pruned_members[member_name])
 
     if not relative_to is None:
         _process_relative_to(out_dir, relative_to)
 
-    _prune_tree(out_dir, ignore_files)
+@contextlib.contextmanager
+def open_tar_stream(archive_path, threads=0):
+    """
+    Context manager that opens the uncompressed tar stream of archive_path as a readable
+    binary file object, for reading with TarStreamReader. Compressed archives are piped
+    through decompressor commands when they are available, and decompressed with Python
+    otherwise. The stream is closed on exit; the decompressor is then waited for unless
+    an exception was raised.
+
+    threads is the number of threads to decompress with, or 0 for one per CPU core.
+
+    Raises BuildkitAbort if the archive cannot be decompressed, or the decompressor failed.
+    """
+    source, decompress_pipeline = _open_tar_stream(
+        archive_path, _get_decompress_cmds(archive_path, threads))
+    try:
+        yield source
+    finally:
+        source.close()
+    _check_decompressor(decompress_pipeline)
+
+def prune_files(unpack_root, file_list, threads=0):
+    """
+    Removes the files in file_list from the directory unpack_root.
+
+    unpack_root is the pathlib.Path that the paths in file_list are relative to.
+    file_list is an iterable of POSIX path strings of files.
+    threads is the number of threads to remove files with, or 0 for one per CPU core.
+    Files are grouped by their directories, and each directory is processed by one thread.
+
+    Returns a tuple of a set of the paths in file_list that were not found (or are
+    directories), and the total size of the removed files in bytes.
+    """
+    # Directory path strings to dictionaries of file names to their paths in file_list
+    directories = dict()
+    for relative_file in file_list:
+        parent, name = os.path.split(os.path.join(str(unpack_root), relative_file))
+        directories.setdefault(parent, dict())[name] = relative_file
+    missing_files = set()
+    pruned_size = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads or None) as executor:
+        futures = {
+            executor.submit(_prune_directory, dir_path, tuple(names)): names
+            for dir_path, names in directories.items()
+        }
+        for future, names in futures.items():
+            missing_names, dir_size = future.result()
+            missing_files.update(names[x] for x in missing_names)
+            pruned_size += dir_size
+    return missing_files, pruned_size
@@ -6,15 +6,16 @@
 
 """Common code for build files generators"""
 
+import configparser
 import hashlib
 import re
 import string
 import subprocess
-import urllib.request
 
 from pathlib import Path
 
 from ..common import ENCODING, BuildkitAbort, get_logger
+from ..source_retrieval import Downloader, DownloadReportHook
 
 # Constants
 
@@ -23,6 +24,8 @@ PROCESS_BUILD_OUTPUTS = 'process_build_outputs.py'
 APPLY_PATCH_SERIES = 'apply_patch_series.py'
 DEFAULT_BUILD_OUTPUT = Path('out/Default')
 
+_REMOTE_HASH_CHUNK_SIZE = 1024 * 1024 # 1 MiB
+
 # Classes
 
 class BuildFileStringTemplate(string.Template):
@@ -73,7 +76,73 @@ def get_current_commit():
         raise BuildkitAbort()
     return result.stdout.strip('\n')
 
-def get_remote_file_hash(url, hash_type='sha256'):
-    """Downloads and returns a hash of a file at the given url"""
-    with urllib.request.urlopen(url) as file_obj:
-        return hashlib.new(hash_type, file_obj.read()).hexdigest()
+def _read_remote_hash_cache(cache_path):
+    """Returns a ConfigParser of the remote hash cache at cache_path"""
+    cache = configparser.ConfigParser(interpolation=None)
+    if cache_path is not None:
+        try:
+            cache.read(str(cache_path), encoding=ENCODING)
+        except configparser.Error as exc:
+            get_logger().warning('Ignoring invalid remote hash cache %s: %s', cache_path, exc)
+            cache = configparser.ConfigParser(interpolation=None)
+    return cache
+
+def _write_remote_hash_cache(cache_path, cache):
+    """Atomically writes the ConfigParser cache to cache_path"""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with temp_path.open('w', encoding=ENCODING) as cache_file:
+        cache.write(cache_file)
+    temp_path.replace(cache_path)
+
+def get_remote_file_hash(url, hash_type='sha256', downloader=None, cache_path=None, #pylint: disable=too-many-arguments
+                         show_progress=False):
+    """
+    Downloads and returns a hash of a file at the given url
+
+    The file is hashed as it is downloaded, so it is never held in memory as a whole.
+
+    downloader is the source_retrieval.Downloader to download with, or None to use a new one.
+    cache_path is a pathlib.Path to an INI file of previously computed hashes, or None to
+    not use one. Hashes are cached with the ETag of the file, and the cached hash is reused
+    if the server reports that the file is unchanged.
+    show_progress is a boolean indicating if download progress is printed to the console.
+    """
+    if downloader is None:
+        with Downloader() as new_downloader:
+            return get_remote_file_hash(
+                url, hash_type=hash_type, downloader=new_downloader, cache_path=cache_path,
+                show_progress=show_progress)
+    cache = _read_remote_hash_cache(cache_path)
+    headers = dict()
+    if cache.has_option(url, 'etag') and cache.has_option(url, hash_type):
+        headers['If-None-Match'] = cache.get(url, 'etag')
+    with downloader.open(url, headers=headers) as file_obj:
+        if file_obj.status == 304:
+            get_logger().info('Using cached hash of unchanged file: %s', url)
+            return cache.get(url, hash_type)
+        hasher = hashlib.new(hash_type)
+        total_size = int(file_obj.headers.get('Content-Length', -1))
+        downloaded_size = 0
+        reporthook = DownloadReportHook() if show_progress else None
+        while True:
+            chunk = file_obj.read(_REMOTE_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            downloaded_size += len(chunk)
+            if reporthook:
+                reporthook(downloaded_size, total_size)
+        if reporthook:
+            print()
+        etag = file_obj.headers.get('ETag')
+    file_hash = hasher.hexdigest()
+    if cache_path is not None and etag:
+        if cache.has_option(url, 'etag') and cache.get(url, 'etag') != etag:
+            cache.remove_section(url) # Hashes of other types are outdated
+        if not cache.has_section(url):
+            cache.add_section(url)
+        cache.set(url, 'etag', etag)
+        cache.set(url, hash_type, file_hash)
+        _write_remote_hash_cache(cache_path, cache)
+    return file_hash
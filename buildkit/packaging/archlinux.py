@@ -29,8 +29,9 @@ def _generate_gn_flags(flags_items_iter):
 
 # Public definitions
 
-def generate_packaging(config_bundle, output_dir, repo_version='bundle',
-                       repo_hash='SKIP', build_output=DEFAULT_BUILD_OUTPUT):
+def generate_packaging(config_bundle, output_dir, repo_version='bundle', #pylint: disable=too-many-arguments
+                       repo_hash='SKIP', build_output=DEFAULT_BUILD_OUTPUT,
+                       repo_hash_cache=None):
     """
     Generates an Arch Linux PKGBUILD into output_dir
 
@@ -43,9 +44,11 @@ def generate_packaging(config_bundle, output_dir, repo_version='bundle',
     git repository).
     repo_hash is a string specifying the SHA-256 to verify the archive of
     the ungoogled-chromium repository to download within the PKGBUILD. If it is
-    'compute', the archive is downloaded to memory and a hash is computed. If it
+    'compute', the archive is downloaded and a hash is computed. If it
     is 'SKIP', hash computation is skipped in the PKGBUILD.
     build_output is a pathlib.Path for building intermediates and outputs to be stored
+    repo_hash_cache is a pathlib.Path to a file caching computed hashes by URL and ETag,
+    or None to always download the archive when repo_hash is 'compute'.
 
     Raises FileExistsError if a file named PKGBUILD already exists in output_dir
     Raises FileNotFoundError if output_dir is not an existing directory.
@@ -56,8 +59,9 @@ def generate_packaging(config_bundle, output_dir, repo_version='bundle',
         repo_version = get_current_commit()
     repo_url = _REPO_URL_TEMPLATE.format(repo_version)
     if repo_hash == 'compute':
-        get_logger().debug('Downloading archive into memory for hash computation...')
-        repo_hash = get_remote_file_hash(repo_url)
+        get_logger().info('Downloading archive for hash computation...')
+        repo_hash = get_remote_file_hash(
+            repo_url, cache_path=repo_hash_cache, show_progress=True)
         get_logger().debug('Computed hash: %s', repo_hash)
     elif repo_hash == 'SKIP':
         pass # Allow skipping of hash verification
@@ -0,0 +1,369 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Cache of pristine buildspace trees
+
+A snapshot is the pruned tree extracted from the Chromium source code and extra dependencies
+of a config bundle. Snapshots are keyed by the Chromium version and digests of the pruning
+list and extra dependencies, so later getsrc runs with the same inputs can materialize the
+buildspace tree from a snapshot instead of downloading and extracting the archives again.
+"""
+
+import collections
+import concurrent.futures
+import configparser
+import hashlib
+import json
+import os
+import shutil
+import stat
+from pathlib import Path
+
+from .common import ENCODING, get_logger, reflink_file
+from .tree_manifest import get_manifest_path
+
+# Constants
+
+class SnapshotMethod: #pylint: disable=too-few-public-methods
+    """Methods to materialize a buildspace tree from a snapshot"""
+    AUTO = 'auto'
+    REFLINK = 'reflink'
+    HARDLINK = 'hardlink'
+    COPY = 'copy'
+
+SNAPSHOT_METHODS = (
+    SnapshotMethod.AUTO, SnapshotMethod.REFLINK, SnapshotMethod.HARDLINK, SnapshotMethod.COPY)
+
+# Name of the file of snapshot properties in each snapshot directory
+_SNAPSHOT_INFO = 'snapshot.ini'
+# Name of the tree directory in each snapshot directory
+_SNAPSHOT_TREE = 'tree'
+# Infix of snapshot directories that are being created or removed
+_TEMP_INFIX = '.tmp'
+# Number of threads placing files while materializing a tree
+_PLACE_THREADS = 8
+
+# Public classes
+
+Snapshot = collections.namedtuple(
+    'Snapshot', ('name', 'path', 'chromium_version', 'size', 'last_used', 'unpruned_files'))
+Snapshot.__doc__ = """
+A snapshot in the snapshot cache.
+
+path is the pathlib.Path of the snapshot directory.
+size is the total size of the files in the snapshot in bytes.
+last_used is the time the snapshot was last created or materialized, in seconds since
+the epoch.
+unpruned_files is a tuple of the files in the pruning list that were not found during
+extraction.
+"""
+
+class SnapshotCache:
+    """
+    A directory of snapshots of pristine buildspace trees.
+
+    Each snapshot is a directory containing the tree and a file of its properties.
+    Snapshots are created in a temporary directory and renamed into place once complete.
+    When the total size of the snapshots exceeds the limit, the least recently used snapshots
+    are removed.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        """
+        cache_dir is the pathlib.Path to the cache directory. It is created if necessary.
+        max_size is the maximum total size of the snapshots in bytes, or None for no limit.
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+    def _read_snapshot(self, snapshot_path):
+        """Returns the Snapshot in snapshot_path; None if it is incomplete or invalid"""
+        info_path = snapshot_path / _SNAPSHOT_INFO
+        info = configparser.ConfigParser(interpolation=None)
+        try:
+            with info_path.open(encoding=ENCODING) as info_file:
+                info.read_file(info_file, source=str(info_path))
+            last_used = info_path.stat().st_mtime
+            section = info['snapshot']
+            return Snapshot(
+                snapshot_path.name, snapshot_path, section['chromium_version'],
+                int(section['size']), last_used,
+                tuple(filter(len, section.get('unpruned_files', '').splitlines())))
+        except (OSError, configparser.Error, KeyError, ValueError):
+            return None
+
+    def list(self):
+        """Returns a list of the complete Snapshots in the cache, most recently used first"""
+        if not self._cache_dir.is_dir():
+            return list()
+        snapshots = list()
+        for snapshot_path in self._cache_dir.iterdir():
+            if _TEMP_INFIX in snapshot_path.name:
+                continue # Being created or removed
+            snapshot = self._read_snapshot(snapshot_path)
+            if not snapshot is None:
+                snapshots.append(snapshot)
+        snapshots.sort(key=lambda x: x.last_used, reverse=True)
+        return snapshots
+
+    def get(self, name):
+        """Returns the Snapshot of name; None if it is not in the cache"""
+        if _TEMP_INFIX in name:
+            return None
+        return self._read_snapshot(self._cache_dir / name)
+
+    def begin(self, name):
+        """
+        Starts creating the snapshot name.
+
+        Returns the pathlib.Path of a new temporary snapshot directory. Its tree directory
+        is to be filled and then passed to commit() or discard().
+        """
+        temp_path = self._cache_dir / '{}{}-{}'.format(name, _TEMP_INFIX, os.getpid())
+        if temp_path.exists():
+            _remove_tree(temp_path)
+        (temp_path / _SNAPSHOT_TREE).mkdir(parents=True)
+        return temp_path
+
+    @staticmethod
+    def get_tree(snapshot_path):
+        """Returns the pathlib.Path of the tree in the snapshot directory snapshot_path"""
+        return snapshot_path / _SNAPSHOT_TREE
+
+    def commit(self, temp_path, name, chromium_version, unpruned_files):
+        """
+        Adds the temporary snapshot directory temp_path to the cache as the snapshot name.
+        If the snapshot was added by another buildkit instance in the meantime, temp_path is
+        discarded instead. Least recently used snapshots are evicted if necessary.
+
+        unpruned_files is an iterable of files in the pruning list that were not found.
+
+        Returns the Snapshot of name.
+        """
+        info = configparser.ConfigParser(interpolation=None)
+        info['snapshot'] = {
+            'chromium_version': chromium_version,
+            'size': str(_get_tree_size(temp_path / _SNAPSHOT_TREE)),
+            'unpruned_files': '\n'.join(sorted(unpruned_files)),
+        }
+        with (temp_path / _SNAPSHOT_INFO).open('w', encoding=ENCODING) as info_file:
+            info.write(info_file)
+        snapshot_path = self._cache_dir / name
+        try:
+            temp_path.rename(snapshot_path)
+            get_logger().info('Stored snapshot %s', name)
+        except OSError:
+            if not snapshot_path.is_dir():
+                raise
+            get_logger().debug('Snapshot %s was stored by another instance', name)
+            self.discard(temp_path)
+        snapshot = self._read_snapshot(snapshot_path)
+        self._evict(keep_name=name)
+        return snapshot
+
+    @staticmethod
+    def discard(temp_path):
+        """Removes the temporary snapshot directory temp_path"""
+        _remove_tree(temp_path)
+
+    def remove(self, name):
+        """
+        Removes the snapshot name from the cache.
+
+        Raises FileNotFoundError if the snapshot does not exist.
+        """
+        snapshot_path = self._cache_dir / name
+        if _TEMP_INFIX in name or not snapshot_path.is_dir():
+            raise FileNotFoundError(snapshot_path)
+        # Rename first, so the snapshot is never seen partially removed
+        temp_path = self._cache_dir / '{}{}-{}'.format(name, _TEMP_INFIX, os.getpid())
+        snapshot_path.rename(temp_path)
+        _remove_tree(temp_path)
+
+    def materialize(self, snapshot, dest_tree, method=SnapshotMethod.AUTO,
+                    copy_files=frozenset()):
+        """
+        Fills the empty directory dest_tree with the tree of snapshot.
+        The manifest of the snapshot's tree is copied to dest_tree's if it exists.
+
+        method is a SnapshotMethod value. With SnapshotMethod.AUTO, files are cloned if the
+        filesystem supports copy-on-write, then hard linked if dest_tree is on the same
+        filesystem, and otherwise copied.
+        copy_files is a set of POSIX path strings of files to copy instead of hard link,
+        since they are modified in place.
+
+        Returns the SnapshotMethod value that was used.
+
+        Raises OSError if the method is not supported.
+        """
+        snapshot_tree = snapshot.path / _SNAPSHOT_TREE
+        if method == SnapshotMethod.AUTO:
+            method = _detect_method(snapshot.path, dest_tree)
+        get_logger().info('Materializing snapshot %s with method "%s" ...', snapshot.name, method)
+        if method == SnapshotMethod.HARDLINK:
+            get_logger().warning(
+                'The buildspace tree is hard linked to the snapshot. Files modified in place, '
+                'except those in domain substitution, also change the snapshot.')
+        _place_tree(snapshot_tree, dest_tree, method, copy_files)
+        if get_manifest_path(snapshot_tree).exists():
+            shutil.copyfile(
+                str(get_manifest_path(snapshot_tree)), str(get_manifest_path(dest_tree)))
+        # Mark the snapshot as recently used
+        os.utime(str(snapshot.path / _SNAPSHOT_INFO))
+        return method
+
+    def _evict(self, keep_name):
+        """
+        Removes the least recently used snapshots until the cache fits within its limit.
+        The snapshot keep_name is never removed.
+        """
+        if self._max_size is None:
+            return
+        snapshots = self.list()
+        total_size = sum(x.size for x in snapshots)
+        for snapshot in reversed(snapshots):
+            if total_size <= self._max_size:
+                break
+            if snapshot.name == keep_name:
+                continue
+            get_logger().info('Evicting snapshot %s', snapshot.name)
+            try:
+                self.remove(snapshot.name)
+            except FileNotFoundError:
+                pass # Removed by another buildkit instance
+            total_size -= snapshot.size
+
+# Private methods
+
+def _remove_tree(path):
+    """Removes the directory tree at path, including read-only directories"""
+    def _onerror(func, error_path, exc_info):
+        if not func in (os.rmdir, os.unlink, os.remove) or not isinstance(
+                exc_info[1], PermissionError):
+            raise exc_info[1]
+        os.chmod(os.path.dirname(error_path), stat.S_IRWXU)
+        func(error_path)
+    shutil.rmtree(str(path), onerror=_onerror)
+
+def _get_tree_size(tree_path):
+    """Returns the total size of the regular files in tree_path in bytes"""
+    total_size = 0
+    for dir_path, _, file_names in os.walk(str(tree_path)):
+        for file_name in file_names:
+            stat_result = os.lstat(os.path.join(dir_path, file_name))
+            if stat.S_ISREG(stat_result.st_mode):
+                total_size += stat_result.st_size
+    return total_size
+
+def _detect_method(snapshot_path, dest_tree):
+    """
+    Returns the fastest SnapshotMethod value that works from snapshot_path to dest_tree,
+    by trying each method with a probe file.
+    """
+    probe_path = snapshot_path / 'probe{}-{}'.format(_TEMP_INFIX, os.getpid())
+    dest_probe_path = dest_tree / probe_path.name
+    probe_path.write_bytes(b'probe')
+    try:
+        try:
+            reflink_file(probe_path, dest_probe_path)
+            return SnapshotMethod.REFLINK
+        except OSError:
+            pass
+        try:
+            os.link(str(probe_path), str(dest_probe_path))
+            return SnapshotMethod.HARDLINK
+        except OSError:
+            pass
+        return SnapshotMethod.COPY
+    finally:
+        probe_path.unlink()
+        if dest_probe_path.exists():
+            dest_probe_path.unlink()
+
+def _place_file(src_path, dest_path, method):
+    """Places the regular file src_path at the non-existent path dest_path using method"""
+    if method == SnapshotMethod.HARDLINK:
+        os.link(src_path, dest_path)
+    elif method == SnapshotMethod.REFLINK:
+        reflink_file(Path(src_path), Path(dest_path))
+        shutil.copystat(src_path, dest_path)
+    else:
+        shutil.copy2(src_path, dest_path)
+
+def _place_files(file_pairs, method, copy_files):
+    """
+    Places each regular file in file_pairs of (src_path, dest_path, relative_path) using
+    method. Files in copy_files are copied instead of hard linked.
+    """
+    for src_path, dest_path, relative_path in file_pairs:
+        if method == SnapshotMethod.HARDLINK and relative_path in copy_files:
+            _place_file(src_path, dest_path, SnapshotMethod.COPY)
+        else:
+            _place_file(src_path, dest_path, method)
+
+def _place_tree(src_tree, dest_tree, method, copy_files):
+    """
+    Recreates the directories and symbolic links of src_tree in the existing directory
+    dest_tree, and places its regular files using method in parallel.
+    """
+    src_root = str(src_tree)
+    dir_stats = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_PLACE_THREADS) as executor:
+        futures = list()
+        for dir_path, dir_names, file_names in os.walk(src_root):
+            relative_dir = os.path.relpath(dir_path, src_root)
+            dest_dir = os.path.join(str(dest_tree), relative_dir)
+            if relative_dir != os.curdir:
+                os.mkdir(dest_dir)
+            dir_stats.append((dir_path, dest_dir))
+            file_pairs = list()
+            for name in list(dir_names) + file_names:
+                src_path = os.path.join(dir_path, name)
+                dest_path = os.path.join(dest_dir, name)
+                if os.path.islink(src_path):
+                    os.symlink(os.readlink(src_path), dest_path)
+                    if name in dir_names:
+                        dir_names.remove(name)
+                elif name in file_names:
+                    relative_path = Path(relative_dir, name).as_posix()
+                    file_pairs.append((src_path, dest_path, relative_path))
+            if file_pairs:
+                futures.append(executor.submit(_place_files, file_pairs, method, copy_files))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    # Directory attributes are set last, since placing files changes them
+    for src_dir, dest_dir in reversed(dir_stats):
+        shutil.copystat(src_dir, dest_dir)
+
+# Public methods
+
+def get_snapshot_name(config_bundle, prune_binaries=True):
+    """
+    Returns the name of the snapshot of the pristine tree of config_bundle.
+
+    The name consists of the Chromium version and a digest of the pruning list and the
+    properties of the extra dependencies that determine the tree.
+    prune_binaries is a boolean indicating if the tree is pruned.
+    """
+    if prune_binaries:
+        pruning_list = sorted(set(config_bundle.pruning))
+    else:
+        pruning_list = list()
+    pruning_digest = hashlib.sha256(
+        '\n'.join(pruning_list).encode(ENCODING)).hexdigest()
+    extra_deps = list()
+    for dep_name in sorted(config_bundle.extra_deps):
+        dep_properties = config_bundle.extra_deps[dep_name]
+        extra_deps.append((
+            dep_name, dep_properties.version, dep_properties.output_path,
+            dep_properties.strip_leading_dirs, dep_properties.extractor,
+            sorted(dep_properties.hashes.items())))
+    extra_deps_digest = hashlib.sha256(
+        json.dumps(extra_deps, sort_keys=True).encode(ENCODING)).hexdigest()
+    key_digest = hashlib.sha256('\n'.join((
+        config_bundle.version.chromium_version, pruning_digest,
+        extra_deps_digest)).encode(ENCODING)).hexdigest()
+    return 'chromium-{}-{}'.format(config_bundle.version.chromium_version, key_digest[:16])
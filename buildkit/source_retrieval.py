@@ -8,19 +8,72 @@
 Module for the downloading, checking, and unpacking of necessary files into the buildspace tree
 """
 
+import collections
+import concurrent.futures
+import configparser
+import http.client
+import os
+import shutil
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import hashlib
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 
 from .common import (
-    ENCODING, ExtractorEnum, get_logger, ensure_empty_dir)
+    ENCODING, ExtractorEnum, get_logger, ensure_empty_dir, reflink_file)
+from .domain_substitution import remove_journal
 from .extraction import extract_tar_file, extract_with_7z
+from .snapshot_cache import SnapshotCache, SnapshotMethod, get_snapshot_name
+from .tree_manifest import get_manifest_path, remove_manifest, write_manifest
 
 # Constants
 
-_SOURCE_ARCHIVE_URL = ('https://commondatastorage.googleapis.com/'
-                       'chromium-browser-official/chromium-{}.tar.xz')
-_SOURCE_HASHES_URL = _SOURCE_ARCHIVE_URL + '.hashes'
+# Mirrors of the Chromium source code archive, in order of preference
+_SOURCE_ARCHIVE_URLS = (
+    'https://commondatastorage.googleapis.com/chromium-browser-official/chromium-{}.tar.xz',
+    'https://storage.googleapis.com/chromium-browser-official/chromium-{}.tar.xz',
+)
+_SOURCE_HASHES_URLS = tuple(x + '.hashes' for x in _SOURCE_ARCHIVE_URLS)
+
+# Number of bytes to read from an archive at a time during hash verification
+_HASH_CHUNK_SIZE = 1024 * 1024
+# Number of bytes to read from the network at a time during downloads
+_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Suffix of the file recording the hashes of a successfully verified download
+_VERIFIED_STAMP_SUFFIX = '.verified'
+# Suffix of the file that a download is written to until it is complete
+_PARTIAL_SUFFIX = '.partial'
+# Suffix of the file recording the progress of a segmented download
+_SEGMENTS_SUFFIX = '.segments'
+# Smallest number of bytes requested by each connection of a segmented download
+_MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Number of segments per connection of a segmented download. More segments allow faster
+# connections to take over work from slower ones.
+_SEGMENTS_PER_CONNECTION = 4
+# Number of bytes requested from each mirror to measure its speed
+_MIRROR_PROBE_SIZE = 64 * 1024
+# Seconds to wait for a mirror to respond before it is considered unavailable
+_MIRROR_PROBE_TIMEOUT = 10
+# Exceptions that cause a download to continue from the next mirror
+_MIRROR_ERRORS = (urllib.error.URLError, http.client.HTTPException, ConnectionError,
+                  socket.timeout)
+# Maximum number of redirects to follow for a URL
+_MAX_REDIRECTS = 10
+# HTTP status codes of redirects
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Largest remaining response body that is read to keep a connection alive when closed early
+_MAX_DRAIN_SIZE = 64 * 1024
+# Hash algorithms to key the download cache with, in order of preference
+_CACHE_KEY_HASHES = ('sha256', 'sha512', 'sha384', 'sha224', 'sha1', 'md5')
+# Suffix of the file next to a download cache entry whose modification time is the last use
+# of the entry. The entry itself is not touched, since it may be hard linked into buildspaces
+# whose stamps include its modification time.
+_CACHE_USED_SUFFIX = '.used'
 
 # Custom Exceptions
 
@@ -32,46 +85,877 @@ class HashMismatchError(Exception):
     """Exception for computed hashes not matching expected hashes"""
     pass
 
-class _UrlRetrieveReportHook: #pylint: disable=too-few-public-methods
-    """Hook for urllib.request.urlretrieve to log progress information to console"""
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection that resumes TLS sessions from previous connections to the same host"""
+    def __init__(self, *args, tls_sessions=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tls_sessions = tls_sessions
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self) #pylint: disable=non-parent-method-called
+        server_hostname = self._tunnel_host or self.host
+        session = self._tls_sessions.get(server_hostname)
+        if session is None:
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+        else:
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname, session=session)
+        self.save_tls_session()
+
+    def save_tls_session(self):
+        """Stores the TLS session of the connection for reuse by new connections"""
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            self._tls_sessions[self._tunnel_host or self.host] = session
+
+class _PooledResponse:
+    """
+    HTTP response that returns its connection to the Downloader pool when closed.
+
+    Only the parts of the urllib response interface used by buildkit are provided.
+    """
+    def __init__(self, downloader, pool_key, connection, response, url): #pylint: disable=too-many-arguments
+        self._downloader = downloader
+        self._pool_key = pool_key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        """Reads and returns up to amt bytes of the response body, or all of it if amt is None"""
+        return self._response.read(amt)
+
+    def close(self):
+        """Closes the response, and returns the connection to the pool if it can be reused"""
+        if self._connection is None:
+            return
+        remaining = self._response.length
+        if not self._response.isclosed() and remaining is not None and (
+                remaining <= _MAX_DRAIN_SIZE):
+            try:
+                self._response.read()
+            except (http.client.HTTPException, OSError):
+                pass
+        if self._response.isclosed() and not self._response.will_close:
+            self._downloader._release(self._pool_key, self._connection) #pylint: disable=protected-access
+        else:
+            self._response.close()
+            self._connection.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Downloader:
+    """
+    Downloads files over HTTP and HTTPS with persistent connections.
+
+    Idle connections are kept open per host and reused by later requests, and TLS sessions
+    are resumed when new connections to the same host are needed. The final location of a
+    redirected URL is remembered, so later requests for the same URL go there directly.
+    It is safe to use from multiple threads; each thread gets its own connection.
+    """
+    def __init__(self, disable_ssl_verification=False, timeout=None):
+        """
+        disable_ssl_verification is a boolean indicating if certificate verification
+        should be disabled for HTTPS.
+        timeout is the default timeout in seconds for blocking operations, or None for the
+        global default timeout.
+        """
+        self._ssl_context = ssl.create_default_context()
+        if disable_ssl_verification:
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        self._timeout = timeout
+        self._proxies = urllib.request.getproxies()
+        self._lock = threading.Lock()
+        self._idle_connections = collections.defaultdict(list)
+        self._redirects = dict()
+        self._tls_sessions = dict()
+
+    def _get_pool_key(self, url_parts):
+        """Returns a tuple of (scheme, host, port, proxy) identifying compatible connections"""
+        if url_parts.scheme not in ('http', 'https'):
+            raise urllib.error.URLError('Unsupported URL scheme: {}'.format(url_parts.scheme))
+        port = url_parts.port
+        if port is None:
+            port = 443 if url_parts.scheme == 'https' else 80
+        proxy = self._proxies.get(url_parts.scheme)
+        if proxy and urllib.request.proxy_bypass(url_parts.hostname):
+            proxy = None
+        return url_parts.scheme, url_parts.hostname, port, proxy
+
+    def _new_connection(self, pool_key):
+        """Creates a new connection for the pool key"""
+        scheme, host, port, proxy = pool_key
+        if proxy:
+            proxy_parts = urllib.parse.urlsplit(proxy)
+            connect_host, connect_port = proxy_parts.hostname, proxy_parts.port or 80
+        else:
+            connect_host, connect_port = host, port
+        if scheme == 'https':
+            connection = _HTTPSConnection(
+                connect_host, connect_port, timeout=self._timeout, context=self._ssl_context,
+                tls_sessions=self._tls_sessions)
+            if proxy:
+                connection.set_tunnel(host, port)
+        else:
+            connection = http.client.HTTPConnection(
+                connect_host, connect_port, timeout=self._timeout)
+        return connection
+
+    def _acquire(self, pool_key):
+        """Returns a tuple of an idle or new connection, and if it was idle"""
+        with self._lock:
+            idle_connections = self._idle_connections[pool_key]
+            if idle_connections:
+                return idle_connections.pop(), True
+        return self._new_connection(pool_key), False
+
+    def _release(self, pool_key, connection):
+        """Returns a connection to the pool of idle connections"""
+        if isinstance(connection, _HTTPSConnection):
+            connection.save_tls_session()
+        with self._lock:
+            self._idle_connections[pool_key].append(connection)
+
+    def _request(self, url, headers, timeout):
+        """Sends a GET request for url and returns a _PooledResponse"""
+        url_parts = urllib.parse.urlsplit(url)
+        pool_key = self._get_pool_key(url_parts)
+        if pool_key[0] == 'http' and pool_key[3]:
+            target = url # Plain HTTP proxies need the absolute URL
+        else:
+            target = urllib.parse.urlunsplit(('', '', url_parts.path or '/', url_parts.query, ''))
+        request_headers = {'User-Agent': 'Python-urllib/{}'.format(urllib.request.__version__)}
+        request_headers.update(headers or dict())
+        connection, reused = self._acquire(pool_key)
+        while True:
+            connection.timeout = self._timeout if timeout is None else timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(connection.timeout)
+            try:
+                connection.request('GET', target, headers=request_headers)
+                response = connection.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection. Retry once with a new connection.
+                connection, reused = self._new_connection(pool_key), False
+                continue
+            except BaseException:
+                connection.close()
+                raise
+            return _PooledResponse(self, pool_key, connection, response, url)
+
+    def open(self, url, headers=None, timeout=None):
+        """
+        Sends a GET request for url and returns the response, following redirects.
+
+        headers is a dictionary of additional request headers.
+        timeout is the timeout in seconds for this request, or None for the default.
+
+        The returned response must be closed, preferably via a with statement, so its
+        connection can be reused.
+
+        Raises urllib.error.HTTPError if the server returns an error status.
+        Raises urllib.error.URLError if the URL is not supported or redirects too many times.
+        May raise http.client.HTTPException or OSError for connection errors.
+        """
+        with self._lock:
+            target = self._redirects.get(url, url)
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._request(target, headers, timeout)
+            if response.status not in _REDIRECT_STATUSES:
+                break
+            location = response.headers.get('Location')
+            response.close()
+            if not location:
+                raise urllib.error.URLError('Redirect without a location from {}'.format(target))
+            target = urllib.parse.urljoin(target, location)
+        else:
+            raise urllib.error.URLError('Too many redirects for {}'.format(url))
+        if response.status >= 400:
+            response.close()
+            with self._lock:
+                cached_target = self._redirects.pop(url, None)
+            if cached_target is not None:
+                # The remembered redirect may have expired
+                return self.open(url, headers=headers, timeout=timeout)
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.headers, None)
+        if target != url:
+            with self._lock:
+                self._redirects[url] = target
+        return response
+
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            for idle_connections in self._idle_connections.values():
+                for connection in idle_connections:
+                    connection.close()
+            self._idle_connections.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class DownloadReportHook: #pylint: disable=too-few-public-methods
+    """
+    Hook for downloads to log progress information to console.
+
+    It is called with the number of bytes downloaded so far and the total size in bytes,
+    which is not positive if it is unknown.
+    """
     def __init__(self):
         self._max_len_printed = 0
         self._last_percentage = None
 
-    def __call__(self, block_count, block_size, total_size):
-        downloaded_estimate = block_count * block_size
-        percentage = round(downloaded_estimate / total_size, ndigits=3)
-        if percentage == self._last_percentage:
+    def __call__(self, downloaded_size, total_size):
+        if total_size > 0:
+            percentage = round(downloaded_size / total_size, ndigits=3)
+        else:
+            percentage = None
+        if percentage is not None and percentage == self._last_percentage:
             return # Do not needlessly update the console
         self._last_percentage = percentage
         print('\r' + ' ' * self._max_len_printed, end='')
         if total_size > 0:
             status_line = 'Progress: {:.1%} of {:,d} B'.format(percentage, total_size)
         else:
-            status_line = 'Progress: {:,d} B of unknown size'.format(downloaded_estimate)
+            status_line = 'Progress: {:,d} B of unknown size'.format(downloaded_size)
         self._max_len_printed = len(status_line)
         print('\r' + status_line, end='')
 
-def _download_if_needed(file_path, url, show_progress):
+def _get_stamp_path(file_path):
+    """Returns the pathlib.Path to the verified stamp of file_path"""
+    return file_path.with_name(file_path.name + _VERIFIED_STAMP_SUFFIX)
+
+class _MultiHasher:
+    """Computes several hashes of the same data in a single pass"""
+    def __init__(self, hash_iter):
+        """
+        hash_iter is an iterable of (hash_name, hash_hex) tuples of expected hashes.
+        """
+        self._hash_pairs = tuple(hash_iter)
+        self._hashers = None
+        self.reset()
+
+    def reset(self):
+        """Discards all data fed to the hashers"""
+        self._hashers = list()
+        for hash_name, hash_hex in self._hash_pairs:
+            self._hashers.append((hashlib.new(hash_name), hash_hex))
+
+    def __bool__(self):
+        return bool(self._hashers)
+
+    def update(self, data):
+        """Feeds data to every hasher"""
+        for hasher, _ in self._hashers:
+            hasher.update(data)
+
+    def verify(self, file_path):
+        """
+        Compares the computed hashes against the expected hashes.
+
+        file_path is the pathlib.Path of the file being verified, for error reporting.
+
+        Raises source_retrieval.HashMismatchError when the hashes do not match.
+        """
+        for hasher, hash_hex in self._hashers:
+            get_logger().debug('Verifying %s hash...', hasher.name)
+            if not hasher.hexdigest().lower() == hash_hex.lower():
+                raise HashMismatchError(file_path)
+
+    def write_stamp(self, file_path):
+        """
+        Writes a stamp next to file_path recording the verified hashes along with the
+        size, modification time, and inode of file_path.
+        """
+        stat_result = file_path.stat()
+        stamp = configparser.ConfigParser()
+        stamp['file'] = {
+            'size': str(stat_result.st_size),
+            'mtime_ns': str(stat_result.st_mtime_ns),
+            'inode': str(stat_result.st_ino),
+        }
+        stamp['hashes'] = dict(
+            (hasher.name.lower(), hasher.hexdigest().lower()) for hasher, _ in self._hashers)
+        with _get_stamp_path(file_path).open('w', encoding=ENCODING) as stamp_file:
+            stamp.write(stamp_file)
+
+def _check_stamp(file_path, hash_pairs):
+    """
+    Returns True if the verified stamp of file_path matches the current size, modification
+    time, and inode of file_path, and it contains all of the expected hashes in hash_pairs;
+    False otherwise.
+    """
+    stamp_path = _get_stamp_path(file_path)
+    if not stamp_path.is_file():
+        return False
+    stamp = configparser.ConfigParser()
+    try:
+        with stamp_path.open(encoding=ENCODING) as stamp_file:
+            stamp.read_file(stamp_file)
+        stat_result = file_path.stat()
+        if (stamp.getint('file', 'size') != stat_result.st_size
+                or stamp.getint('file', 'mtime_ns') != stat_result.st_mtime_ns
+                or stamp.getint('file', 'inode') != stat_result.st_ino):
+            return False
+        for hash_name, hash_hex in hash_pairs:
+            if stamp.get('hashes', hash_name.lower()) != hash_hex.lower():
+                return False
+    except (configparser.Error, ValueError):
+        get_logger().debug('Ignoring malformed stamp: %s', stamp_path)
+        return False
+    return True
+
+def _get_partial_path(file_path):
+    """Returns the pathlib.Path where file_path is stored while it is being downloaded"""
+    return file_path.with_name(file_path.name + _PARTIAL_SUFFIX)
+
+def _hash_file(hasher, file_path):
+    """Feeds the contents of file_path to hasher in chunks"""
+    with file_path.open('rb') as file_obj:
+        chunk = file_obj.read(_HASH_CHUNK_SIZE)
+        while chunk:
+            hasher.update(chunk)
+            chunk = file_obj.read(_HASH_CHUNK_SIZE)
+
+def _open_resumable(downloader, url, resume_size):
+    """
+    Opens url for reading with the Downloader downloader, resuming at byte offset
+    resume_size when it is non-zero.
+
+    Returns a tuple of the response object (or None if there is nothing left to download)
+    and the offset the response data starts at. The offset is 0 if the server does not
+    support resuming.
+    """
+    headers = dict()
+    if resume_size:
+        headers['Range'] = 'bytes={}-'.format(resume_size)
+    try:
+        response = downloader.open(url, headers=headers)
+    except urllib.error.HTTPError as exc:
+        if resume_size and exc.code == 416: # Range Not Satisfiable
+            # The partial file already contains everything there is to download
+            return None, resume_size
+        raise
+    if resume_size and response.status == 206: # Partial Content
+        content_range = response.headers.get('Content-Range', '')
+        if content_range.startswith('bytes {}-'.format(resume_size)):
+            return response, resume_size
+        response.close()
+        get_logger().warning('Unexpected Content-Range "%s". Restarting download.', content_range)
+        return downloader.open(url), 0
+    if resume_size:
+        get_logger().info('Server does not support resuming downloads. Restarting download.')
+    return response, 0
+
+def _probe_mirror(downloader, url):
+    """
+    Measures how long it takes to download the first bytes of url with the Downloader
+    downloader.
+
+    Returns the elapsed time in seconds, which accounts for both latency and throughput,
+    or None if the mirror could not be reached.
+    """
+    headers = {'Range': 'bytes=0-{}'.format(_MIRROR_PROBE_SIZE - 1)}
+    start_time = time.monotonic()
+    try:
+        with downloader.open(url, headers=headers, timeout=_MIRROR_PROBE_TIMEOUT) as response:
+            received_size = len(response.read(_MIRROR_PROBE_SIZE))
+    except _MIRROR_ERRORS as exc:
+        get_logger().warning('Mirror %s is unavailable: %s', url, exc)
+        return None
+    elapsed_time = time.monotonic() - start_time
+    get_logger().debug('Mirror %s: %s B in %.3f s', url, received_size, elapsed_time)
+    # Normalize by the amount received, in case the file is smaller than the probe
+    return elapsed_time * _MIRROR_PROBE_SIZE / max(received_size, 1)
+
+def _sort_mirrors(downloader, urls):
+    """
+    Returns a list of the mirror URLs in urls ordered from fastest to slowest.
+
+    Mirrors that could not be reached are placed last in their original order, so they
+    are still tried if all others fail.
     """
-    Downloads a file from url to the specified path file_path if necessary.
+    if len(urls) <= 1:
+        return list(urls)
+    get_logger().info('Probing %s mirrors...', len(urls))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        probe_times = list(executor.map(lambda x: _probe_mirror(downloader, x), urls))
+    float_inf = float('inf')
+    sorted_urls = [url for _, _, url in sorted(
+        (float_inf if probe_time is None else probe_time, index, url)
+        for index, (probe_time, url) in enumerate(zip(probe_times, urls)))]
+    get_logger().info('Using mirror %s', sorted_urls[0])
+    return sorted_urls
+
+def _probe_download_size(downloader, url):
+    """
+    Checks if the server of url supports HTTP Range requests with the Downloader downloader.
+
+    Returns the size of the file in bytes if ranges are supported; None otherwise.
+    """
+    with downloader.open(url, headers={'Range': 'bytes=0-0'}) as response:
+        content_range = response.headers.get('Content-Range', '')
+        if response.status != 206 or not content_range.startswith('bytes 0-0/'):
+            return None
+        total_size = content_range.rpartition('/')[2]
+        if not total_size.isdigit():
+            return None
+        return int(total_size)
+
+class _SegmentedDownload:
+    """
+    Downloads a file over multiple connections by fetching byte ranges concurrently.
+
+    The ranges are written directly into a preallocated partial file. Completed segments
+    are recorded in a sidecar file, so an interrupted download only fetches the segments
+    that are missing when it is resumed.
+    """
+    def __init__(self, downloader, urls, partial_path, connections, reporthook=None): #pylint: disable=too-many-arguments
+        """
+        downloader is the Downloader to download with.
+        urls is a sequence of mirror URLs of the file. Segments that fail to download
+        are retried from the next mirror.
+        """
+        self._downloader = downloader
+        self._urls = urls
+        self._partial_path = partial_path
+        self._segments_path = partial_path.with_name(partial_path.name + _SEGMENTS_SUFFIX)
+        self._connections = connections
+        self._reporthook = reporthook
+        self._lock = threading.Lock()
+        self._total_size = None
+        self._segment_size = None
+        self._downloaded_size = 0
+        self._failed_urls = set()
+
+    @property
+    def in_progress(self):
+        """Returns True if there is an interrupted segmented download to resume"""
+        return self._segments_path.exists() and self._partial_path.exists()
+
+    def _read_progress(self):
+        """Returns the set of completed segment indices, and loads the segment layout"""
+        with self._segments_path.open(encoding=ENCODING) as segments_file:
+            lines = segments_file.read().splitlines()
+        self._total_size, self._segment_size = map(int, lines[0].split())
+        return set(map(int, filter(len, lines[1:])))
+
+    def _init_progress(self, total_size):
+        """Preallocates the partial file and writes a new segment layout"""
+        self._total_size = total_size
+        self._segment_size = max(
+            _MIN_SEGMENT_SIZE,
+            -(-total_size // (self._connections * _SEGMENTS_PER_CONNECTION)))
+        with self._partial_path.open('wb') as file_obj:
+            file_obj.truncate(total_size)
+        with self._segments_path.open('w', encoding=ENCODING) as segments_file:
+            segments_file.write('{} {}\n'.format(self._total_size, self._segment_size))
+
+    def _segment_range(self, index):
+        """Returns the inclusive byte range of the segment"""
+        start = index * self._segment_size
+        return start, min(start + self._segment_size, self._total_size) - 1
+
+    def _add_progress(self, size):
+        """Adds size bytes to the downloaded size and reports progress"""
+        with self._lock:
+            self._downloaded_size += size
+            if self._reporthook:
+                self._reporthook(self._downloaded_size, self._total_size)
+
+    def _fetch_range(self, url, start, end):
+        """
+        Downloads the inclusive byte range from url into the partial file.
+
+        If the download fails, the bytes written for the range are removed from the
+        progress before the error is raised.
+        """
+        written_size = 0
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        try:
+            with self._downloader.open(url, headers=headers) as response, \
+                    self._partial_path.open('r+b') as file_obj:
+                if response.status != 206 or not response.headers.get(
+                        'Content-Range', '').startswith('bytes {}-{}/'.format(start, end)):
+                    raise urllib.error.URLError(
+                        'Server did not honor range {}-{} of {}'.format(start, end, url))
+                file_obj.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = response.read(min(_DOWNLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise urllib.error.URLError(
+                            'Connection closed early for range {}-{} of {}'.format(
+                                start, end, url))
+                    file_obj.write(chunk)
+                    remaining -= len(chunk)
+                    written_size += len(chunk)
+                    self._add_progress(len(chunk))
+        except _MIRROR_ERRORS:
+            # The segment will be fetched again from the beginning
+            self._add_progress(-written_size)
+            raise
+
+    def _fetch_segment(self, index):
+        """Downloads one segment into its place in the partial file"""
+        start, end = self._segment_range(index)
+        with self._lock:
+            # Prefer mirrors that have not failed yet
+            urls = sorted(self._urls, key=lambda x: x in self._failed_urls)
+        for mirror_index, url in enumerate(urls):
+            try:
+                self._fetch_range(url, start, end)
+                break
+            except _MIRROR_ERRORS as exc:
+                with self._lock:
+                    self._failed_urls.add(url)
+                if mirror_index == len(urls) - 1:
+                    raise
+                get_logger().warning(
+                    'Segment %s failed from %s: %s. Trying next mirror.', index, url, exc)
+        with self._lock:
+            with self._segments_path.open('a', encoding=ENCODING) as segments_file:
+                segments_file.write('{}\n'.format(index))
+
+    def run(self):
+        """
+        Performs the download.
+
+        Returns True if the download completed; False if the server does not support
+        range requests and nothing was downloaded.
+        """
+        total_size = None
+        for mirror_index, url in enumerate(self._urls):
+            try:
+                total_size = _probe_download_size(self._downloader, url)
+                break
+            except _MIRROR_ERRORS as exc:
+                if mirror_index == len(self._urls) - 1:
+                    raise
+                get_logger().warning('Unable to probe %s: %s. Trying next mirror.', url, exc)
+        completed = set()
+        if self.in_progress:
+            completed = self._read_progress()
+            if total_size == self._total_size:
+                get_logger().info(
+                    'Resuming segmented download with %s of %s segments done',
+                    len(completed), -(-self._total_size // self._segment_size))
+            else:
+                get_logger().info('Remote file has changed. Restarting segmented download.')
+                completed = set()
+                self._segments_path.unlink()
+                self._partial_path.unlink()
+        if total_size is None:
+            return False
+        if not completed:
+            self._init_progress(total_size)
+        segment_count = -(-self._total_size // self._segment_size)
+        for index in completed:
+            start, end = self._segment_range(index)
+            self._downloaded_size += end - start + 1
+        pending = [x for x in range(segment_count) if x not in completed]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._connections) as executor:
+            for future in [executor.submit(self._fetch_segment, x) for x in pending]:
+                future.result()
+        self._segments_path.unlink()
+        return True
+
+def _download_single_stream(downloader, urls, partial_path, hasher, reporthook):
+    """
+    Using the Downloader downloader, downloads the file at the mirror URLs in urls into
+    partial_path over one connection, resuming the partial file if it exists. If a mirror
+    fails during the download, the download continues from the next mirror at the same
+    offset when it supports resuming.
+    hasher is fed all of the data of the file.
+    """
+    hashed_size = None
+    for mirror_index, url in enumerate(urls):
+        resume_size = 0
+        if partial_path.exists():
+            resume_size = partial_path.stat().st_size
+        try:
+            response, downloaded_size = _open_resumable(downloader, url, resume_size)
+            if downloaded_size != hashed_size:
+                hasher.reset()
+                if downloaded_size:
+                    get_logger().info('Resuming download at %s B ...', downloaded_size)
+                    _hash_file(hasher, partial_path)
+                hashed_size = downloaded_size
+            if response is None:
+                return
+            with response, partial_path.open('ab' if downloaded_size else 'wb') as file_obj:
+                total_size = int(response.headers.get('Content-Length', -1))
+                if total_size >= 0:
+                    total_size += downloaded_size
+                chunk = response.read(_DOWNLOAD_CHUNK_SIZE)
+                while chunk:
+                    file_obj.write(chunk)
+                    hasher.update(chunk)
+                    hashed_size += len(chunk)
+                    if reporthook:
+                        reporthook(hashed_size, total_size)
+                    chunk = response.read(_DOWNLOAD_CHUNK_SIZE)
+                if 0 <= total_size != hashed_size:
+                    raise urllib.error.URLError('Connection closed early for {}'.format(url))
+            return
+        except _MIRROR_ERRORS as exc:
+            if mirror_index == len(urls) - 1:
+                raise
+            get_logger().warning('Download from %s failed: %s. Trying next mirror.', url, exc)
+
+def _download_if_needed(downloader, file_path, urls, show_progress, hash_iter=None, #pylint: disable=too-many-arguments
+                        connections=1):
+    """
+    Downloads a file from the mirror URLs in urls to the specified path file_path if necessary.
+
+    downloader is the Downloader to download with.
+
+    If there are multiple mirrors, each is probed and the fastest one is used first. When a
+    mirror fails, the download continues from the next mirror without starting over.
+
+    The file is downloaded into a ".partial" file next to file_path first. If a partial file
+    exists from an interrupted download, the download is resumed with an HTTP Range request
+    when the server supports it. The partial file is renamed to file_path only after the
+    download is complete and verified.
 
     If show_progress is True, download progress is printed to the console.
+    hash_iter is an optional iterable of (hash_name, hash_hex) tuples. If specified, the
+    hashes are computed while the file is downloaded, and the file is verified as soon
+    as the download finishes. A stamp file recording the verified hashes is then written.
+    connections is the number of concurrent connections to download the file with. If it is
+    greater than 1 and the server supports range requests, the file is split into segments
+    that are downloaded concurrently, and the hashes are computed after the download
+    completes. Otherwise, the file is downloaded in a single stream.
+
+    Returns True if the file was downloaded and verified against hash_iter;
+    False if the file already exists or no hashes were given.
 
     Raises source_retrieval.NotAFileError when the destination exists but is not a file.
+    Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
+    The partial file is removed in this case.
     """
     if file_path.exists() and not file_path.is_file():
         raise NotAFileError(file_path)
-    elif not file_path.exists():
-        get_logger().info('Downloading %s ...', file_path)
-        reporthook = None
-        if show_progress:
-            reporthook = _UrlRetrieveReportHook()
-        urllib.request.urlretrieve(url, str(file_path), reporthook=reporthook)
-        if show_progress:
-            print()
-    else:
+    elif file_path.exists():
         get_logger().info('%s already exists. Skipping download.', file_path)
+        return False
+    partial_path = _get_partial_path(file_path)
+    if partial_path.exists() and not partial_path.is_file():
+        raise NotAFileError(partial_path)
+    stamp_path = _get_stamp_path(file_path)
+    if stamp_path.exists():
+        stamp_path.unlink()
+    hasher = _MultiHasher(hash_iter or tuple())
+    reporthook = None
+    if show_progress:
+        reporthook = DownloadReportHook()
+    get_logger().info('Downloading %s ...', file_path)
+    urls = _sort_mirrors(downloader, urls)
+    segmented = _SegmentedDownload(downloader, urls, partial_path, max(connections, 1), reporthook)
+    use_segments = segmented.in_progress or (connections > 1 and not partial_path.exists())
+    if use_segments and segmented.run():
+        if hasher:
+            _hash_file(hasher, partial_path)
+    else:
+        if use_segments:
+            get_logger().info('Server does not support range requests. Using one connection.')
+        _download_single_stream(downloader, urls, partial_path, hasher, reporthook)
+    if show_progress:
+        print()
+    if hasher:
+        get_logger().info('Verifying hashes...')
+        try:
+            hasher.verify(file_path)
+        except HashMismatchError:
+            # Resuming from corrupt data can never succeed
+            partial_path.unlink()
+            raise
+    partial_path.replace(file_path)
+    if not hasher:
+        return False
+    hasher.write_stamp(file_path)
+    return True
+
+def _verify_hashes(file_path, hash_pairs, paranoid=False):
+    """
+    Verifies the hashes of the file at file_path in a single pass over its contents.
+
+    hash_pairs is a sequence of (hash_name, hash_hex) tuples. All hashes are computed
+    together by feeding each chunk of the file to every hasher, so the file is read
+    only once and memory usage is independent of the file size.
+    If the verified stamp of file_path shows that the file is unchanged since it was last
+    verified with the same hashes, the hashes are not computed again unless paranoid is True.
+
+    Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
+    """
+    hasher = _MultiHasher(hash_pairs)
+    if not hasher:
+        get_logger().warning('No hashes to verify for %s', file_path)
+        return
+    if not paranoid and _check_stamp(file_path, hash_pairs):
+        get_logger().info('%s is unchanged since it was verified. Skipping hashes.',
+                          file_path.name)
+        return
+    stamp_path = _get_stamp_path(file_path)
+    if stamp_path.exists():
+        stamp_path.unlink()
+    get_logger().info('Verifying hashes...')
+    _hash_file(hasher, file_path)
+    hasher.verify(file_path)
+    hasher.write_stamp(file_path)
+
+class _DownloadCache:
+    """
+    A content-addressed cache of verified downloads that can be shared by buildspaces.
+
+    Entries are stored under a directory named after the hash algorithm, with the expected
+    hash as the file name. Entries are only added after verification. Files are placed into
+    the buildspace downloads directory as hard links when possible, falling back to
+    copy-on-write clones and then to copies. When the size of the cache exceeds its
+    limit, the least recently used entries are removed. The last use of an entry is recorded
+    by a separate file next to it.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        """
+        cache_dir is the pathlib.Path to the cache directory. It is created if necessary.
+        max_size is the maximum total size of the cache in bytes, or None for no limit.
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def _get_entry_path(self, hash_pairs):
+        """Returns the pathlib.Path of the cache entry for hash_pairs; None if no key exists"""
+        hashes = dict((name.lower(), value.lower()) for name, value in hash_pairs)
+        for hash_name in _CACHE_KEY_HASHES:
+            if hash_name in hashes:
+                return self._cache_dir / hash_name / hashes[hash_name]
+        return None
+
+    @staticmethod
+    def _get_used_path(entry_path):
+        """Returns the pathlib.Path of the file that records the last use of entry_path"""
+        return entry_path.with_name(entry_path.name + _CACHE_USED_SUFFIX)
+
+    @staticmethod
+    def _place_file(src_path, dest_path):
+        """Hard links, clones, or copies src_path to the non-existent path dest_path"""
+        try:
+            os.link(str(src_path), str(dest_path))
+            return
+        except OSError:
+            pass
+        try:
+            reflink_file(src_path, dest_path)
+            return
+        except OSError:
+            pass
+        shutil.copyfile(str(src_path), str(dest_path))
+
+    def retrieve(self, file_path, hash_pairs):
+        """
+        Places the cached file for hash_pairs at file_path if it is cached and file_path does
+        not exist yet.
+
+        Returns True if the file was retrieved from the cache; False otherwise.
+        """
+        entry_path = self._get_entry_path(hash_pairs)
+        if entry_path is None or file_path.exists():
+            return False
+        try:
+            self._place_file(entry_path, file_path)
+        except FileNotFoundError:
+            return False
+        self._get_used_path(entry_path).touch()
+        get_logger().info('Retrieved %s from download cache', file_path.name)
+        return True
+
+    def store(self, file_path, hash_pairs):
+        """Adds the verified file at file_path to the cache if it is not cached already"""
+        entry_path = self._get_entry_path(hash_pairs)
+        if entry_path is None:
+            return
+        if not entry_path.exists():
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = entry_path.with_name('{}.{}.tmp'.format(entry_path.name, os.getpid()))
+            if temp_path.exists():
+                temp_path.unlink()
+            self._place_file(file_path, temp_path)
+            temp_path.replace(entry_path)
+            self._get_used_path(entry_path).touch()
+            get_logger().debug('Stored %s in download cache', file_path.name)
+        self._evict()
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits within its limit"""
+        if self._max_size is None:
+            return
+        with self._lock:
+            entries = list()
+            for entry_path in self._cache_dir.glob('*/*'):
+                if entry_path.suffix in ('.tmp', _CACHE_USED_SUFFIX):
+                    continue # Being stored by another buildkit instance, or a use record
+                try:
+                    stat_result = entry_path.stat()
+                except FileNotFoundError:
+                    continue # Removed by another buildkit instance
+                last_used = stat_result.st_mtime
+                try:
+                    last_used = self._get_used_path(entry_path).stat().st_mtime
+                except FileNotFoundError:
+                    pass # Stored by an older version of buildkit
+                entries.append((last_used, stat_result.st_size, entry_path))
+            total_size = sum(map(lambda x: x[1], entries))
+            for _, entry_size, entry_path in sorted(entries, key=lambda x: x[0]):
+                if total_size <= self._max_size:
+                    break
+                get_logger().info('Evicting %s from download cache', entry_path)
+                for path in (entry_path, self._get_used_path(entry_path)):
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                total_size -= entry_size
+
+def _retrieve_archive(downloader, file_path, urls, show_progress, hash_pairs, #pylint: disable=too-many-arguments
+                      download_connections=1, download_cache=None, paranoid=False):
+    """
+    Retrieves and verifies the archive at file_path, using the download cache if available.
+
+    hash_pairs is a sequence of (hash_name, hash_hex) tuples of expected hashes.
+    download_cache is a _DownloadCache, or None to not use a download cache.
+    paranoid is a boolean indicating if existing archives are always fully verified,
+    even if their verified stamps are up to date.
+    Other arguments are the same as _download_if_needed()
+
+    Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
+    Raises source_retrieval.NotAFileError when the archive name exists but is not a file.
+    """
+    if download_cache:
+        download_cache.retrieve(file_path, hash_pairs)
+    if not _download_if_needed(downloader, file_path, urls, show_progress, hash_pairs,
+                               connections=download_connections):
+        _verify_hashes(file_path, hash_pairs, paranoid=paranoid)
+    if download_cache:
+        download_cache.store(file_path, hash_pairs)
 
 def _chromium_hashes_generator(hashes_path):
     with hashes_path.open(encoding=ENCODING) as hashes_file:
@@ -82,20 +966,17 @@ def _chromium_hashes_generator(hashes_path):
         else:
             get_logger().warning('Skipping unknown hash algorithm: %s', hash_name)
 
-def _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments
-                           show_progress, pruning_set, extractors=None):
+def _download_chromium_source(downloader, config_bundle, buildspace_downloads, show_progress, #pylint: disable=too-many-arguments
+                              download_connections=1, download_cache=None, paranoid=False):
     """
-    Download, check, and extract the Chromium source code into the buildspace tree.
+    Download and check the Chromium source code archive.
 
     Arguments of the same name are shared with retreive_and_extract().
-    pruning_set is a set of files to be pruned. Only the files that are ignored during
-    extraction are removed from the set.
-    extractors is a dictionary of PlatformEnum to a command or path to the
-    extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip.
+
+    Returns the pathlib.Path to the verified archive.
 
     Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
     Raises source_retrieval.NotAFileError when the archive name exists but is not a file.
-    May raise undetermined exceptions during archive unpacking.
     """
     source_archive = buildspace_downloads / 'chromium-{}.tar.xz'.format(
         config_bundle.version.chromium_version)
@@ -108,79 +989,255 @@ def _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree,
 
     get_logger().info('Downloading Chromium source code...')
     _download_if_needed(
-        source_archive,
-        _SOURCE_ARCHIVE_URL.format(config_bundle.version.chromium_version),
-        show_progress)
-    _download_if_needed(
-        source_hashes,
-        _SOURCE_HASHES_URL.format(config_bundle.version.chromium_version),
+        downloader, source_hashes,
+        [x.format(config_bundle.version.chromium_version) for x in _SOURCE_HASHES_URLS],
         False)
-    get_logger().info('Verifying hashes...')
-    with source_archive.open('rb') as file_obj:
-        archive_data = file_obj.read()
-    for hash_name, hash_hex in _chromium_hashes_generator(source_hashes):
-        get_logger().debug('Verifying %s hash...', hash_name)
-        hasher = hashlib.new(hash_name, data=archive_data)
-        if not hasher.hexdigest().lower() == hash_hex.lower():
-            raise HashMismatchError(source_archive)
-    get_logger().info('Extracting archive...')
-    extract_tar_file(
-        archive_path=source_archive, buildspace_tree=buildspace_tree, unpack_dir=Path(),
-        ignore_files=pruning_set,
-        relative_to=Path('chromium-{}'.format(config_bundle.version.chromium_version)),
-        extractors=extractors)
+    _retrieve_archive(
+        downloader, source_archive,
+        [x.format(config_bundle.version.chromium_version) for x in _SOURCE_ARCHIVE_URLS],
+        show_progress, tuple(_chromium_hashes_generator(source_hashes)),
+        download_connections=download_connections, download_cache=download_cache,
+        paranoid=paranoid)
+    return source_archive
 
-def _setup_extra_deps(config_bundle, buildspace_downloads, buildspace_tree, show_progress, #pylint: disable=too-many-arguments,too-many-locals
-                      pruning_set, extractors=None):
+class _InlineExecutor:
+    """
+    Executor with the submit() interface of concurrent.futures executors that runs each
+    call in the calling process before returning its completed future.
     """
-    Download, check, and extract extra dependencies into the buildspace tree.
+    def __enter__(self):
+        return self
 
-    Arguments of the same name are shared with retreive_and_extract().
-    pruning_set is a set of files to be pruned. Only the files that are ignored during
-    extraction are removed from the set.
+    def __exit__(self, *_):
+        pass
+
+    def submit(self, function, *args, **kwargs): #pylint: disable=no-self-use
+        """Calls function with args and kwargs, and returns a completed Future of the call"""
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as exc: #pylint: disable=broad-except
+            future.set_exception(exc)
+        return future
+
+def _extract_archive(extractor_name, archive_path, buildspace_tree, unpack_dir, pruning_set, #pylint: disable=too-many-arguments
+                     relative_to, extractors, decompress_threads):
+    """
+    Extracts an archive into the buildspace tree. This runs in an extraction worker process,
+    so all arguments must be picklable.
+
+    extractor_name is the ExtractorEnum value of the extractor to use.
+    pruning_set is a set of files to be pruned.
+    Other arguments are passed to the extractor function.
+
+    Returns a tuple of pruning_set without the files that were ignored during extraction,
+    and a dictionary of the tree manifest hashes of the extracted files computed during
+    extraction.
+
+    May raise undetermined exceptions during archive unpacking.
+    """
+    if extractor_name == ExtractorEnum.SEVENZIP:
+        extractor_func = extract_with_7z
+    elif extractor_name == ExtractorEnum.TAR:
+        extractor_func = extract_tar_file
+    else:
+        # This is not a normal code path
+        raise NotImplementedError(extractor_name)
+    file_hashes = dict()
+    extractor_func(
+        archive_path=archive_path, buildspace_tree=buildspace_tree, unpack_dir=unpack_dir,
+        ignore_files=pruning_set, relative_to=relative_to, extractors=extractors,
+        threads=decompress_threads, file_hashes=file_hashes)
+    return pruning_set, file_hashes
+
+def _submit_chromium_source(executor, config_bundle, source_archive, buildspace_tree, #pylint: disable=too-many-arguments
+                            pruning_set, extractors=None, decompress_threads=0):
+    """
+    Submits the extraction of the Chromium source code archive into the buildspace tree
+    to the extraction executor.
+
+    pruning_set is a set of files to be pruned. It is not modified.
     extractors is a dictionary of PlatformEnum to a command or path to the
     extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip.
+    decompress_threads is the number of threads to decompress with, or 0 for one per
+    CPU core.
+
+    Returns a concurrent.futures.Future of a tuple of the set of files in pruning_set that
+    were not found during extraction, and a dictionary of the hashes of the extracted files.
+    """
+    get_logger().info('Extracting archive...')
+    return executor.submit(
+        _extract_archive, ExtractorEnum.TAR, source_archive, buildspace_tree, Path(),
+        set(pruning_set), Path('chromium-{}'.format(config_bundle.version.chromium_version)),
+        extractors, decompress_threads)
+
+def _download_extra_dep(downloader, dep_name, dep_properties, buildspace_downloads, #pylint: disable=too-many-arguments
+                        show_progress, download_connections=1, download_cache=None,
+                        paranoid=False):
+    """
+    Download and check an extra dependency.
+
+    dep_name is the name of the section in extra_deps.ini, and dep_properties are
+    its properties.
+
+    Returns the pathlib.Path to the verified archive.
 
     Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
     Raises source_retrieval.NotAFileError when the archive name exists but is not a file.
-    May raise undetermined exceptions during archive unpacking.
     """
-    for dep_name in config_bundle.extra_deps:
-        get_logger().info('Downloading extra dependency "%s" ...', dep_name)
-        dep_properties = config_bundle.extra_deps[dep_name]
-        dep_archive = buildspace_downloads / dep_properties.download_name
-        _download_if_needed(dep_archive, dep_properties.url, show_progress)
-        get_logger().info('Verifying hashes...')
-        with dep_archive.open('rb') as file_obj:
-            archive_data = file_obj.read()
-        for hash_name, hash_hex in dep_properties.hashes.items():
-            get_logger().debug('Verifying %s hash...', hash_name)
-            hasher = hashlib.new(hash_name, data=archive_data)
-            if not hasher.hexdigest().lower() == hash_hex.lower():
-                raise HashMismatchError(dep_archive)
-        get_logger().info('Extracting to %s ...', dep_properties.output_path)
-        extractor_name = dep_properties.extractor or ExtractorEnum.TAR
-        if extractor_name == ExtractorEnum.SEVENZIP:
-            extractor_func = extract_with_7z
-        elif extractor_name == ExtractorEnum.TAR:
-            extractor_func = extract_tar_file
-        else:
-            # This is not a normal code path
-            raise NotImplementedError(extractor_name)
+    get_logger().info('Downloading extra dependency "%s" ...', dep_name)
+    dep_archive = buildspace_downloads / dep_properties.download_name
+    _retrieve_archive(
+        downloader, dep_archive, dep_properties.urls, show_progress,
+        tuple(dep_properties.hashes.items()), download_connections=download_connections,
+        download_cache=download_cache, paranoid=paranoid)
+    return dep_archive
 
-        if dep_properties.strip_leading_dirs is None:
-            strip_leading_dirs_path = None
-        else:
-            strip_leading_dirs_path = Path(dep_properties.strip_leading_dirs)
+def _submit_extra_dep(executor, dep_properties, dep_archive, buildspace_tree, pruning_set, #pylint: disable=too-many-arguments
+                      extractors=None, decompress_threads=0):
+    """
+    Submits the extraction of an extra dependency into the buildspace tree to the
+    extraction executor. Its output directory is created if it does not exist.
+
+    pruning_set is a set of files to be pruned. It is not modified.
+    extractors is a dictionary of PlatformEnum to a command or path to the
+    extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip.
+    decompress_threads is the number of threads to decompress with, or 0 for one per
+    CPU core.
+
+    Returns a concurrent.futures.Future of a tuple of the set of files in pruning_set that
+    were not found during extraction, and a dictionary of the hashes of the extracted files.
+    """
+    get_logger().info('Extracting to %s ...', dep_properties.output_path)
+    (buildspace_tree / dep_properties.output_path).mkdir(parents=True, exist_ok=True)
+
+    if dep_properties.strip_leading_dirs is None:
+        strip_leading_dirs_path = None
+    else:
+        strip_leading_dirs_path = Path(dep_properties.strip_leading_dirs)
+
+    return executor.submit(
+        _extract_archive, dep_properties.extractor or ExtractorEnum.TAR, dep_archive,
+        buildspace_tree, Path(dep_properties.output_path), set(pruning_set),
+        strip_leading_dirs_path, extractors, decompress_threads)
+
+def _partition_pruning_set(pruning_set, unpack_dirs):
+    """
+    Returns a dictionary of each POSIX path string in unpack_dirs to a set of the files in
+    pruning_set inside of it. Each file is assigned to the longest unpack directory
+    containing it; the directory '.' contains all files.
+    """
+    partitions = {PurePosixPath(x).as_posix(): set() for x in unpack_dirs}
+    for tree_path in pruning_set:
+        for parent in PurePosixPath(tree_path).parents:
+            if parent.as_posix() in partitions:
+                partitions[parent.as_posix()].add(tree_path)
+                break
+    return partitions
+
+def _unpack_dirs_overlap(first_dir, second_dir):
+    """Returns True if the POSIX path string first_dir contains second_dir or vice versa"""
+    first_parts = PurePosixPath(first_dir).parts
+    second_parts = PurePosixPath(second_dir).parts
+    common_length = min(len(first_parts), len(second_parts))
+    return first_parts[:common_length] == second_parts[:common_length]
+
+def _retrieve_concurrently(downloader, config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments,too-many-locals,too-many-branches
+                           show_progress, pruning_set, file_hashes, extractors,
+                           download_connections, download_workers, download_cache, paranoid,
+                           decompress_threads, extract_workers):
+    """
+    Downloads the Chromium source code and all extra dependencies concurrently, and
+    extracts each archive in a pool of extract_workers processes as soon as it is downloaded
+    and verified.
 
-        extractor_func(
-            archive_path=dep_archive, buildspace_tree=buildspace_tree,
-            unpack_dir=Path(dep_properties.output_path), ignore_files=pruning_set,
-            relative_to=strip_leading_dirs_path, extractors=extractors)
+    downloader is the Downloader shared by all downloads.
+    download_workers is the maximum number of archives downloaded at the same time.
+    extract_workers is the maximum number of archives extracted at the same time, or 0 for
+    one per CPU core. If it is 1, the archives are extracted in this process. The extra
+    dependencies are extracted while the Chromium source code is extracted, since they are
+    unpacked into their own directories of the source tree.
+    Extra dependencies with overlapping output paths are extracted one at a time.
+    pruning_set is partitioned between the archives by their output paths; each file is
+    pruned by the archive with the longest output path containing it. The files that were
+    found are removed from pruning_set when all extractions finish.
+    file_hashes is a dictionary that the hashes of the extracted files computed during
+    extraction are added to, for the tree manifest.
 
-def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments
+    Other arguments of the same name are shared with retreive_and_extract().
+    """
+    # Concurrent progress bars would overwrite each other
+    dep_progress = show_progress and download_workers <= 1
+    source_dir = PurePosixPath().as_posix()
+    dep_dirs = {
+        x: PurePosixPath(config_bundle.extra_deps[x].output_path).as_posix()
+        for x in config_bundle.extra_deps
+    }
+    partitions = _partition_pruning_set(pruning_set, (source_dir, *dep_dirs.values()))
+    download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=download_workers)
+    if extract_workers == 1:
+        # Extracting in this process avoids starting a worker process for a single extraction
+        extract_executor = _InlineExecutor()
+    else:
+        extract_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=extract_workers or None)
+    with download_executor, extract_executor:
+        download_futures = dict()
+        download_futures[download_executor.submit(
+            _download_chromium_source, downloader, config_bundle, buildspace_downloads,
+            show_progress, download_connections, download_cache, paranoid)] = None
+        for dep_name in config_bundle.extra_deps:
+            dep_properties = config_bundle.extra_deps[dep_name]
+            download_futures[download_executor.submit(
+                _download_extra_dep, downloader, dep_name, dep_properties, buildspace_downloads,
+                dep_progress, download_connections, download_cache, paranoid)] = dep_name
+        # Extraction futures to their unpack directories
+        extract_futures = dict()
+        # Tuples of dependency names and archives waiting for an overlapping extraction
+        waiting_deps = list()
+        pending_futures = set(download_futures)
+        try:
+            while pending_futures:
+                done_futures, pending_futures = concurrent.futures.wait(
+                    pending_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done_futures:
+                    if future in extract_futures:
+                        unpack_dir = extract_futures.pop(future)
+                        partitions[unpack_dir], dir_hashes = future.result()
+                        file_hashes.update(dir_hashes)
+                    elif download_futures[future] is None:
+                        extract_futures[_submit_chromium_source(
+                            extract_executor, config_bundle, future.result(), buildspace_tree,
+                            partitions[source_dir], extractors, decompress_threads)] = source_dir
+                    else:
+                        waiting_deps.append((download_futures[future], future.result()))
+                for dep_name, dep_archive in list(waiting_deps):
+                    dep_dir = dep_dirs[dep_name]
+                    if any(_unpack_dirs_overlap(dep_dir, x) for x in extract_futures.values()
+                           if x != source_dir):
+                        continue
+                    waiting_deps.remove((dep_name, dep_archive))
+                    extract_futures[_submit_extra_dep(
+                        extract_executor, config_bundle.extra_deps[dep_name], dep_archive,
+                        buildspace_tree, partitions[dep_dir], extractors,
+                        decompress_threads)] = dep_dir
+                pending_futures.update(extract_futures)
+        except BaseException:
+            # Do not start downloads or extractions that are no longer needed
+            for future in (*download_futures, *extract_futures):
+                future.cancel()
+            raise
+    pruning_set.clear()
+    for partition in partitions.values():
+        pruning_set.update(partition)
+
+def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments,too-many-locals,too-many-branches
                          prune_binaries=True, show_progress=True, extractors=None,
-                         disable_ssl_verification=False):
+                         disable_ssl_verification=False, download_connections=1,
+                         download_workers=1, download_cache=None, download_cache_size=None,
+                         paranoid=False, decompress_threads=0, extract_workers=0,
+                         snapshot_cache=None, snapshot_cache_size=None,
+                         snapshot_method=SnapshotMethod.AUTO):
     """
     Downloads, checks, and unpacks the Chromium source code and extra dependencies
     defined in the config bundle into the buildspace tree.
@@ -191,6 +1248,32 @@ def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree, #
     extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip.
     disable_ssl_verification is a boolean indicating if certificate verification
     should be disabled for downloads using HTTPS.
+    download_connections is the number of concurrent connections used to download each
+    archive. Servers without support for range requests fall back to one connection.
+    download_workers is the maximum number of archives to download at the same time.
+    Archives are extracted while the remaining archives are downloading.
+    download_cache is a pathlib.Path to a directory of verified archives shared between
+    buildspaces, or None to not use one. Archives are keyed by their expected hashes.
+    download_cache_size is the maximum size of the download cache in bytes, or None for
+    no limit. Least recently used archives are removed when the limit is exceeded.
+    paranoid is a boolean indicating if existing archives are always fully verified. By default,
+    archives that are unchanged since they were last verified are not hashed again.
+    decompress_threads is the number of threads to decompress archives with, or 0 for one
+    per CPU core. 1 always uses single-threaded decompression.
+    extract_workers is the maximum number of archives to extract at the same time in
+    separate processes, or 0 for one per CPU core. Extra dependencies are extracted
+    while the Chromium source code is extracted.
+    snapshot_cache is a pathlib.Path to a directory of pristine trees shared between
+    buildspaces, or None to not use one. If a snapshot of the same Chromium version, pruning
+    list, and extra dependencies exists, the buildspace tree is materialized from it without
+    downloading or extracting any archives. Otherwise, the archives are extracted into a new
+    snapshot first.
+    snapshot_cache_size is the maximum size of the snapshot cache in bytes, or None for
+    no limit. Least recently used snapshots are removed when the limit is exceeded.
+    snapshot_method is the snapshot_cache.SnapshotMethod value to materialize snapshots with.
+
+    Once the tree is complete, a tree manifest is written next to it, so the tree can be
+    checked with tree_manifest.verify_tree().
 
     Raises FileExistsError when the buildspace tree already exists and is not empty
     Raises FileNotFoundError when buildspace/downloads does not exist or through
@@ -202,32 +1285,61 @@ def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree, #
     May raise undetermined exceptions during archive unpacking.
     """
     ensure_empty_dir(buildspace_tree) # FileExistsError, FileNotFoundError
+    # A stale manifest must not be mistaken for that of an interrupted extraction
+    remove_manifest(buildspace_tree)
+    # Journal entries of files of the old tree must not be used for the new one
+    remove_journal(buildspace_tree)
     if not buildspace_downloads.exists():
         raise FileNotFoundError(buildspace_downloads)
     if not buildspace_downloads.is_dir():
         raise NotADirectoryError(buildspace_downloads)
+    if download_cache:
+        download_cache = _DownloadCache(download_cache, download_cache_size)
     if prune_binaries:
         remaining_files = set(config_bundle.pruning)
     else:
         remaining_files = set()
-    if disable_ssl_verification:
-        import ssl
-        # TODO: Properly implement disabling SSL certificate verification
-        orig_https_context = ssl._create_default_https_context #pylint: disable=protected-access
-        ssl._create_default_https_context = ssl._create_unverified_context #pylint: disable=protected-access
-    try:
-        _setup_chromium_source(
-            config_bundle=config_bundle, buildspace_downloads=buildspace_downloads,
-            buildspace_tree=buildspace_tree, show_progress=show_progress,
-            pruning_set=remaining_files, extractors=extractors)
-        _setup_extra_deps(
-            config_bundle=config_bundle, buildspace_downloads=buildspace_downloads,
-            buildspace_tree=buildspace_tree, show_progress=show_progress,
-            pruning_set=remaining_files, extractors=extractors)
-    finally:
-        # Try to reduce damage of hack by reverting original HTTPS context ASAP
-        if disable_ssl_verification:
-            ssl._create_default_https_context = orig_https_context #pylint: disable=protected-access
+    if snapshot_cache:
+        snapshot_cache = SnapshotCache(snapshot_cache, snapshot_cache_size)
+        snapshot_name = get_snapshot_name(config_bundle, prune_binaries)
+        snapshot = snapshot_cache.get(snapshot_name)
+        if snapshot is None:
+            get_logger().info('Snapshot %s not found. Creating it...', snapshot_name)
+            snapshot_path = snapshot_cache.begin(snapshot_name)
+            extract_tree = snapshot_cache.get_tree(snapshot_path)
+    else:
+        snapshot = None
+        extract_tree = buildspace_tree
+    if snapshot is None:
+        file_hashes = dict()
+        try:
+            with Downloader(disable_ssl_verification=disable_ssl_verification) as downloader:
+                _retrieve_concurrently(
+                    downloader=downloader, config_bundle=config_bundle,
+                    buildspace_downloads=buildspace_downloads, buildspace_tree=extract_tree,
+                    show_progress=show_progress, pruning_set=remaining_files,
+                    file_hashes=file_hashes, extractors=extractors,
+                    download_connections=download_connections,
+                    download_workers=download_workers, download_cache=download_cache,
+                    paranoid=paranoid, decompress_threads=decompress_threads,
+                    extract_workers=extract_workers)
+            write_manifest(extract_tree, file_hashes)
+        except BaseException:
+            if snapshot_cache:
+                snapshot_cache.discard(snapshot_path)
+            raise
+        if snapshot_cache:
+            snapshot = snapshot_cache.commit(
+                snapshot_path, snapshot_name, config_bundle.version.chromium_version,
+                remaining_files)
+    if snapshot_cache:
+        snapshot_cache.materialize(
+            snapshot, buildspace_tree, method=snapshot_method,
+            copy_files=set(config_bundle.domain_substitution))
+        remaining_files = set(snapshot.unpruned_files)
+        if not get_manifest_path(buildspace_tree).exists():
+            # The snapshot was created without a manifest
+            write_manifest(buildspace_tree)
     if remaining_files:
         logger = get_logger()
         for path in remaining_files:
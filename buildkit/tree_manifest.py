@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Integrity manifests of buildspace trees
+
+A manifest records the path, type, size, mode, and content hash of every entry in a tree.
+It is written next to the tree once extraction completes, so a tree from an interrupted
+extraction has no manifest. A tree can be verified against its manifest in a fraction of
+the time it takes to extract the archives again.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import stat
+
+from .common import ENCODING, get_logger
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Constants
+
+MANIFEST_SUFFIX = '.manifest'
+
+_MANIFEST_VERSION = 1
+# Number of bytes to read from a file at a time while hashing it
+_HASH_CHUNK_SIZE = 1024 * 1024 # 1 MiB
+# Number of entries checked by each task during verification
+_VERIFY_BATCH_SIZE = 256
+
+# Entry types
+_TYPE_FILE = 'f'
+_TYPE_DIRECTORY = 'd'
+_TYPE_SYMLINK = 'l'
+
+def _get_default_hash_name():
+    """Returns the name of the fastest available hash algorithm"""
+    if not xxhash is None and hasattr(xxhash, 'xxh3_128'):
+        return 'xxh3_128'
+    if hasattr(hashlib, 'blake2b'):
+        return 'blake2b'
+    return 'sha256'
+
+# Name of the hash algorithm of new manifests. xxhash is used if the module is installed.
+HASH_NAME = _get_default_hash_name()
+
+# Public classes
+
+ManifestProblem = collections.namedtuple('ManifestProblem', ('path', 'reason'))
+ManifestProblem.__doc__ = """
+A difference between a tree and its manifest.
+
+path is the POSIX path string of the entry relative to the tree.
+reason is a string describing the difference.
+"""
+
+# Public methods
+
+def new_hasher(hash_name=HASH_NAME):
+    """
+    Returns a new hash object of the algorithm hash_name.
+
+    Raises ValueError if the algorithm is not available.
+    """
+    if hash_name.startswith('xxh'):
+        if xxhash is None or not hasattr(xxhash, hash_name):
+            raise ValueError('The xxhash module is required for hash algorithm {}'.format(
+                hash_name))
+        return getattr(xxhash, hash_name)()
+    return hashlib.new(hash_name)
+
+def get_manifest_path(tree_path):
+    """Returns the pathlib.Path of the manifest of the tree at tree_path"""
+    return tree_path.with_name(tree_path.name + MANIFEST_SUFFIX)
+
+def remove_manifest(tree_path):
+    """Removes the manifest of the tree at tree_path if it exists"""
+    try:
+        get_manifest_path(tree_path).unlink()
+    except FileNotFoundError:
+        pass
+
+def write_manifest(tree_path, file_hashes=None, threads=0):
+    """
+    Writes the manifest of the tree at tree_path. The manifest is written to a temporary file
+    first, so it only exists once it is complete.
+
+    file_hashes is a dictionary of POSIX path strings relative to tree_path to the HASH_NAME
+    hashes of regular files, computed while they were extracted, or None. Other regular
+    files are read and hashed in parallel.
+    threads is the number of threads to hash files with, or 0 for one per CPU core.
+
+    Returns the number of entries in the manifest.
+    """
+    if file_hashes is None:
+        file_hashes = dict()
+    entries = list()
+    unhashed_entries = list()
+    for relative_path, stat_result in _scan_tree(str(tree_path)):
+        if stat.S_ISLNK(stat_result.st_mode):
+            entry = [relative_path, _TYPE_SYMLINK, 0, 0,
+                     os.readlink(os.path.join(str(tree_path), relative_path))]
+        elif stat.S_ISDIR(stat_result.st_mode):
+            entry = [relative_path, _TYPE_DIRECTORY, stat.S_IMODE(stat_result.st_mode), 0, None]
+        else:
+            entry = [relative_path, _TYPE_FILE, stat.S_IMODE(stat_result.st_mode),
+                     stat_result.st_size, file_hashes.get(relative_path)]
+            if entry[4] is None:
+                unhashed_entries.append(entry)
+        entries.append(entry)
+    if unhashed_entries:
+        get_logger().info('Hashing %s files for the tree manifest...', len(unhashed_entries))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads or None) as executor:
+            for entry, digest in zip(unhashed_entries, executor.map(
+                    lambda x: _hash_file(os.path.join(str(tree_path), x[0]), HASH_NAME),
+                    unhashed_entries)):
+                entry[4] = digest
+    manifest_path = get_manifest_path(tree_path)
+    temp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with gzip.open(str(temp_path), 'wt', encoding=ENCODING) as manifest_file:
+        json.dump({
+            'version': _MANIFEST_VERSION,
+            'hash': HASH_NAME,
+            'entries': entries,
+        }, manifest_file, separators=(',', ':'))
+    temp_path.replace(manifest_path)
+    get_logger().info('Wrote tree manifest with %s entries: %s', len(entries), manifest_path)
+    return len(entries)
+
+def verify_tree(tree_path, check_hashes=True, threads=0):
+    """
+    Verifies the tree at tree_path against its manifest in parallel.
+
+    check_hashes is a boolean indicating if the contents of regular files are hashed.
+    Otherwise, only the types, sizes, and modes of entries are checked.
+    threads is the number of threads to verify with, or 0 for one per CPU core.
+
+    Returns a list of ManifestProblem sorted by path; it is empty if the tree matches.
+
+    Raises FileNotFoundError if the tree or its manifest does not exist.
+    Raises ValueError if the manifest is invalid or uses an unavailable hash algorithm.
+    """
+    if not tree_path.is_dir():
+        raise FileNotFoundError(tree_path)
+    manifest_path = get_manifest_path(tree_path)
+    try:
+        with gzip.open(str(manifest_path), 'rt', encoding=ENCODING) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, EOFError) as exc:
+        if isinstance(exc, FileNotFoundError):
+            raise
+        raise ValueError('Unable to read {}: {}'.format(manifest_path, exc))
+    if manifest.get('version') != _MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version: {}'.format(manifest.get('version')))
+    hash_name = manifest['hash']
+    if check_hashes:
+        new_hasher(hash_name) # Raises ValueError if unavailable
+    else:
+        hash_name = None
+    entries = manifest['entries']
+    problems = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads or None) as executor:
+        futures = list()
+        for batch_start in range(0, len(entries), _VERIFY_BATCH_SIZE):
+            futures.append(executor.submit(
+                _verify_entries, str(tree_path),
+                entries[batch_start:batch_start + _VERIFY_BATCH_SIZE], hash_name))
+        # Find entries that are not in the manifest while the entries are checked
+        manifest_paths = set(x[0] for x in entries)
+        for relative_path, _ in _scan_tree(str(tree_path)):
+            if not relative_path in manifest_paths:
+                problems.append(ManifestProblem(relative_path, 'not in manifest'))
+        for future in futures:
+            problems.extend(future.result())
+    problems.sort()
+    return problems
+
+# Private methods
+
+def _scan_tree(root):
+    """
+    Yields a tuple of the POSIX path string relative to root and the os.stat_result
+    of every entry under the directory path string root, without following symbolic links.
+    """
+    pending_dirs = [('', root)]
+    while pending_dirs:
+        relative_dir, dir_path = pending_dirs.pop()
+        with os.scandir(dir_path) as dir_entries:
+            for dir_entry in dir_entries:
+                relative_path = relative_dir + dir_entry.name
+                stat_result = dir_entry.stat(follow_symlinks=False)
+                yield relative_path, stat_result
+                if stat.S_ISDIR(stat_result.st_mode):
+                    pending_dirs.append((relative_path + '/', dir_entry.path))
+
+def _hash_file(path, hash_name):
+    """Returns the hexadecimal hash of the file at path string path"""
+    hasher = new_hasher(hash_name)
+    with open(path, 'rb') as file_obj:
+        while True:
+            data = file_obj.read(_HASH_CHUNK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def _verify_entries(root, entries, hash_name):
+    """
+    Returns a list of ManifestProblem of manifest entries that do not match the tree at the
+    path string root. Contents of regular files are only hashed if hash_name is not None.
+    """
+    problems = list()
+    for relative_path, entry_type, mode, size, value in entries:
+        path = os.path.join(root, relative_path)
+        try:
+            stat_result = os.lstat(path)
+        except FileNotFoundError:
+            problems.append(ManifestProblem(relative_path, 'missing'))
+            continue
+        if entry_type == _TYPE_SYMLINK:
+            if not stat.S_ISLNK(stat_result.st_mode):
+                problems.append(ManifestProblem(relative_path, 'not a symbolic link'))
+            elif os.readlink(path) != value:
+                problems.append(ManifestProblem(relative_path, 'symbolic link target differs'))
+            continue
+        if entry_type == _TYPE_DIRECTORY and not stat.S_ISDIR(stat_result.st_mode):
+            problems.append(ManifestProblem(relative_path, 'not a directory'))
+            continue
+        if entry_type == _TYPE_FILE and not stat.S_ISREG(stat_result.st_mode):
+            problems.append(ManifestProblem(relative_path, 'not a regular file'))
+            continue
+        if stat.S_IMODE(stat_result.st_mode) != mode:
+            problems.append(ManifestProblem(relative_path, 'mode differs: {:o} != {:o}'.format(
+                stat.S_IMODE(stat_result.st_mode), mode)))
+        if entry_type != _TYPE_FILE:
+            continue
+        if stat_result.st_size != size:
+            problems.append(ManifestProblem(relative_path, 'size differs: {} != {}'.format(
+                stat_result.st_size, size)))
+        elif not hash_name is None and _hash_file(path, hash_name) != value:
+            problems.append(ManifestProblem(relative_path, 'contents differ'))
+    return problems
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Substitute domains in a small tree through buildkit and compare the results between modes.
+
+It checks the following against sequential substitution in one process:
+
+    * Substitution in a pool of worker processes started with the spawn start method
+    * The subdom command of buildkit-launcher.py with several jobs under the spawn start method
+    * Substitution with the regex pairs combined into one pattern
+    * Substitution with combining requested, when the private regex parser of the re module
+      is unavailable or fails. It must fall back to sequential substitution.
+
+Exit codes:
+    * 0 if all checks pass
+    * 1 if any check fails
+"""
+
+import argparse
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from buildkit import domain_substitution
+from buildkit.common import get_logger
+from buildkit.config import ConfigBundle
+from buildkit.domain_substitution import substitute_domains_for_files
+sys.path.pop(0)
+
+_LAUNCHER_PATH = Path(__file__).resolve().parent.parent / 'buildkit-launcher.py'
+# Runs the launcher as the main module with the spawn start method
+_SPAWN_LAUNCHER_CODE = (
+    'import multiprocessing, runpy, sys; '
+    'multiprocessing.set_start_method("spawn"); '
+    'sys.argv = sys.argv[1:]; '
+    'runpy.run_path(sys.argv[0], run_name="__main__")')
+_BASE_BUNDLE = 'common'
+# Number of jobs to substitute with
+_JOBS = 2
+# Files of the tree to their content
+_TREE_FILES = {
+    'a.cc': 'const char kUrl[] = "https://www.google.com/search";\n',
+    'b.py': 'URLS = ["https://clients2.google.com", "https://chromium.googlesource.com"]\n',
+    'c.txt': 'fonts.googleapis.com and fonts\\.googleapis\\.com\n',
+    'd.html': '<a href="https://www.chromium.org">chromium</a>\n',
+    'empty.txt': '',
+    'unchanged.txt': 'No domains here\n',
+}
+
+def _create_tree(tree_path):
+    """Creates the tree of _TREE_FILES at tree_path"""
+    tree_path.mkdir(parents=True)
+    for name, content in _TREE_FILES.items():
+        (tree_path / name).write_text(content)
+
+def _read_tree(tree_path):
+    """Returns a dictionary of the names of _TREE_FILES to their content in tree_path"""
+    return {x: (tree_path / x).read_text() for x in _TREE_FILES}
+
+def _compare_trees(expected_path, tree_path):
+    """Returns a list of strings describing the files of tree_path that differ"""
+    expected = _read_tree(expected_path)
+    actual = _read_tree(tree_path)
+    return ['{} differs'.format(x) for x in _TREE_FILES if expected[x] != actual[x]]
+
+def _fail_parse(*_):
+    """Regex parser that fails like one with an incompatible private API"""
+    raise AttributeError('Incompatible regex parser')
+
+def _check_combined(regex_pairs, expected_path, temp_dir, regex_parser, expect_combined):
+    """
+    Substitutes a copy of the tree with combining requested, in one process. regex_parser
+    replaces the private regex parser module of domain_substitution during substitution.
+    expect_combined indicates if the pairs must be combined into one pattern.
+
+    Returns a list of strings describing the problems with the substitution.
+    """
+    tree_path = Path(tempfile.mkdtemp(prefix='combined_', dir=str(temp_dir))) / 'tree'
+    _create_tree(tree_path)
+    original_parser = domain_substitution.sre_parse
+    domain_substitution.sre_parse = regex_parser
+    try:
+        substituter = domain_substitution._get_substituter( #pylint: disable=protected-access
+            regex_pairs, combined=True)
+        substitute_domains_for_files(
+            regex_pairs, map(lambda x: tree_path / x, _TREE_FILES), log_warnings=False,
+            combined=True)
+    except Exception as exc: #pylint: disable=broad-except
+        return ['Substitution failed: {!r}'.format(exc)]
+    finally:
+        domain_substitution.sre_parse = original_parser
+    problems = _compare_trees(expected_path, tree_path)
+    is_combined = isinstance(
+        getattr(substituter.subn, '__self__', None),
+        domain_substitution._CombinedPairs) #pylint: disable=protected-access
+    if is_combined != expect_combined:
+        problems.append('Pairs were {}combined'.format('' if is_combined else 'not '))
+    return problems
+
+def _check_spawn_pool(regex_pairs, expected_path, temp_dir):
+    """
+    Substitutes a copy of the tree in a pool of processes started with spawn.
+
+    Returns a list of strings describing the problems with the substituted files.
+    """
+    tree_path = temp_dir / 'pool_tree'
+    _create_tree(tree_path)
+    substitute_domains_for_files(
+        regex_pairs, map(lambda x: tree_path / x, _TREE_FILES), log_warnings=False, jobs=_JOBS)
+    return _compare_trees(expected_path, tree_path)
+
+def _check_spawn_launcher(bundle_path, expected_path, temp_dir):
+    """
+    Substitutes a copy of the tree with the subdom command of the launcher under spawn.
+
+    Returns a list of strings describing the problems with the substituted files.
+    """
+    tree_path = temp_dir / 'launcher_tree'
+    _create_tree(tree_path)
+    result = subprocess.run(
+        (sys.executable, '-c', _SPAWN_LAUNCHER_CODE, str(_LAUNCHER_PATH), 'subdom', '-u',
+         str(bundle_path), '-o', 'tree', '-t', str(tree_path), '-j', str(_JOBS)),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode:
+        return ['subdom exited with code {}:\n{}'.format(result.returncode, result.stdout)]
+    return _compare_trees(expected_path, tree_path)
+
+def main(arg_list=None):
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args(args=arg_list)
+
+    multiprocessing.set_start_method('spawn', force=True)
+    logger = get_logger()
+    failed = False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        bundle_path = temp_dir / 'bundle'
+        ConfigBundle.from_base_name(_BASE_BUNDLE).write(bundle_path)
+        (bundle_path / 'domain_substitution.list').write_text(
+            ''.join(x + '\n' for x in _TREE_FILES))
+        regex_pairs = ConfigBundle(bundle_path).domain_regex.get_pairs()
+        expected_path = temp_dir / 'expected_tree'
+        _create_tree(expected_path)
+        substitute_domains_for_files(
+            regex_pairs, map(lambda x: expected_path / x, _TREE_FILES), log_warnings=False)
+        if _read_tree(expected_path) == dict(_TREE_FILES):
+            logger.error('Substitution in one process did not change any file')
+            failed = True
+        checks = (
+            ('Pool of processes with spawn',
+             _check_spawn_pool(regex_pairs, expected_path, temp_dir)),
+            ('Launcher subdom command with spawn',
+             _check_spawn_launcher(bundle_path, expected_path, temp_dir)),
+            ('Combined pattern',
+             _check_combined(
+                 regex_pairs, expected_path, temp_dir, domain_substitution.sre_parse, True)),
+            ('Combined pattern without regex parser',
+             _check_combined(regex_pairs, expected_path, temp_dir, None, False)),
+            ('Combined pattern with failing regex parser',
+             _check_combined(
+                 regex_pairs, expected_path, temp_dir, types.SimpleNamespace(parse=_fail_parse),
+                 False)),
+        )
+        for name, problems in checks:
+            for problem in problems:
+                logger.error('%s: %s', name, problem)
+            if problems:
+                failed = True
+            else:
+                logger.info('%s: OK', name)
+    if failed:
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
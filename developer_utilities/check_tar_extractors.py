@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Extract a small archive with each tar binary on PATH and the Python extractor through buildkit.
+
+It checks the following for each tar binary (GNU tar and bsdtar) and the Python extractor:
+
+    * The relative_to directory is stripped from member names
+    * Symbolic link targets are not changed
+    * Hardlinks are extracted
+    * Pruned files are excluded
+    * Hardlinks to pruned files are extracted with their content, and the pruned files
+      are removed
+
+Exit codes:
+    * 0 if all checks pass
+    * 1 if any check fails, or no tar binary is found
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from buildkit.common import BuildkitAbort, ExtractorEnum, get_logger
+from buildkit.extraction import extract_tar_file
+sys.path.pop(0)
+
+# Names of tar binaries to check by default
+_DEFAULT_BINARIES = ('tar', 'gtar', 'bsdtar')
+# relative_to directories to check. The second cannot use the default bsdtar delimiter.
+_PREFIXES = ('chromium-1.2.3', 'chromium,1.2.3')
+_FILE_CONTENT = b'file content\n'
+_PRUNED_CONTENT = b'pruned content\n'
+# Name of the Python extractor in messages
+_PYTHON_EXTRACTOR = 'Python extractor'
+
+def _create_archive(archive_path, source_dir, prefix):
+    """Creates the tar archive at archive_path with the members under the directory prefix"""
+    root = source_dir / prefix
+    (root / 'dir').mkdir(parents=True)
+    (root / 'dir' / 'file.txt').write_bytes(_FILE_CONTENT)
+    (root / 'pruned.bin').write_bytes(b'\0')
+    os.symlink('dir/file.txt', str(root / 'symlink'))
+    os.link(str(root / 'dir' / 'file.txt'), str(root / 'hardlink'))
+    (root / 'pruned_target.bin').write_bytes(_PRUNED_CONTENT)
+    os.link(str(root / 'pruned_target.bin'), str(root / 'hardlink_to_pruned'))
+    with tarfile.open(str(archive_path), 'w') as tar_file:
+        # Members are added in this order so that the first path of each hardlinked file
+        # is its target
+        for name in ('', 'dir', 'dir/file.txt', 'pruned.bin', 'symlink', 'hardlink',
+                     'pruned_target.bin', 'hardlink_to_pruned'):
+            tar_file.add(
+                str(root / name), arcname=str(PurePosixPath(prefix, name)), recursive=False)
+
+def _check_binary(binary, prefix):
+    """
+    Extracts an archive with the tar binary, or the Python extractor if binary is None,
+    stripping the relative_to directory prefix.
+
+    Returns a list of strings describing the problems with the extracted files.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        archive_path = temp_dir / 'archive.tar'
+        _create_archive(archive_path, temp_dir / 'source', prefix)
+        buildspace_tree = temp_dir / 'tree'
+        (buildspace_tree / 'out').mkdir(parents=True)
+        ignore_files = {'out/pruned.bin', 'out/pruned_target.bin'}
+        file_hashes = dict()
+        try:
+            extract_tar_file(
+                archive_path, buildspace_tree, Path('out'), ignore_files, Path(prefix),
+                extractors={ExtractorEnum.TAR: binary}, threads=1, file_hashes=file_hashes)
+        except BuildkitAbort:
+            return ['Extraction failed']
+        out_dir = buildspace_tree / 'out'
+        problems = list()
+        if (out_dir / prefix).exists():
+            problems.append('relative_to directory was not stripped')
+        for name in ('dir/file.txt', 'hardlink'):
+            path = out_dir / name
+            if not path.is_file() or path.read_bytes() != _FILE_CONTENT:
+                problems.append('{} is missing or has the wrong content'.format(name))
+        if not (out_dir / 'symlink').is_symlink():
+            problems.append('symlink is missing')
+        elif os.readlink(str(out_dir / 'symlink')) != 'dir/file.txt':
+            problems.append('symlink target was changed')
+        for name in ('pruned.bin', 'pruned_target.bin'):
+            if (out_dir / name).exists() or 'out/' + name in ignore_files:
+                problems.append('{} was not pruned'.format(name))
+            if 'out/' + name in file_hashes:
+                problems.append('{} has a hash for the tree manifest'.format(name))
+        path = out_dir / 'hardlink_to_pruned'
+        if not path.is_file() or path.read_bytes() != _PRUNED_CONTENT:
+            problems.append('hardlink_to_pruned is missing or has the wrong content')
+        if not 'out/hardlink_to_pruned' in file_hashes:
+            problems.append('hardlink_to_pruned has no hash for the tree manifest')
+        return problems
+
+def main(arg_list=None):
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'binaries', metavar='BINARY', nargs='*', default=_DEFAULT_BINARIES,
+        help='Tar binaries to check. Missing binaries are skipped. Default: %(default)s')
+    args = parser.parse_args(args=arg_list)
+
+    logger = get_logger()
+    checked_binaries = set()
+    failed = False
+    for binary in args.binaries:
+        binary_path = shutil.which(binary)
+        if binary_path is None:
+            logger.info('Skipping tar binary not on PATH: %s', binary)
+            continue
+        if os.path.realpath(binary_path) in checked_binaries:
+            continue
+        checked_binaries.add(os.path.realpath(binary_path))
+    if not checked_binaries:
+        logger.error('No tar binary found')
+        failed = True
+    for binary_path in (*sorted(checked_binaries), None):
+        name = _PYTHON_EXTRACTOR if binary_path is None else binary_path
+        for prefix in _PREFIXES:
+            problems = _check_binary(binary_path, prefix)
+            for problem in problems:
+                logger.error('%s with relative_to "%s": %s', name, prefix, problem)
+            if problems:
+                failed = True
+            else:
+                logger.info('%s with relative_to "%s": OK', name, prefix)
+    if failed:
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()